@@ -3,7 +3,17 @@ import os
 from gluon.serializers import json
 import json as json_package
 import module_admin_functions
+import api_payload
+import json_response
+import db_indexes
+import stream_index
+import thumbnails
+import daily_counts
+import audio_browser
+import audio_export
 import time
+import datetime
+import tempfile
 
 # common set of export classes to suppress
 EXPORT_CLASSES = dict(csv_with_hidden_cols=False,
@@ -12,6 +22,52 @@ EXPORT_CLASSES = dict(csv_with_hidden_cols=False,
                       tsv_with_hidden_cols=False,
                       tsv=False)
 
+# tables used to build the api_response payload
+API_TABLES = ('sites', 'site_images', 'taxa', 'taxon_observations',
+              'gbif_sound_occurrences', 'audio', 'audio_streams')
+
+
+def refreshes_api_payload(action):
+
+    """
+    Decorator for admin actions that can change the content of the api_response
+    payload. Changes to the tables used in the payload are noted using the DAL
+    callbacks and, if there are any, the payload is rendered again once the
+    action completes, including actions that finish by redirecting.
+    """
+
+    def wrapper(*args, **kwargs):
+
+        changed = []
+
+        def note_change(*_):
+            changed.append(True)
+
+        for tbl in API_TABLES:
+            db[tbl]._after_insert.append(note_change)
+            db[tbl]._after_update.append(note_change)
+            db[tbl]._after_delete.append(note_change)
+
+        def refresh():
+            if changed:
+                db.commit()
+                api_payload.render_api_payload()
+
+        try:
+            result = action(*args, **kwargs)
+        except HTTP:
+            refresh()
+            raise
+
+        refresh()
+
+        return result
+
+    wrapper.__doc__ = action.__doc__
+    wrapper.__name__ = action.__name__
+
+    return wrapper
+
 # ---
 # Pure HTML pages that just need a controller to exist
 # ---
@@ -55,36 +111,39 @@ def map():
 def audio():
     
     """
-    Provides a data table of the audio data
+    Provides a table of the audio data, filtered by site, habitat and date
+    range and paged using a cursor rather than an offset - see the
+    audio_browser module.
     """
-    
-    db.audio.record_datetime.represent = lambda val, row: val.date().isoformat()
-    
-    # player buttons
-    ply1 = lambda row: A(SPAN(_class='glyphicon glyphicon-play'), 
-                         _class='btn btn-sm btn-default',
-                         _href=URL("default","simple_player", vars={'audio': row.id}))
-                        
-    ply2 = lambda row: A(SPAN(_class='glyphicon glyphicon-equalizer'), 
-                         _class='btn btn-sm btn-default',
-                         _href=URL("default","player", vars={'audio': row.id}))
-    
-    links = [dict(header = '', body = ply1),
-             dict(header = '', body = ply2)]
-    
-    form = SQLFORM.grid(db.audio,
-                        fields=[db.audio.site_id, 
-                                db.audio.habitat,
-                                db.audio.record_datetime,
-                                db.audio.start_time,
-                                db.audio.recorder_type],
-                        links=links,
-                        editable=False,
-                        create=False,
-                        deletable=False,
-                        exportclasses=EXPORT_CLASSES)
 
-    return dict(form=form)
+    site_ids, start, end = _filter_args(request.vars.site, request.vars.start, request.vars.end)
+    habitat = request.vars.getlast('habitat') or None
+
+    sites = db(db.sites).select(db.sites.id, db.sites.site_name, orderby=db.sites.site_name)
+
+    form = SQLFORM.factory(Field('site', requires=IS_EMPTY_OR(IS_IN_SET([(st.id, st.site_name) for st in sites])),
+                                 default=request.vars.site),
+                           Field('habitat', requires=IS_EMPTY_OR(IS_IN_SET(HABITATS)),
+                                 default=habitat),
+                           Field('start', 'date', default=start),
+                           Field('end', 'date', default=end),
+                           _method='GET',
+                           submit_button='Filter')
+
+    try:
+        rows, next_cursor = audio_browser.audio_page(site_ids, habitat, start, end,
+                                                     cursor=request.vars.getlast('after'))
+    except ValueError:
+        raise HTTP(400, 'Invalid cursor')
+
+    filters = {ky: request.vars[ky] for ky in ('site', 'habitat', 'start', 'end') if request.vars[ky]}
+
+    return dict(form=form,
+                rows=rows,
+                site_names={st.id: st.site_name for st in sites},
+                total=audio_browser.estimated_total(site_ids, habitat, start, end),
+                first_url=URL(vars=filters) if request.vars.after else None,
+                next_url=URL(vars=dict(filters, after=next_cursor)) if next_cursor else None)
 
 
 def availability():
@@ -116,6 +175,7 @@ def availability():
 # ---
 
 @auth.requires_login()
+@refreshes_api_payload
 def sites():
 
     """
@@ -181,6 +241,7 @@ def audio_matching():
 
 
 @auth.requires_login()
+@refreshes_api_payload
 def taxa():
 
     """
@@ -198,6 +259,7 @@ def taxa():
     return dict(form=form)
 
 @auth.requires_login()
+@refreshes_api_payload
 def taxon_observations():
 
     """
@@ -211,6 +273,7 @@ def taxon_observations():
     return dict(form=form)
 
 @auth.requires_login()
+@refreshes_api_payload
 def site_images():
 
     """
@@ -236,6 +299,7 @@ def site_images():
 
 
 @auth.requires_login()
+@refreshes_api_payload
 def audio_admin():
 
     """
@@ -250,6 +314,7 @@ def audio_admin():
     return dict(form=form)
 
 @auth.requires_login()
+@refreshes_api_payload
 def gbif_sound_occurrences():
 
     """
@@ -307,6 +372,7 @@ def gbif_image_occurrences():
 
 
 @auth.requires_login()
+@refreshes_api_payload
 def set_gbif_image_for_taxon():
 
     """
@@ -334,13 +400,14 @@ def set_gbif_image_for_taxon():
 
 
 @auth.requires_login()
+@refreshes_api_payload
 def upload_image():
 
     form = SQLFORM(db.site_images)
 
     if form.accepts(request.vars, session):
         response.flash = 'form accepted'
-        module_admin_functions.make_thumb(form.vars.id)
+        thumbnails.queue_thumbnails('site_images', [form.vars.id])
     elif form.errors:
         response.flash = 'form has errors'
 
@@ -352,6 +419,17 @@ def upload_image():
 # should probably get passed to run in the background 
 # ---
 
+# admin functions that change the api_response payload tables without
+# rendering the payload themselves - scanning and rescanning deployments
+# render it, as they also run as scheduler tasks
+RENDERS_API_PAYLOAD = ('Reindex audio streams',
+                       'Reassign time windows',
+                       'Update GBIF image occurrences',
+                       'Update GBIF sound occurrences',
+                       'Remove deleted GBIF occurrences',
+                       'Create thumbnails')
+
+
 @auth.requires_login()
 def admin_functions():
 
@@ -363,7 +441,10 @@ def admin_functions():
                                                      'Reassign time windows',
                                                      'Update GBIF image occurrences',
                                                      'Update GBIF sound occurrences',
+                                                     'Remove deleted GBIF occurrences',
                                                      'Create availability plot',
+                                                     'Create thumbnails',
+                                                     'Create database indexes',
                                                      ],
                                                      zero=None),
                                  default='Scan box for new audio'))
@@ -378,18 +459,28 @@ def admin_functions():
         elif form.vars.action == 'Rescan _all_ deployments':
             report = module_admin_functions.rescan_deployments(rescan_all=True)
         elif form.vars.action == 'Reindex audio streams':
-            report = module_admin_functions.index_day_streams()
+            report = module_admin_functions.index_day_streams(full_rebuild=True)
         elif form.vars.action == 'Reassign time windows':
-            report = module_admin_functions.assign_time_windows()
+            report = module_admin_functions.assign_time_windows(recompute=True)
         elif form.vars.action == 'Update GBIF image occurrences':
             report = module_admin_functions.populate_gbif_image_occurrences()
         elif form.vars.action == 'Update GBIF sound occurrences':
             report = module_admin_functions.populate_gbif_sound_occurrences()
+        elif form.vars.action == 'Remove deleted GBIF occurrences':
+            report = module_admin_functions.reconcile_gbif_occurrences()
         elif form.vars.action == 'Create availability plot':
             report = module_admin_functions.make_availability_png()
+        elif form.vars.action == 'Create thumbnails':
+            report = PRE('\n'.join(thumbnails.make_thumbnails(table) for table in thumbnails.TABLES))
+        elif form.vars.action == 'Create database indexes':
+            report = PRE(db_indexes.create_indexes() + '\n' + db_indexes.explain_indexes())
         else:
             pass
 
+        if form.vars.action in RENDERS_API_PAYLOAD:
+            db.commit()
+            api_payload.render_api_payload()
+
     elif form.errors:
         response.flash = 'form has errors'
 
@@ -416,15 +507,34 @@ def _shared_link():
 
 def download_url(box_id):
     """
-    Simple helper to pair the static download page with the current download access token value
+    Simple helper to get a download link for an audio file from the file storage backend
 
     :param box_id:
     :return:
     """
 
-    url = 'https://dl.boxcloud.com/api/2.0/files/{}/content?access_token={}'.format(box_id, dl_token.access_token)
+    return storage_backend.download_url(box_id)
+
+
+def stored_file():
+    """
+    Serves audio files from the local file storage backend, supporting HTTP
+    range requests so that players can seek within a file. The file id is
+    given by the request args.
+    """
+
+    if not isinstance(storage_backend, file_storage.LocalStorage):
+        raise HTTP(404)
+
+    try:
+        path = storage_backend.local_path('/'.join(request.args))
+    except ValueError:
+        raise HTTP(404)
+
+    if not os.path.isfile(path):
+        raise HTTP(404)
 
-    return url
+    return response.stream(path, request=request)
 
 def player():
 
@@ -539,6 +649,35 @@ def download():
     """
     return response.download(request, db)
 
+
+def thumbnail():
+    """
+    Serves a thumbnail of a site or taxon image, using WebP if the client
+    accepts it and it is available and JPEG otherwise.
+    http://..../[app]/default/thumbnail/[table]/[id]/[size]
+    """
+
+    table = request.args(0)
+    size_name = request.args(2) or 'card'
+
+    if table not in thumbnails.TABLES or size_name not in dict(thumbnails.THUMB_SIZES):
+        raise HTTP(404)
+
+    record = db[table](request.args(1, cast=int, default=0))
+
+    if record is None or record.thumb_hash is None:
+        raise HTTP(404)
+
+    path = thumbnails.thumbnail_path(record.thumb_hash, size_name, 'webp')
+
+    if 'image/webp' not in (request.env.http_accept or '') or not os.path.exists(path):
+        path = thumbnails.thumbnail_path(record.thumb_hash, size_name, 'jpg')
+
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    response.headers['Vary'] = 'Accept'
+
+    return response.stream(path, request=request)
+
 # ---
 # Call services - could implement as a more RESTFUL API style thing but small set 
 # of actions and only GET not any of the rest of the CRUD interface required.
@@ -560,10 +699,22 @@ def call():
     response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
     response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
 
+    # Allow clients to store responses but revalidate them using the ETag.
+    # Services can override these to allow longer caching.
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Expires'] = None
+
     # Dump the session to remove Set-Cookie
     session.forget(response)
 
-    return service()
+    content = service()
+
+    # JSON services are sent with an ETag, supporting conditional requests
+    # and compression
+    if request.args(0) == 'json':
+        json_response.send_json(content)
+
+    return content
 
 
 def audio_row_to_json(row):
@@ -620,6 +771,17 @@ def _stream_get(site, time, shuffle=False):
 
     window = int(myconf.take('audio.window_width'))
 
+    # Shuffled recordings are picked from the in memory index of recordings
+    # at each site sorted by time of day
+    if shuffle:
+        time_second = start_time.hour * 3600 + start_time.minute * 60
+        audio_id = stream_index.random_in_window(site, time_second, window / 2)
+
+        if audio_id is None:
+            return 1, {"error": "No recordings match site and time requested"}
+
+        return 0, audio_row_to_json(db.audio[audio_id])
+
     # build the query
     window = datetime.timedelta(seconds=window / 2)
     sim_min = (start_time - window).time()
@@ -632,20 +794,16 @@ def _stream_get(site, time, shuffle=False):
         sim_where = ((db.audio.start_time > sim_min) |
                      (db.audio.start_time < sim_max))
 
-    # search the db for the next later recording within the similarity window
+    # search the db for the most recent recording within the similarity window
     min_size = int(myconf.take('audio.min_size'))
-    candidates = db((db.audio.site_id == site) &
-                    (db.audio.file_size > min_size) &
-                    sim_where).select(orderby=~db.audio.record_datetime)
+    row = db((db.audio.site_id == site) &
+             (db.audio.file_size > min_size) &
+             sim_where).select(orderby=~db.audio.record_datetime,
+                               limitby=(0, 1)).first()
 
-    if len(candidates) == 0:
+    if row is None:
         return 1, {"error": "No recordings match site and time requested"}
     else:
-        if shuffle:
-            row = random.choice(candidates)
-        else:
-            row = candidates[0]
-
         return 0, audio_row_to_json(row)
 
 
@@ -746,6 +904,151 @@ def get_site(site):
         return site_data
 
 
+def _filter_args(sites, start, end):
+    """
+    Converts the site and date filter arguments from strings. A repeated
+    query variable is passed in as a list, so repeated sites are combined
+    and the last of any repeated dates is used.
+
+    :param sites: A comma separated list of site ids
+    :param start: An ISO format start date
+    :param end: An ISO format end date
+    :return: A tuple of a list of site ids, and the start and end dates
+    """
+
+    if isinstance(sites, list):
+        sites = ','.join(sites)
+    if isinstance(start, list):
+        start = start[-1]
+    if isinstance(end, list):
+        end = end[-1]
+
+    try:
+        site_ids = [int(st) for st in sites.split(',')] if sites else None
+        start = datetime.datetime.strptime(start, '%Y-%m-%d').date() if start else None
+        end = datetime.datetime.strptime(end, '%Y-%m-%d').date() if end else None
+    except ValueError:
+        raise HTTP(400, 'Invalid sites or dates')
+
+    return site_ids, start, end
+
+
+@service.json
+def get_availability(sites=None, start=None, end=None, by_window=False):
+    """
+    Provides the number of recordings at each site on each date, from the
+    audio daily counts summary, for the front end to plot. The counts for
+    each site are a list covering every date from start to end, optionally
+    split into a list of counts per time window for each date.
+
+    :param sites: An optional comma separated list of site ids
+    :param start: An optional ISO format start date
+    :param end: An optional ISO format end date
+    :param by_window: Provide counts by time window within each date, given as 1, true or yes
+    :return: A dictionary of availability data
+    """
+
+    site_ids, start, end = _filter_args(sites, start, end)
+
+    return daily_counts.availability(site_ids, start, end, by_window=str(by_window).lower() in ('1', 'true', 'yes'))
+
+
+@service.csv
+def get_availability_csv(sites=None, start=None, end=None):
+    """
+    Provides the audio daily counts summary as CSV, with a row for each
+    site, date and time window with recordings.
+
+    :param sites: An optional comma separated list of site ids
+    :param start: An optional ISO format start date
+    :param end: An optional ISO format end date
+    :return: The summary rows
+    """
+
+    site_ids, start, end = _filter_args(sites, start, end)
+
+    qry = db.audio_daily_counts.id > 0
+
+    if site_ids:
+        qry &= db.audio_daily_counts.site_id.belongs(site_ids)
+    if start is not None:
+        qry &= db.audio_daily_counts.record_date >= start
+    if end is not None:
+        qry &= db.audio_daily_counts.record_date <= end
+
+    return db(qry).select(db.audio_daily_counts.site_id,
+                          db.audio_daily_counts.record_date,
+                          db.audio_daily_counts.time_window,
+                          db.audio_daily_counts.n_audio,
+                          orderby=[db.audio_daily_counts.site_id,
+                                   db.audio_daily_counts.record_date,
+                                   db.audio_daily_counts.time_window])
+
+
+@service.json
+def get_audio(sites=None, habitat=None, start=None, end=None, after=None, page_size=50):
+    """
+    Provides a page of audio records, most recent first, with optional site,
+    habitat and date filters. The response includes a cursor that is passed
+    as after to get the next page, which is null on the last page, and an
+    estimate of the total number of matching records.
+
+    :param sites: An optional comma separated list of site ids
+    :param habitat: An optional habitat
+    :param start: An optional ISO format start date
+    :param end: An optional ISO format end date
+    :param after: The cursor returned with the previous page
+    :param page_size: The number of records in a page, up to 500
+    :return: A dictionary of the audio records, next cursor and estimated total
+    """
+
+    site_ids, start, end = _filter_args(sites, start, end)
+
+    try:
+        rows, next_cursor = audio_browser.audio_page(site_ids, habitat, start, end,
+                                                     cursor=after, page_size=page_size)
+    except ValueError:
+        raise HTTP(400, 'Invalid cursor or page size')
+
+    return dict(audio=rows.as_list(),
+                next=next_cursor,
+                estimated_total=audio_browser.estimated_total(site_ids, habitat, start, end))
+
+
+def export_audio():
+    """
+    Exports the audio catalogue, joined with the site and deployment details,
+    with optional site, habitat and date filters. The format is given by the
+    extension - export_audio.csv, export_audio.ndjson or export_audio.parquet.
+    The export is written in chunks to a temporary file, which is then
+    streamed to the client, so memory use does not grow with the number of
+    records.
+    """
+
+    fmt = request.extension if request.extension != 'html' else 'csv'
+
+    if fmt not in audio_export.FORMATS:
+        raise HTTP(400, 'Unknown export format')
+
+    site_ids, start, end = _filter_args(request.vars.sites, request.vars.start, request.vars.end)
+
+    outfile = tempfile.TemporaryFile()
+
+    try:
+        audio_export.write_export(outfile, fmt, site_ids=site_ids, habitat=request.vars.habitat,
+                                  start=start, end=end)
+    except ValueError as err:
+        outfile.close()
+        raise HTTP(400, str(err))
+
+    outfile.seek(0)
+
+    response.headers['Content-Type'] = audio_export.CONTENT_TYPES[fmt]
+    response.headers['Content-Disposition'] = 'attachment; filename="audio_export.{}"'.format(fmt)
+
+    return response.stream(outfile, request=request)
+
+
 @service.json
 def get_site_image(site, time=None):
     """
@@ -810,13 +1113,20 @@ def get_dl_access_token():
 
     """
     Provides an access token downscoped to provide download only access to files
-    within the root audio folder. This token expires.
+    within the root audio folder. This token expires, and the Expires header
+    is set from the expiry of the shared token.
 
     :return:
     """
 
+    dl_token = storage_backend.download_token()
+
+    # Backends that serve files without a token, such as local storage
+    if dl_token is None:
+        return None
+
     expiry_time = time.strftime("%a, %d %b %Y %H:%M:%S +0000",
-                                time.gmtime(cache.ram.storage['dl_token'][0] + 3600))
+                                time.gmtime(dl_token.expires_at))
 
     response.headers['Cache-Control'] = None
     response.headers['Expires'] = expiry_time
@@ -906,8 +1216,8 @@ def api_response():
     Implementation of Aaron's 'mega' API to populate the front end with a single
     large payload rather than a set of independent calls to individual components.
     The output of this is largely static, rolling updates of the audio and admin
-    updates to the content will happen infrequently, so the response is cached to
-    reduce response time.
+    updates to the content will happen infrequently, so the response is rendered
+    to a versioned file when the content changes and served as bytes.
 
     See static/api_response.ts for description
 
@@ -915,14 +1225,15 @@ def api_response():
         A JSON object containing all the data needed to populate the front end.
     """
 
-    response.headers['Cache-Control'] = 'public, max-age=86400'
-    response.headers['Expires'] = None
-    
-    # create and cache the api_response. This never expires, it is just replaced when the 
-    # box scan updates the available files.
-    content = cache.ram('api_response', lambda: module_admin_functions.api_response(), time_expire=None)
-    
-    return content
+    version, content, compressed = api_payload.get_api_payload()
+
+    # Send the pre-serialised bytes directly rather than returning a value
+    # for the service to serialise.
+    json_response.send_json(content,
+                            etag='"{}"'.format(version),
+                            compressed=compressed,
+                            **{'Cache-Control': 'public, max-age=86400',
+                               'Expires': None})
 
 
 @service.json
@@ -1,5 +1,5 @@
 import os
-import box
+import file_storage
 
 # These could be in a table, but simpler to hard code a fixed global set
 HABITATS = {'Old Growth', 'Logged Fragment', 'Riparian Reserve', 'Cleared Forest', 'Oil Palm'}
@@ -35,6 +35,7 @@ db.define_table('audio',
     Field('recorder_id', 'string'),
     Field('record_datetime', 'datetime'),
     Field('start_time', 'time'),
+    Field('start_second', 'integer', default=None),
     Field('time_window', 'integer', default=None),
     Field('length_seconds', 'float'),
     Field('file_size', 'integer'),
@@ -52,12 +53,28 @@ db.define_table('audio_streams',
     Field('stream_date', 'date'),
     Field('stream_data', 'json'))
 
+# A summary of the number of recordings at each site on each date in each
+# time window, maintained as audio is added - see modules/daily_counts.py
+db.define_table('audio_daily_counts',
+    Field('site_id', 'reference sites'),
+    Field('record_date', 'date'),
+    Field('time_window', 'integer'),
+    Field('n_audio', 'integer'))
+
 db.define_table('box_scans',
     Field('scan_datetime', 'datetime'),
     Field('known_total', 'integer'),
     Field('known_new', 'integer'),
     Field('unknown_total', 'integer'),
-    Field('unknown_new', 'integer'))
+    Field('unknown_new', 'integer'),
+    Field('files_scanned', 'integer'),
+    Field('files_per_second', 'double'))
+
+# A simple key-value store of application state, such as the settings used
+# to build the current indices - see modules/app_state.py
+db.define_table('app_state',
+    Field('name', 'string', unique=True),
+    Field('value', 'json'))
 
 # Images - provide a library of site images keyed by habitat
 db.define_table('site_images',
@@ -66,6 +83,7 @@ db.define_table('site_images',
                       uploadfolder=os.path.join(request.folder, 'uploads', 'site_images')),
                 Field('thumb', 'upload', readable=False, writable=False,
                       uploadfolder=os.path.join(request.folder, 'uploads', 'site_images_thumbs')),
+                Field('thumb_hash', 'string', readable=False, writable=False),
                 Field('habitat', 'string', requires=IS_IN_SET(HABITATS)))
 
 
@@ -85,6 +103,7 @@ db.define_table('taxa',
                       uploadfolder=os.path.join(request.folder, 'uploads', 'taxon_images_thumbs'),
                       #default=os.path.join(request.folder, 'static', 'images', 'taxon_default.jpg')
                       ),
+                Field('thumb_hash', 'string', readable=False, writable=False),
                 Field('image_is_local', 'boolean'),
                 Field('gbif_media_identifier', 'string'),
                 Field('gbif_media_creator', 'string'),
@@ -138,23 +157,40 @@ db.define_table('gbif_sound_occurrences',
 
 
 
-# create and cache an instance of the BOX connection and make
-# it accessible from current so it can be used in modules
+# create the file storage backend used to find and serve audio files and
+# make it accessible from current so it can be used in modules. The local
+# backend serves files from a directory and does not need Box at all.
 
-JSON_FILE = os.path.join(request.folder, myconf.take('box.app_config'))
-PRIVATE_KEY_FILE = os.path.join(request.folder, myconf.take('box.pem_file'))
+if myconf.take('storage.backend') == 'local':
 
-box_client = cache.ram('box_client',
-                       lambda: box.authorize_jwt_client_json(JSON_FILE, PRIVATE_KEY_FILE),
-                       time_expire=3600)
+    box_client = None
+    dl_token = None
 
-current.box_client = box_client
+    storage_backend = file_storage.LocalStorage(os.path.join(request.folder, myconf.take('storage.local_root')))
+
+else:
+
+    import box
 
-# create and cache a downscoped token to use in providing download links for audio files
-# The expiry time is a bit of guess - they seem to last an hour or so but not precisely.
-# Can we use the dl_token.expires_in to set a real expiry time?
+    # create an instance of the BOX connection and make it accessible from
+    # current so it can be used in modules. The JWT access token and the
+    # downscoped download token are held in a cache shared by all workers, so
+    # that they are only refreshed once per expiry rather than once per worker.
 
-dl_token = cache.ram('dl_token',
-                     lambda: box.downscope_to_root_download(box_client),
-                     time_expire=3600)
+    JSON_FILE = os.path.join(request.folder, myconf.take('box.app_config'))
+    PRIVATE_KEY_FILE = os.path.join(request.folder, myconf.take('box.pem_file'))
 
+    import shared_cache
+    shared = shared_cache.get_shared_cache()
+
+    box_client = box.shared_jwt_client(shared, JSON_FILE, PRIVATE_KEY_FILE)
+
+    # get a downscoped token to use in providing download links for audio files,
+    # which expires using the expires_in value provided by Box
+
+    dl_token = box.shared_download_token(shared, box_client)
+
+    storage_backend = box.BoxStorage(box_client, dl_token)
+
+current.box_client = box_client
+current.file_storage = storage_backend
@@ -1,5 +1,7 @@
 from gluon.scheduler import Scheduler
 from module_admin_functions import scan_box
+from thumbnails import make_thumbnails
+from db_indexes import create_indexes
 
 # The scheduler is loaded and defined in a model, so that it can register the
 # required tables with the database. The functions are defined in separate modules.
@@ -12,7 +14,12 @@ from module_admin_functions import scan_box
 # wait for one or two heartbeats to actually run.
 
 scheduler = Scheduler(db,
-                      tasks=dict(scan_box=scan_box))
+                      tasks=dict(scan_box=scan_box,
+                                 make_thumbnails=make_thumbnails,
+                                 create_indexes=create_indexes))
+
+# make the scheduler available to modules, so that they can queue tasks
+current.scheduler = scheduler
 
 # These tasks then need to be queued using scheduler.queue_task or manually via
 # the appadmin interface. Don't do it here as they'll be queued every time the
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+API payload module.
+
+The 'mega' api_response payload changes only when new audio is scanned or
+when the admin pages are used to edit content. Rather than building it in
+each worker process, it is rendered once to a versioned JSON file and a
+gzipped copy in the application cache folder. A small pointer file names
+the current version and is replaced atomically, so that all workers switch
+to a new version at the same time and serve the same bytes and ETag.
+Compressed variants are saved alongside for each content encoding that
+json_response supports.
+'''
+
+import os
+import hashlib
+
+from gluon import current
+from gluon.serializers import json
+
+import json_response
+
+PAYLOAD_NAME = 'api_response'
+
+# Payloads loaded by this process, keyed by version
+_loaded = {}
+
+# The version read from the pointer file and the inode and modification time
+# of the pointer file when it was read
+_pointer = {'key': None, 'version': None}
+
+
+def _payload_dir():
+
+    payload_dir = os.path.join(current.request.folder, 'cache', PAYLOAD_NAME)
+
+    if not os.path.exists(payload_dir):
+        os.makedirs(payload_dir)
+
+    return payload_dir
+
+
+def _encodings():
+    """
+    The content encodings saved for each payload version and their file suffixes
+    """
+
+    if json_response.brotli is not None:
+        return [('gzip', '.gz'), ('br', '.br')]
+
+    return [('gzip', '.gz')]
+
+
+def _atomic_write(path, content):
+    """
+    Writes content to a temporary file alongside path and renames it into
+    place, so that readers never see a partially written file.
+    """
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+
+    with open(tmp_path, 'wb') as outfile:
+        outfile.write(content)
+
+    os.rename(tmp_path, path)
+
+
+def render_api_payload(keep=2):
+    """
+    Builds the api_response payload, serialises it to JSON and saves
+    the JSON and compressed copies using a version string taken from a hash
+    of the content. The current version pointer is then updated and older
+    versions are removed, keeping the most recent few so that requests in
+    progress can still complete.
+
+    :param keep: The number of versions to keep on disk
+    :return: The version string of the payload
+    """
+
+    # Avoid a circular import, as module_admin_functions refreshes the payload
+    import module_admin_functions
+
+    content = json(module_admin_functions.api_response())
+
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+
+    version = hashlib.sha1(content).hexdigest()[:16]
+    payload_dir = _payload_dir()
+    json_file = os.path.join(payload_dir, '{}.{}.json'.format(PAYLOAD_NAME, version))
+
+    if os.path.exists(json_file):
+        # mark an existing copy of this version as the most recent
+        os.utime(json_file, None)
+    else:
+        for encoding, suffix in _encodings():
+            _atomic_write(json_file + suffix, json_response.compress(content, encoding))
+
+        _atomic_write(json_file, content)
+
+    _atomic_write(os.path.join(payload_dir, PAYLOAD_NAME + '.current'), version)
+
+    # Tidy up old versions
+    versions = [fl for fl in os.listdir(payload_dir) if fl.endswith('.json')]
+    versions.sort(key=lambda fl: os.path.getmtime(os.path.join(payload_dir, fl)), reverse=True)
+
+    for old_file in versions[keep:]:
+        for suffix in [''] + [sfx for _, sfx in _encodings()]:
+            try:
+                os.remove(os.path.join(payload_dir, old_file + suffix))
+            except OSError:
+                pass
+
+    return version
+
+
+def current_version():
+    """
+    Gets the current payload version, rendering the payload if there
+    is no current version.
+
+    :return: The version string of the payload
+    """
+
+    pointer = os.path.join(_payload_dir(), PAYLOAD_NAME + '.current')
+
+    try:
+        with open(pointer, 'rb') as infile:
+            return infile.read().strip()
+    except IOError:
+        return render_api_payload()
+
+
+def stored_version():
+    """
+    Gets the current payload version without rendering a payload if there
+    is none. The pointer file is only read again when it has been replaced,
+    which is checked using its inode and modification time, so this is
+    cheap enough to call on every request.
+
+    :return: The version string of the payload or None if no payload has
+        been rendered
+    """
+
+    pointer = os.path.join(_payload_dir(), PAYLOAD_NAME + '.current')
+
+    try:
+        stat = os.stat(pointer)
+    except OSError:
+        return None
+
+    key = (stat.st_ino, stat.st_mtime)
+
+    if _pointer['key'] != key:
+        try:
+            with open(pointer, 'rb') as infile:
+                _pointer['version'] = infile.read().strip()
+        except IOError:
+            return None
+        _pointer['key'] = key
+
+    return _pointer['version']
+
+
+def _read_payload(version):
+    """
+    Reads the JSON and compressed bytes of a payload version from disk
+
+    :param version: A payload version string
+    :return: A tuple of the JSON bytes and a dictionary of compressed
+        bytes keyed by content encoding
+    """
+
+    json_file = os.path.join(_payload_dir(), '{}.{}.json'.format(PAYLOAD_NAME, version))
+
+    with open(json_file, 'rb') as infile:
+        content = infile.read()
+
+    compressed = {}
+
+    for encoding, suffix in _encodings():
+        with open(json_file + suffix, 'rb') as infile:
+            compressed[encoding] = infile.read()
+
+    return content, compressed
+
+
+def get_api_payload():
+    """
+    Gets the bytes of the current api_response payload. The content of
+    the current version is held in memory once it has been read from disk.
+
+    :return: A tuple of the version string, the JSON bytes and a dictionary
+        of compressed bytes keyed by content encoding
+    """
+
+    version = current_version()
+
+    if version not in _loaded:
+
+        try:
+            payload = _read_payload(version)
+        except IOError:
+            # The version files are missing, so render them again
+            version = render_api_payload()
+            payload = _read_payload(version)
+
+        _loaded.clear()
+        _loaded[version] = payload
+
+    content, compressed = _loaded[version]
+
+    return version, content, compressed
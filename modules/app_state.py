@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Application state module.
+
+Provides a simple persistent key-value store in the app_state table, used
+to record settings and markers that need to survive between requests and
+scheduler runs, such as the window width used to build the time windows.
+'''
+
+from gluon import current
+
+
+def get_state(name, default=None):
+    """
+    Gets a stored application state value
+
+    :param name: The name of the state value
+    :param default: The value to return if the state has not been set
+    :return: The stored value or default
+    """
+
+    db = current.db
+    row = db(db.app_state.name == name).select(db.app_state.value, limitby=(0, 1)).first()
+
+    if row is None:
+        return default
+
+    return row.value
+
+
+def set_state(name, value):
+    """
+    Stores an application state value, replacing any existing value
+
+    :param name: The name of the state value
+    :param value: A JSON serialisable value
+    """
+
+    db = current.db
+    db.app_state.update_or_insert(db.app_state.name == name, name=name, value=value)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Audio browser module.
+
+Provides pages of the audio table for the public audio listing and its JSON
+variant. Pages use keyset pagination on (record_datetime, id): each page
+carries a cursor holding the datetime and id of its last row and the next
+page selects the rows that sort after it, so every page is a short index
+range scan rather than an OFFSET over the whole table. Totals are estimated
+from the audio_daily_counts summary rather than using COUNT over the audio
+table.
+'''
+
+import datetime
+
+from gluon import current
+
+CURSOR_FORMAT = '%Y%m%dT%H%M%S'
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(row):
+    """
+    Creates the cursor string for a row of the audio table
+
+    :param row: A row with record_datetime and id fields
+    :return: A cursor string
+    """
+
+    return '{}.{}'.format(row.record_datetime.strftime(CURSOR_FORMAT), row.id)
+
+
+def decode_cursor(cursor):
+    """
+    Converts a cursor string back to a datetime and audio id
+
+    :param cursor: A cursor string from encode_cursor
+    :return: A tuple of a datetime and an integer id
+    """
+
+    try:
+        dt, audio_id = cursor.split('.')
+        return datetime.datetime.strptime(dt, CURSOR_FORMAT), int(audio_id)
+    except ValueError:
+        raise ValueError('Invalid cursor: {}'.format(cursor))
+
+
+def audio_filters(site_ids=None, habitat=None, start=None, end=None):
+    """
+    Builds the query for the audio filters, shared by the audio listing and
+    the audio export. Each filter is served by an index leading on the filter
+    field and record_datetime.
+
+    :param site_ids: An optional list of site ids
+    :param habitat: An optional habitat
+    :param start: An optional first date
+    :param end: An optional last date
+    :return: A DAL query
+    """
+
+    db = current.db
+
+    qry = db.audio.id > 0
+
+    if site_ids:
+        qry &= db.audio.site_id.belongs(site_ids)
+    if habitat:
+        qry &= db.audio.habitat == habitat
+    if start is not None:
+        qry &= db.audio.record_datetime >= datetime.datetime.combine(start, datetime.time())
+    if end is not None:
+        qry &= db.audio.record_datetime < datetime.datetime.combine(end + datetime.timedelta(days=1),
+                                                                    datetime.time())
+
+    return qry
+
+
+def audio_page(site_ids=None, habitat=None, start=None, end=None, cursor=None, page_size=50):
+    """
+    Gets a page of audio records, most recent first.
+
+    :param site_ids: An optional list of site ids
+    :param habitat: An optional habitat
+    :param start: An optional first date
+    :param end: An optional last date
+    :param cursor: The cursor of the last row of the previous page
+    :param page_size: The number of rows in a page
+    :return: A tuple of the rows and the cursor for the next page, which is
+        None on the last page
+    """
+
+    db = current.db
+
+    page_size = max(1, min(int(page_size), MAX_PAGE_SIZE))
+    qry = audio_filters(site_ids, habitat, start, end)
+
+    if cursor:
+        last_dt, last_id = decode_cursor(cursor)
+        qry &= ((db.audio.record_datetime < last_dt) |
+                ((db.audio.record_datetime == last_dt) & (db.audio.id < last_id)))
+
+    # Fetch one more row than needed to find out if there is a next page
+    rows = db(qry).select(db.audio.id,
+                          db.audio.site_id,
+                          db.audio.habitat,
+                          db.audio.record_datetime,
+                          db.audio.start_time,
+                          db.audio.recorder_type,
+                          orderby=[~db.audio.record_datetime, ~db.audio.id],
+                          limitby=(0, page_size + 1))
+
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor(rows.last())
+    else:
+        next_cursor = None
+
+    return rows, next_cursor
+
+
+def estimated_total(site_ids=None, habitat=None, start=None, end=None):
+    """
+    Estimates the number of audio records matching the filters from the
+    audio_daily_counts summary. The summary only includes audio that has
+    been matched to a site and is updated after each scan, so this can
+    differ from the exact count.
+
+    :param site_ids: An optional list of site ids
+    :param habitat: An optional habitat
+    :param start: An optional first date
+    :param end: An optional last date
+    :return: An integer estimate
+    """
+
+    db = current.db
+
+    qry = db.audio_daily_counts.id > 0
+
+    if habitat:
+        habitat_sites = db(db.sites.habitat == habitat).select(db.sites.id)
+        site_ids = [rw.id for rw in habitat_sites if not site_ids or rw.id in site_ids]
+        if not site_ids:
+            return 0
+
+    if site_ids:
+        qry &= db.audio_daily_counts.site_id.belongs(site_ids)
+    if start is not None:
+        qry &= db.audio_daily_counts.record_date >= start
+    if end is not None:
+        qry &= db.audio_daily_counts.record_date <= end
+
+    total = db.audio_daily_counts.n_audio.sum()
+
+    return db(qry).select(total).first()[total] or 0
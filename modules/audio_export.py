@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Audio export module.
+
+Exports the audio table, joined with the site and deployment details, as
+CSV, newline delimited JSON or Parquet. Records are read in chunks of
+audio ids using iterselect, so that neither the database driver nor the
+export holds more than one chunk in memory at once, and each chunk is
+written to the output file before the next is read. Parquet files get one
+row group per chunk and need the pyarrow package, which is only imported
+when a Parquet export is written, as this module is imported by the default
+controller on every request.
+
+The export is used by the export_audio action of the default controller and
+by the private/export_audio.py command line script.
+'''
+
+import csv
+import json
+import datetime
+from collections import OrderedDict
+
+from gluon import current
+
+from audio_browser import audio_filters
+
+FORMATS = ('csv', 'ndjson', 'parquet')
+
+CONTENT_TYPES = {'csv': 'text/csv',
+                 'ndjson': 'application/x-ndjson',
+                 'parquet': 'application/octet-stream'}
+
+
+def _columns():
+    """
+    The exported columns, as a list of tuples of the column name, the field
+    and the name of the pyarrow type used for Parquet output.
+    """
+
+    db = current.db
+
+    return [('audio_id', db.audio.id, 'int64'),
+            ('filename', db.audio.filename, 'string'),
+            ('recorder_id', db.audio.recorder_id, 'string'),
+            ('recorder_type', db.audio.recorder_type, 'string'),
+            ('record_datetime', db.audio.record_datetime, 'timestamp'),
+            ('start_time', db.audio.start_time, 'time'),
+            ('time_window', db.audio.time_window, 'int64'),
+            ('length_seconds', db.audio.length_seconds, 'float64'),
+            ('file_size', db.audio.file_size, 'int64'),
+            ('box_id', db.audio.box_id, 'string'),
+            ('habitat', db.audio.habitat, 'string'),
+            ('site_id', db.audio.site_id, 'int64'),
+            ('site_name', db.sites.site_name, 'string'),
+            ('latitude', db.sites.latitude, 'float64'),
+            ('longitude', db.sites.longitude, 'float64'),
+            ('deployment_id', db.audio.deployment_id, 'int64'),
+            ('deployed_from', db.deployments.deployed_from, 'date'),
+            ('deployed_to', db.deployments.deployed_to, 'date'),
+            ('height', db.deployments.height, 'float64')]
+
+
+def iter_chunks(site_ids=None, habitat=None, start=None, end=None, chunk_size=5000):
+    """
+    Generator of chunks of exported audio records, ordered by audio id.
+    Each chunk is read with a separate query starting after the last id of
+    the previous chunk.
+
+    :param site_ids: An optional list of site ids
+    :param habitat: An optional habitat
+    :param start: An optional first date
+    :param end: An optional last date
+    :param chunk_size: The number of records in each chunk
+    :return: A generator of lists of tuples of column values
+    """
+
+    db = current.db
+
+    fields = [field for _, field, _ in _columns()]
+
+    qry = audio_filters(site_ids, habitat, start, end)
+
+    left = [db.sites.on(db.audio.site_id == db.sites.id),
+            db.deployments.on(db.audio.deployment_id == db.deployments.id)]
+
+    last_id = 0
+
+    while True:
+
+        rows = db(qry & (db.audio.id > last_id)).iterselect(*fields, left=left, orderby=db.audio.id,
+                                                             limitby=(0, chunk_size))
+
+        chunk = [tuple(row[fld] for fld in fields) for row in rows]
+
+        if not chunk:
+            return
+
+        yield chunk
+
+        if len(chunk) < chunk_size:
+            return
+
+        last_id = chunk[-1][0]
+
+
+def _json_default(value):
+
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def _csv_value(value):
+
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+
+    return value
+
+
+def write_export(outfile, fmt='csv', site_ids=None, habitat=None, start=None, end=None, chunk_size=5000):
+    """
+    Writes the audio export to a file, one chunk at a time.
+
+    :param outfile: A file object opened for writing bytes
+    :param fmt: One of csv, ndjson or parquet
+    :param site_ids: An optional list of site ids
+    :param habitat: An optional habitat
+    :param start: An optional first date
+    :param end: An optional last date
+    :param chunk_size: The number of records in each chunk
+    :return: The number of records written
+    """
+
+    if fmt not in FORMATS:
+        raise ValueError('Unknown export format: {}'.format(fmt))
+
+    if fmt == 'parquet':
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ValueError('Parquet export needs the pyarrow package')
+
+    columns = _columns()
+    names = [name for name, _, _ in columns]
+    chunks = iter_chunks(site_ids, habitat, start, end, chunk_size)
+    n_rows = 0
+
+    if fmt == 'csv':
+        writer = csv.writer(outfile)
+        writer.writerow(names)
+        for chunk in chunks:
+            writer.writerows([_csv_value(val) for val in row] for row in chunk)
+            n_rows += len(chunk)
+
+    elif fmt == 'ndjson':
+        for chunk in chunks:
+            outfile.write(''.join(json.dumps(OrderedDict(zip(names, row)), default=_json_default) + '\n'
+                                  for row in chunk))
+            n_rows += len(chunk)
+
+    else:
+        pa_types = {'int64': pyarrow.int64(),
+                    'float64': pyarrow.float64(),
+                    'string': pyarrow.string(),
+                    'timestamp': pyarrow.timestamp('s'),
+                    'time': pyarrow.time32('s'),
+                    'date': pyarrow.date32()}
+        types = [pa_types[pa_type] for _, _, pa_type in columns]
+        schema = pyarrow.schema([pyarrow.field(name, pa_type) for name, pa_type in zip(names, types)])
+        writer = pyarrow.parquet.ParquetWriter(outfile, schema)
+        try:
+            for chunk in chunks:
+                arrays = [pyarrow.array(list(values), type=pa_type)
+                          for values, pa_type in zip(zip(*chunk), types)]
+                writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+                n_rows += len(chunk)
+        finally:
+            writer.close()
+
+    return n_rows
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Audio scan module.
+
+Scans the data folders in the file storage backend for new audio files and
+adds them to the audio table, matching each file to a deployment or site
+from its path. The scan uses the StorageBackend interface from the
+file_storage module, so it runs in the same way against Box or a local
+directory.
+
+Most of the scan time is spent waiting for the storage backend, so the data
+folders, and time slices of the period being scanned within each folder,
+are listed concurrently by a bounded pool of threads. The listing threads
+do not use the database: they pass pages of files through a bounded queue
+to the thread running the scan, which is the only one writing to the
+database.
+'''
+
+import os
+import datetime
+import itertools
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
+
+# current exposes the database abstraction layer as current.db
+from gluon import current
+
+from deployment_index import DeploymentIndex
+
+
+def _pages(iterable, page_size):
+    """
+    Generator that consumes an iterable in lists of up to page_size entries,
+    used to batch the file listings so that database lookups and inserts
+    can be done once per page rather than once per file.
+
+    :param iterable: An iterable, such as a file listing generator
+    :param page_size: The maximum number of entries in each page
+    :return: A generator of lists
+    """
+
+    iterator = iter(iterable)
+
+    while True:
+        page = list(itertools.islice(iterator, page_size))
+        if not page:
+            return
+        yield page
+
+
+def _time_slices(since, until, n_slices):
+    """
+    Splits the period being scanned into time slices that can be listed
+    independently. The slices are given as (since, until) tuples and the
+    newest slice is left open, so that files added during the scan are
+    still found. A scan with a start time is split into equal slices. The
+    first scan, with no start time, is split into years back from the scan
+    time, leaving the oldest slice open.
+
+    :param since: The start of the period or None
+    :param until: The time the scan started
+    :param n_slices: The number of slices
+    :return: A list of tuples of datetimes or None
+    """
+
+    if since is None:
+        step = datetime.timedelta(days=365)
+        bounds = [None] + [until - step * idx for idx in range(n_slices - 1, 0, -1)]
+    else:
+        step = (until - since) // n_slices
+        if step < datetime.timedelta(seconds=1):
+            return [(since, None)]
+        bounds = [since] + [since + step * idx for idx in range(1, n_slices)]
+
+    return list(zip(bounds, bounds[1:] + [None]))
+
+
+def scan_storage(storage, page_size=200, n_workers=4, slices_per_folder=4):
+    
+    """
+    Searches through the folder structure indexing all MP3 files. 
+    The search is date restricted by the last scan, with the scan date
+    stored in the database.
+
+    Each folder is listed in time slices by a pool of threads. The search
+    results are handled in pages by this thread: the box ids already in the
+    database are found with a single query per page and the new files are
+    then added using a single bulk insert.
+
+    :param storage: A file_storage StorageBackend instance
+    :param page_size: The number of search results to request and process at once.
+    :param n_workers: The number of folder slices listed at once.
+    :param slices_per_folder: The number of time slices to list in each folder.
+    :return: A dictionary of scan statistics
+    """
+
+    db = current.db
+
+    # find the most recent scan date
+    qry = db(db.box_scans)
+    last_scan = qry.select(orderby=~db.box_scans.scan_datetime,
+                           limitby=(0, 1)).first()
+    
+    # If this has run before, there should be a row, but first time around all
+    # files are listed.
+    scan_from = None if last_scan is None else last_scan.scan_datetime
+
+    # Get the folder scan configuration
+    folder_scan = current.myconf.take('box.data_folders')
+
+    # Record the time the scan starts, so that any files added during the search
+    # aren't missed by the next scan
+    scan_started = datetime.datetime.now()
+
+    new_known = 0
+    new_unknown = 0
+    n_files = 0
+
+    # Deployments and sites are loaded once to match files to sites
+    deployments = DeploymentIndex()
+    sites_by_name = {rw.site_name: rw for rw in db(db.sites).select(db.sites.id,
+                                                                   db.sites.site_name,
+                                                                   db.sites.habitat)}
+
+    # Create the jobs listing each time slice of each folder, and track the
+    # slices remaining, files found and time taken for each folder
+    jobs = [(idx, slice_since, slice_until)
+            for idx in range(len(folder_scan))
+            for slice_since, slice_until in _time_slices(scan_from, scan_started, slices_per_folder)]
+
+    folder_stats = [dict(folder_id=this_folder['id'], slices=0, files_scanned=0, scan_seconds=None)
+                    for this_folder in folder_scan]
+
+    for idx, _, _ in jobs:
+        folder_stats[idx]['slices'] += 1
+
+    # The bounded queue stops the listing threads getting too far ahead of
+    # the database inserts.
+    pages = Queue.Queue(maxsize=n_workers * 2)
+    stop = threading.Event()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return
+            except Queue.Full:
+                pass
+
+    def _list_slice(job):
+        """
+        Lists a time slice of a folder, passing pages of files to the queue,
+        followed by None when the slice is complete or the exception if the
+        listing fails.
+        """
+
+        idx, slice_since, slice_until = job
+
+        try:
+            file_search = storage.list_new_files(folder_scan[idx]['id'], since=slice_since,
+                                                 until=slice_until, page_size=page_size)
+            for page in _pages(file_search, page_size):
+                if stop.is_set():
+                    return
+                _put((idx, page))
+        except Exception as exc:
+            _put((idx, exc))
+        else:
+            _put((idx, None))
+
+    pool = ThreadPool(max(1, min(n_workers, len(jobs))))
+    pool.map_async(_list_slice, jobs)
+    pool.close()
+
+    n_slices_left = len(jobs)
+
+    try:
+        # Now add the pages of files from the queue as they arrive
+        while n_slices_left:
+
+            idx, page = pages.get()
+            this_folder = folder_scan[idx]
+
+            if page is None:
+                n_slices_left -= 1
+                folder_stats[idx]['slices'] -= 1
+                if not folder_stats[idx]['slices']:
+                    folder_stats[idx]['scan_seconds'] = (datetime.datetime.now() - scan_started).total_seconds()
+                continue
+
+            if isinstance(page, Exception):
+                raise page
+
+            n_files += len(page)
+            folder_stats[idx]['files_scanned'] += len(page)
+
+            # Find which of the files in this page are already known, which
+            # also catches files listed in two slices
+            page_ids = [this_file.id for this_file in page]
+            known = db(db.audio.box_id.belongs(page_ids)).select(db.audio.box_id)
+            known = {rw.box_id for rw in known}
+
+            new_rows = []
+
+            for this_file in page:
+
+                # If the file is already known or repeated within the page
+                if this_file.id in known:
+                    continue
+
+                known.add(this_file.id)
+
+                # Extract the path
+                path = this_file.path
+
+                # Two kinds of data folders:
+                # 1) 'Deployed' data - only the rpid is reported in the path, so location
+                #    is looked up against a table of deployments.
+                # 2) Other data needs to contain the location in the path.
+
+                # Get the date of the recording from the folder structure
+                rec_date = datetime.datetime.strptime(path[this_folder['date_index']], '%Y-%m-%d').date()
+
+                if this_folder['deployed']:
+
+                    # Check the deployment of this recorder is known
+                    rec_id = path[this_folder['pi_index']]
+
+                    deployment = deployments.resolve(rec_id, rec_date)
+
+                    if deployment:
+                        did = deployment.deployment_id
+                        sid = deployment.site_id
+                        hab = deployment.habitat
+                        new_known += 1
+                    else:
+                        did = None
+                        sid = None
+                        hab = None
+                        new_unknown += 1
+                else:
+                    # Get the location of the recorder
+                    rec_id = None
+                    loc_id = path[this_folder['location_index']]
+                    site = sites_by_name.get(loc_id)
+
+                    if site:
+                        did = None
+                        sid = site.id
+                        hab = site.habitat
+                        new_known += 1
+                    else:
+                        did = None
+                        sid = None
+                        hab = None
+                        new_unknown += 1
+
+                # Now package the file to insert into the database
+                rec_start = datetime.datetime.strptime(this_file.name[:8], '%H-%M-%S').time()
+                rec_datetime = datetime.datetime.combine(rec_date, rec_start)
+
+                new_rows.append(dict(recorder_id=rec_id,
+                                     deployment_id=did,
+                                     site_id=sid,
+                                     habitat=hab,
+                                     recorder_type=this_folder['recorder_type'],
+                                     filename=this_file.name,
+                                     record_datetime=rec_datetime,
+                                     start_time=rec_start,
+                                     start_second=rec_start.hour * 3600 + rec_start.minute * 60 + rec_start.second,
+                                     length_seconds=1200,  # unless I can figure out a way to get actual time
+                                     file_size=this_file.size,
+                                     box_dir=os.path.join(*path),
+                                     box_id=this_file.id))
+
+            if new_rows:
+                db.audio.bulk_insert(new_rows)
+
+    finally:
+        stop.set()
+        pool.join()
+
+    # Get the scan rate
+    scan_seconds = (datetime.datetime.now() - scan_started).total_seconds()
+    files_per_second = n_files / scan_seconds if scan_seconds > 0 else None
+
+    # Insert the new scan date
+    db.box_scans.insert(scan_datetime=scan_started,
+                        known_total=db(db.audio.site_id).count(),
+                        unknown_total=db(db.audio.site_id == None).count(),
+                        known_new=new_known,
+                        unknown_new=new_unknown,
+                        files_scanned=n_files,
+                        files_per_second=files_per_second)
+
+    db.commit()
+
+    return dict(files_scanned=n_files,
+                folder_report='\n'.join('Folder {folder_id}: {files_scanned} files in {scan_seconds:.1f} seconds'.format(**stats)
+                                        for stats in folder_stats),
+                folder_stats=folder_stats,
+                deployment_report=deployments.report(),
+                known_new=new_known,
+                unknown_new=new_unknown,
+                scan_seconds=scan_seconds,
+                files_per_second=files_per_second)
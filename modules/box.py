@@ -3,20 +3,33 @@
 '''
 Box interface module. 
 
-Used to generate the cached client in the rr model and to provide
-functions to scan the Box root folder for files and update the database
+Used to generate the cached client in the rr model and to provide the Box
+implementation of the file storage backend used to find and serve audio.
 '''
 
 import json
 import os
 import datetime
+import time
 
 from boxsdk import JWTAuth, Client
 from boxsdk.exception import BoxAPIException
+from dateutil import parser as date_parser, tz
 
 # current exposes the database abstraction layer as current.db
 from gluon import current
 
+from file_storage import StorageBackend, StoredFile, DownloadToken
+
+
+# Box does not report the lifetime of JWT access tokens, which is
+# documented as 60 minutes, so shared tokens are refreshed a little earlier
+JWT_TOKEN_LIFETIME = 3600
+TOKEN_EXPIRY_MARGIN = 60
+
+# The client for this process and the access token it was created with
+_shared_client = {}
+
 
 def store_token(access_token, _):
     """
@@ -25,9 +38,18 @@ def store_token(access_token, _):
     os.environ.setdefault('access_token', access_token)
 
 
-def authorize_jwt_client_json(config, private_key_file):
+def authorize_jwt_client_json(config, private_key_file, access_token=None, store_tokens=store_token):
     """
-    Function to obtain an authorised Box API Client using JWT
+    Function to obtain an authorised Box API Client using JWT. If an access
+    token is provided, the client uses it rather than authenticating and
+    only authenticates again when the token is rejected.
+
+    :param config: The path to the Box app config JSON file
+    :param private_key_file: The path to the private key file
+    :param access_token: An optional existing access token
+    :param store_tokens: A callback taking the access and refresh tokens
+        whenever the client obtains a new access token
+    :return: A Box SDK Client instance
     """
     if os.path.exists(config):
         with open(config, 'r') as json_file:
@@ -40,13 +62,14 @@ def authorize_jwt_client_json(config, private_key_file):
         client_secret=config['boxAppSettings']['clientSecret'],
         enterprise_id=config['enterpriseID'],
         jwt_key_id=config['boxAppSettings']['appAuth']['publicKeyID'],
-        access_token=None,
+        access_token=access_token,
         rsa_private_key_file_sys_path=private_key_file,
         rsa_private_key_passphrase=str(config['boxAppSettings']['appAuth']['passphrase']).encode('utf_8'),
-        store_tokens=lambda acc, _: store_token(acc, _)
+        store_tokens=store_tokens
     )
 
-    jwt_auth.authenticate_instance()
+    if access_token is None:
+        jwt_auth.authenticate_instance()
 
     return Client(jwt_auth)
 
@@ -65,134 +88,130 @@ def downscope_to_root_download(client):
     return dl_token
 
 
-def scan_box(client):
-    
+def shared_jwt_client(cache, config, private_key_file):
+    """
+    Gets a Box API Client using a JWT access token held in a shared cache, so
+    that worker processes authenticate once per token lifetime between them
+    rather than once each. A new client is created in this process when the
+    shared token changes and, if the client has to refresh a rejected token
+    itself, the new token is written back to the shared cache.
+
+    :param cache: A shared_cache cache instance
+    :param config: The path to the Box app config JSON file
+    :param private_key_file: The path to the private key file
+    :return: A Box SDK Client instance
     """
-    Searches through the folder structure indexing all MP3 files. 
-    The search is date restricted by the last scan, with the scan date
-    stored in the database.
+
+    def _store_shared(access_token, _):
+        cache.set('box_access_token', access_token,
+                  time.time() + JWT_TOKEN_LIFETIME - TOKEN_EXPIRY_MARGIN)
+
+    def _authenticate():
+        client = authorize_jwt_client_json(config, private_key_file)
+        # keep this client rather than creating another from its token
+        _shared_client.clear()
+        _shared_client[client.auth.access_token] = client
+        return client.auth.access_token, time.time() + JWT_TOKEN_LIFETIME - TOKEN_EXPIRY_MARGIN
+
+    access_token = cache.get_or_create('box_access_token', _authenticate)
+
+    if access_token not in _shared_client:
+        _shared_client.clear()
+        _shared_client[access_token] = authorize_jwt_client_json(config, private_key_file,
+                                                                 access_token=access_token,
+                                                                 store_tokens=_store_shared)
+
+    return _shared_client[access_token]
+
+
+def shared_download_token(cache, client):
+    """
+    Gets a downscoped download token held in a shared cache, so that worker
+    processes downscope once per token lifetime between them. The cache
+    expiry is taken from the expires_in of the token response, less a short
+    margin so that users are not given a token that is about to expire.
+
+    :param cache: A shared_cache cache instance
+    :param client: A JWT Client instance
+    :return: A DownloadToken tuple of the access token and the expiry time
+        as seconds since the epoch
+    """
+
+    def _downscope():
+        dl_token = downscope_to_root_download(client)
+        expires_at = time.time() + dl_token.expires_in - TOKEN_EXPIRY_MARGIN
+        return [dl_token.access_token, expires_at], expires_at
+
+    return DownloadToken(*cache.get_or_create('dl_token', _downscope))
+
+
+class BoxStorage(StorageBackend):
+
+    """
+    The Box file storage backend. New files are found using the Box search
+    endpoint and users download files from dl.boxcloud.com using the
+    downscoped download token. Box reports file creation times with a time
+    zone and these are converted to naive UTC datetimes.
 
     :param client: An authorised Box API client instance
+    :param dl_token: A DownloadToken tuple, as from shared_download_token
     """
-    
-    # find the most recent scan date
-    qry = current.db(current.db.box_scans)
-    last_scan = qry.select(orderby=~current.db.box_scans.scan_datetime,
-                           limitby=(0, 1)).first()
-    
-    # If this has run before, there should be a row, but first time around we choose
-    # an arbitrary old date. Either way, convert that to a string to pass to Box,
-    # which requires the timezone specification. Note that web2py strips microseconds
-    # from the datetime when storing, which is good because Box doesn't accept them.
-    if last_scan is None:
-        scan_from = datetime.datetime(1970, 1, 1)
-        scan_from_str = scan_from.isoformat() + 'Z'
-    else:
-        scan_from_str = last_scan.scan_datetime.isoformat() + 'Z'
 
-    # Get the folder scan configuration
-    folder_scan = current.myconf.take('box.data_folders')
+    FIELDS = ['name', 'id', 'path_collection', 'size', 'created_at']
 
-    # Record the time the scan starts, so that any files added during the search
-    # aren't missed by the next scan
-    scan_started = datetime.datetime.now()
+    def __init__(self, client, dl_token=None):
 
-    new_known = 0
-    new_unknown = 0
+        self.client = client
+        self.dl_token = dl_token
 
-    # Loop over those folders
-    for this_folder in folder_scan:
+    @staticmethod
+    def _stored_file(box_file):
 
-        # Call the search endpoint limiting to files within the current folder.
         # Note that the path collection is always relative to the root folder
         # (client.folder('0')) regardless of any ancestors provided.
-        file_search = client.search().query(query='*.mp3',
-                                            ancestor_folders=[client.folder(this_folder['id']).get()],
-                                            file_extensions=['mp3'],
-                                            created_at_range=(scan_from_str, None),
-                                            type='file',
-                                            fields=['name', 'id', 'path_collection', 'size'],
-                                            limit=200)
-
-        # Now iterate over the file search generator
-        for this_file in file_search:
-
-            # If the file isn't already known
-            if current.db.audio(box_id=this_file.id):
-                continue
-
-            # Extract the path
-            path = [entry.name for entry in this_file.path_collection['entries']]
-
-            # Two kinds of data folders:
-            # 1) 'Deployed' data - only the rpid is reported in the path, so location
-            #    is looked up against a table of deployments.
-            # 2) Other data needs to contain the location in the path.
-
-            # Get the date of the recording from the folder structure
-            rec_date = datetime.datetime.strptime(path[this_folder['date_index']], '%Y-%m-%d').date()
-
-            if this_folder['deployed']:
-
-                # Check the deployment of this recorder is known
-                rec_id = path[this_folder['pi_index']]
-
-                deployment_record = current.db((current.db.deployments.recorder_id == rec_id) &
-                                               (current.db.deployments.deployed_from <= rec_date) &
-                                               (current.db.deployments.deployed_to >= rec_date) &
-                                               (current.db.deployments.site_id == current.db.sites.id)
-                                               ).select(limitby=(0, 1)).first()
-
-                if deployment_record:
-                    # TODO - this assumes deployments don't overlap and chooses the first if they do.
-                    did = deployment_record.deployments.id
-                    sid = deployment_record.deployments.site_id
-                    hab = deployment_record.sites.habitat
-                    new_known += 1
-                else:
-                    did = None
-                    sid = None
-                    hab = None
-                    new_unknown += 1
-            else:
-                # Get the location of the recorder
-                loc_id = path[this_folder['location_index']]
-                site = current.db(current.db.sites.site_name == loc_id).select(limitby=(0, 1)).first()
-
-                if site:
-                    did = None
-                    sid = site.id
-                    hab = site.habitat
-                    new_known += 1
-                else:
-                    did = None
-                    sid = None
-                    hab = None
-                    new_unknown += 1
-
-            # Now insert the file into the database
-            rec_start = datetime.datetime.strptime(this_file.name[:8], '%H-%M-%S').time()
-            rec_datetime = datetime.datetime.combine(rec_date, rec_start)
-
-            current.db.audio.insert(deployment_id=did,
-                                    site_id=sid,
-                                    habitat=hab,
-                                    recorder_type=this_folder['recorder_type'],
-                                    filename=this_file.name,
-                                    record_datetime=rec_datetime,
-                                    start_time=rec_start,
-                                    length_seconds=1200,  # unless I can figure out a way to get actual time
-                                    file_size=this_file.size,
-                                    box_dir=os.path.join(*path),
-                                    box_id=this_file.id)
-
-    # Insert the new scan date
-    current.db.box_scans.insert(scan_datetime=scan_started,
-                                known_total=current.db(current.db.audio.site_id).count(),
-                                unknown_total=current.db(current.db.audio.site_id == None).count(),
-                                known_new=new_known,
-                                unknown_new=new_unknown)
-
-    current.db.commit()
-
-    return dict()
+        created_at = date_parser.parse(box_file.created_at).astimezone(tz.tzutc()).replace(tzinfo=None)
+
+        return StoredFile(id=box_file.id,
+                          name=box_file.name,
+                          path=[entry.name for entry in box_file.path_collection['entries']],
+                          size=box_file.size,
+                          created_at=created_at)
+
+    def list_new_files(self, folder_id, since=None, until=None, extensions=('mp3',), page_size=200):
+
+        # Box requires the timezone specification but does not accept
+        # microseconds, which web2py strips from stored datetimes.
+        since = since or datetime.datetime(1970, 1, 1)
+        created_at_range = (since.replace(microsecond=0).isoformat() + 'Z',
+                            until.replace(microsecond=0).isoformat() + 'Z' if until else None)
+
+        extensions = list(extensions)
+
+        file_search = self.client.search().query(query=' OR '.join('*.' + ext for ext in extensions),
+                                                 ancestor_folders=[self.client.folder(folder_id).get()],
+                                                 file_extensions=extensions,
+                                                 created_at_range=created_at_range,
+                                                 type='file',
+                                                 fields=self.FIELDS,
+                                                 limit=page_size)
+
+        for box_file in file_search:
+            yield self._stored_file(box_file)
+
+    def metadata(self, file_id):
+
+        return self._stored_file(self.client.file(file_id).get(fields=self.FIELDS))
+
+    def download_url(self, file_id):
+
+        return 'https://dl.boxcloud.com/api/2.0/files/{}/content?access_token={}'.format(file_id,
+                                                                                       self.dl_token.access_token)
+
+    def read_range(self, file_id, start, end):
+
+        # The Box byte range includes the last byte
+        return self.client.file(file_id).content(byte_range=(start, end - 1))
+
+    def download_token(self):
+
+        return self.dl_token
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Daily counts module.
+
+Maintains the audio_daily_counts summary table, which holds the number of
+recordings for each site, date and time window. The table is updated
+incrementally from the audio added since the last update, using grouped
+count queries, so the cost of an update depends on the new audio rather than
+the size of the archive. The summary is used to render the availability
+heatmap and to provide the availability data to the front end.
+
+The last audio id counted and the window width are stored in the app_state
+table. A change in the window width rebuilds the table and sites whose
+audio has been reassigned by a deployment rescan are recounted in full.
+'''
+
+import os
+import datetime
+
+from gluon import current
+
+from app_state import get_state, set_state
+
+
+def _add_counts(qry):
+    """
+    Counts the audio matching a query by site, date and time window and adds
+    the counts to the summary table, updating existing rows and inserting
+    new ones.
+
+    :param qry: A query on the audio table
+    :return: The number of summary rows changed
+    """
+
+    db = current.db
+
+    qry &= (db.audio.site_id != None) & (db.audio.time_window != None)
+
+    year = db.audio.record_datetime.year()
+    month = db.audio.record_datetime.month()
+    day = db.audio.record_datetime.day()
+    n_audio = db.audio.id.count()
+
+    groups = db(qry).select(db.audio.site_id, year, month, day, db.audio.time_window, n_audio,
+                            groupby=[db.audio.site_id, year, month, day, db.audio.time_window])
+
+    counts = {(rw.audio.site_id, datetime.date(rw[year], rw[month], rw[day]), rw.audio.time_window): rw[n_audio]
+              for rw in groups}
+
+    if not counts:
+        return 0
+
+    # Load the existing summary rows that might need updating
+    site_ids = {key[0] for key in counts}
+    dates = [key[1] for key in counts]
+
+    existing = db(db.audio_daily_counts.site_id.belongs(site_ids) &
+                  (db.audio_daily_counts.record_date >= min(dates)) &
+                  (db.audio_daily_counts.record_date <= max(dates))).select()
+
+    existing = {(rw.site_id, rw.record_date, rw.time_window): rw for rw in existing}
+
+    new_rows = []
+
+    for key, n_audio in counts.iteritems():
+        if key in existing:
+            row = existing[key]
+            db(db.audio_daily_counts.id == row.id).update(n_audio=row.n_audio + n_audio)
+        else:
+            new_rows.append(dict(site_id=key[0], record_date=key[1], time_window=key[2], n_audio=n_audio))
+
+    db.audio_daily_counts.bulk_insert(new_rows)
+
+    return len(counts)
+
+
+def update_daily_counts(full_rebuild=False, site_ids=None):
+    """
+    Updates the daily counts summary with the audio added since the last
+    update. This should run after time windows have been assigned.
+
+    :param full_rebuild: Delete and recount the whole summary table
+    :param site_ids: An iterable of site ids to recount in full, for example
+        following changes to deployments.
+    :return: A string reporting the number of summary rows changed
+    """
+
+    db = current.db
+
+    window_width = int(current.myconf.take('audio.window_width'))
+    last_audio_id = get_state('audio_daily_counts.last_audio_id', 0)
+
+    max_id = db.audio.id.max()
+    max_id = db(db.audio).select(max_id).first()[max_id] or 0
+
+    # A change in the window width changes every count
+    if get_state('audio_daily_counts.window_width') != window_width:
+        full_rebuild = True
+
+    qry = db.audio.id <= max_id
+
+    if full_rebuild:
+        db(db.audio_daily_counts).delete()
+        n_changed = _add_counts(qry)
+    else:
+        n_changed = 0
+        new_qry = qry & (db.audio.id > last_audio_id)
+
+        if site_ids:
+            site_ids = list(site_ids)
+            db(db.audio_daily_counts.site_id.belongs(site_ids)).delete()
+            n_changed += _add_counts(qry & db.audio.site_id.belongs(site_ids))
+            new_qry &= ~db.audio.site_id.belongs(site_ids)
+
+        n_changed += _add_counts(new_qry)
+
+    set_state('audio_daily_counts.last_audio_id', max_id)
+    set_state('audio_daily_counts.window_width', window_width)
+
+    return "Daily counts updated: {} site, date and time window counts".format(n_changed)
+
+
+def availability(site_ids=None, start=None, end=None, by_window=False):
+    """
+    Gets the audio availability from the daily counts summary in a compact
+    form, with a list of counts for each site covering every date from start
+    to end.
+
+    :param site_ids: An optional list of site ids, defaulting to all sites
+    :param start: An optional first date, defaulting to the earliest audio
+    :param end: An optional last date, defaulting to the latest audio
+    :param by_window: Give a list of the counts in each time window for each
+        date rather than the total count for the date
+    :return: A dictionary with the start and end dates, the window width,
+        a list of sites and a dictionary of count lists keyed by site id
+    """
+
+    db = current.db
+
+    qry = db.audio_daily_counts.id > 0
+
+    if site_ids:
+        qry &= db.audio_daily_counts.site_id.belongs(site_ids)
+    if start is not None:
+        qry &= db.audio_daily_counts.record_date >= start
+    if end is not None:
+        qry &= db.audio_daily_counts.record_date <= end
+
+    rows = db(qry).select(db.audio_daily_counts.site_id,
+                          db.audio_daily_counts.record_date,
+                          db.audio_daily_counts.time_window,
+                          db.audio_daily_counts.n_audio)
+
+    window_width = int(current.myconf.take('audio.window_width'))
+    n_slots = -(-86400 // window_width)
+
+    if rows:
+        start = start or min(rw.record_date for rw in rows)
+        end = end or max(rw.record_date for rw in rows)
+
+    sites = db(db.sites.id.belongs(site_ids) if site_ids else db.sites
+               ).select(db.sites.id, db.sites.site_name, orderby=db.sites.id)
+
+    n_days = (end - start).days + 1 if start and end else 0
+
+    if by_window:
+        counts = {st.id: [[0] * n_slots for _ in range(n_days)] for st in sites}
+    else:
+        counts = {st.id: [0] * n_days for st in sites}
+
+    for rw in rows:
+        if rw.site_id not in counts:
+            continue
+        day = (rw.record_date - start).days
+        if by_window:
+            counts[rw.site_id][day][rw.time_window] += rw.n_audio
+        else:
+            counts[rw.site_id][day] += rw.n_audio
+
+    return dict(start=start.isoformat() if start else None,
+                end=end.isoformat() if end else None,
+                window_width=window_width,
+                sites=[{'id': st.id, 'site_name': st.site_name} for st in sites],
+                counts=counts)
+
+
+def render_availability_png():
+    """
+    Saves a heatmap of the number of recordings at each site on each date,
+    rendered as a raster from the daily counts summary.
+
+    :return: The path to the PNG file
+    """
+
+    import numpy as np
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+
+    avail = availability()
+
+    png_file = os.path.join(current.request.folder, 'static', 'images', 'availability.png')
+    site_labels = [st['site_name'] for st in avail['sites']]
+
+    fig, ax = plt.subplots(figsize=(9.2, 5))
+
+    if avail['start'] is not None:
+
+        start = datetime.datetime.strptime(avail['start'], '%Y-%m-%d').date()
+        end = datetime.datetime.strptime(avail['end'], '%Y-%m-%d').date()
+
+        # Mask the days without recordings, so that they are left blank
+        matrix = np.array([avail['counts'][st['id']] for st in avail['sites']])
+        matrix = np.ma.masked_equal(matrix, 0)
+
+        image = ax.imshow(matrix, aspect='auto', interpolation='nearest', cmap='viridis',
+                          extent=[mdates.date2num(start), mdates.date2num(end + datetime.timedelta(days=1)),
+                                  len(site_labels) - 0.5, -0.5])
+        ax.xaxis_date()
+        fig.colorbar(image, ax=ax, label='Recordings per day')
+
+    ax.set_yticks(range(len(site_labels)))
+    ax.set_yticklabels(site_labels)
+    fig.tight_layout()
+    fig.savefig(png_file)
+    plt.close(fig)
+
+    return png_file
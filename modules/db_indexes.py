@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Database index module.
+
+The DAL only creates the primary key index for each table, so this module
+defines the additional indexes needed by the hot query shapes on the audio
+and related tables. The indexes are created with CREATE INDEX IF NOT EXISTS,
+which is supported by SQLite and PostgreSQL, so creation is safe to repeat.
+Creating the indexes commits the database transaction, so it is run from
+the admin functions page or as the create_indexes scheduler task and not
+from a model, where it would commit partway through a request. An EXPLAIN
+based check reports which index the database actually uses for each query
+shape.
+'''
+
+import datetime
+
+from gluon import current
+
+# Index name, table and fields
+INDEXES = [('audio_box_id_idx', 'audio', ('box_id',)),
+           ('audio_site_start_size_idx', 'audio', ('site_id', 'start_time', 'file_size')),
+           ('audio_site_datetime_idx', 'audio', ('site_id', 'record_datetime')),
+           ('audio_recorder_datetime_idx', 'audio', ('recorder_id', 'record_datetime')),
+           ('audio_datetime_id_idx', 'audio', ('record_datetime', 'id')),
+           ('audio_habitat_datetime_idx', 'audio', ('habitat', 'record_datetime')),
+           ('audio_streams_site_date_idx', 'audio_streams', ('site', 'stream_date')),
+           ('audio_daily_counts_site_date_idx', 'audio_daily_counts', ('site_id', 'record_date', 'time_window')),
+           ('gbif_sound_occurrences_taxon_idx', 'gbif_sound_occurrences', ('taxon_id',))]
+
+
+def create_indexes():
+    """
+    Creates any missing indexes and commits them.
+
+    :return: A string reporting the indexes
+    """
+
+    db = current.db
+
+    if db._adapter.dbengine not in ('sqlite', 'postgres'):
+        return "Index creation is not supported for {}\n".format(db._adapter.dbengine)
+
+    report = ""
+
+    for name, table, fields in INDEXES:
+        # accessing a lazy table makes sure it has been created
+        db[table]
+        db.executesql('CREATE INDEX IF NOT EXISTS {} ON {} ({});'.format(name, table, ', '.join(fields)))
+        report += "{} on {} ({})\n".format(name, table, ', '.join(fields))
+
+    db.commit()
+
+    return report
+
+
+def _hot_queries():
+    """
+    Builds the SQL for the hot query shapes, using placeholder values.
+
+    :return: A list of tuples of a description, the SQL and the indexes that
+        can serve the query
+    """
+
+    db = current.db
+    start = datetime.time(6, 0)
+    end = datetime.time(6, 20)
+
+    return [('Scan box_id lookup',
+             db(db.audio.box_id.belongs(['0']))._select(db.audio.box_id),
+             ('audio_box_id_idx',)),
+            ('Stream get by site and time of day',
+             db((db.audio.site_id == 1) & (db.audio.file_size > 0) &
+                (db.audio.start_time > start) & (db.audio.start_time < end)
+                )._select(db.audio.id, orderby=~db.audio.record_datetime),
+             ('audio_site_start_size_idx', 'audio_site_datetime_idx')),
+            ('Site time window counts',
+             db((db.audio.site_id == 1) & (db.audio.file_size > 0)
+                )._select(db.audio.time_window, db.audio.id.count(), groupby=db.audio.time_window),
+             ('audio_site_start_size_idx', 'audio_site_datetime_idx')),
+            ('Site recordings by time',
+             db(db.audio.site_id == 1)._select(db.audio.id, orderby=db.audio.record_datetime),
+             ('audio_site_datetime_idx',)),
+            ('Audio browser page',
+             db(db.audio.record_datetime < datetime.datetime(2019, 1, 1)
+                )._select(db.audio.id, orderby=[~db.audio.record_datetime, ~db.audio.id], limitby=(0, 51)),
+             ('audio_datetime_id_idx',)),
+            ('Audio browser page by habitat',
+             db((db.audio.habitat == 'Old Growth') & (db.audio.record_datetime < datetime.datetime(2019, 1, 1))
+                )._select(db.audio.id, orderby=[~db.audio.record_datetime, ~db.audio.id], limitby=(0, 51)),
+             ('audio_habitat_datetime_idx',)),
+            ('Unmatched audio',
+             db(db.audio.site_id == None)._select(db.audio.recorder_id, orderby=~db.audio.record_datetime),
+             ('audio_site_datetime_idx',))]
+
+
+def explain_indexes():
+    """
+    Runs EXPLAIN on each hot query shape and checks whether the plan uses
+    an index. Note that the query planner may prefer a table scan on small
+    tables.
+
+    :return: A string reporting the index used by each query
+    """
+
+    db = current.db
+
+    if db._adapter.dbengine == 'sqlite':
+        explain = 'EXPLAIN QUERY PLAN '
+    elif db._adapter.dbengine == 'postgres':
+        explain = 'EXPLAIN '
+    else:
+        return "EXPLAIN check is not supported for {}\n".format(db._adapter.dbengine)
+
+    index_names = [name for name, _, _ in INDEXES]
+    report = ""
+
+    for description, sql, expected in _hot_queries():
+
+        plan = ' '.join(str(val) for row in db.executesql(explain + sql.rstrip(';')) for val in row)
+        used = [name for name in index_names if name in plan]
+
+        if set(used) & set(expected):
+            status = 'uses {}'.format(', '.join(used))
+        elif used:
+            status = 'uses {} rather than {}'.format(', '.join(used), ' or '.join(expected))
+        else:
+            status = 'DOES NOT USE AN INDEX'
+
+        report += "{}: {}\n".format(description, status)
+
+    return report
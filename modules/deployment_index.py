@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Deployment index module.
+
+Provides an in memory index of recorder deployments, used to match audio
+from deployed recorders to a deployment and site. The deployments table is
+loaded once and each recorder gets a list of deployments sorted by start
+date, so that a recording can be matched using a binary search rather than
+a database query per file.
+'''
+
+import bisect
+import datetime
+from collections import namedtuple
+
+from gluon import current
+
+
+Deployment = namedtuple('Deployment', ['deployment_id', 'site_id', 'habitat', 'recorder_type'])
+
+
+class DeploymentIndex(object):
+
+    """
+    An index of deployments by recorder id. Deployments for each recorder are
+    sorted by deployed_from and the running maximum of deployed_to is stored
+    alongside, so that a lookup bisects to the last deployment starting on or
+    before the date and only steps back further when deployments overlap.
+
+    Overlapping deployments for a recorder are identified when the index is
+    built and stored in the overlaps attribute. Any lookup that matches more
+    than one deployment returns the most recently started one and is logged
+    in the ambiguous attribute.
+
+    :param recorder_type: The recorder type to report for matched deployments
+    """
+
+    def __init__(self, recorder_type='rpi-eco-monitor'):
+
+        db = current.db
+
+        self.recorder_type = recorder_type
+        self.overlaps = []
+        self.ambiguous = {}
+        self._index = {}
+
+        rows = db(db.deployments.site_id == db.sites.id).select(db.deployments.id,
+                                                                 db.deployments.recorder_id,
+                                                                 db.deployments.site_id,
+                                                                 db.deployments.deployed_from,
+                                                                 db.deployments.deployed_to,
+                                                                 db.sites.habitat)
+
+        by_recorder = {}
+
+        for rw in rows:
+            # Treat missing dates as open ended deployments
+            start = rw.deployments.deployed_from or datetime.date.min
+            end = rw.deployments.deployed_to or datetime.date.max
+            by_recorder.setdefault(rw.deployments.recorder_id, []).append(
+                (start, end, Deployment(rw.deployments.id, rw.deployments.site_id,
+                                        rw.sites.habitat, recorder_type)))
+
+        for recorder_id, intervals in by_recorder.iteritems():
+
+            intervals.sort(key=lambda x: (x[0], x[2].deployment_id))
+
+            starts = []
+            max_ends = []
+            max_end = datetime.date.min
+            latest = None
+
+            for start, end, dep in intervals:
+
+                # This deployment overlaps an earlier one if it starts before the
+                # latest end date seen so far.
+                if latest is not None and start <= max_end:
+                    self.overlaps.append((recorder_id, latest.deployment_id, dep.deployment_id))
+
+                if end >= max_end:
+                    max_end = end
+                    latest = dep
+
+                starts.append(start)
+                max_ends.append(max_end)
+
+            self._index[recorder_id] = (starts, max_ends, intervals)
+
+    def __len__(self):
+
+        return sum(len(val[0]) for val in self._index.values())
+
+    def __iter__(self):
+
+        """
+        Iterates over the indexed deployments, sorted by start date within
+        each recorder, as tuples of (recorder_id, deployed_from, deployed_to,
+        Deployment). Open ended deployments use datetime.date.min and max.
+        """
+
+        for recorder_id, (_, _, intervals) in self._index.iteritems():
+            for start, end, dep in intervals:
+                yield recorder_id, start, end, dep
+
+    def effective_ranges(self):
+
+        """
+        Iterates over the date ranges in which each deployment is the one
+        returned by resolve(), so that where deployments overlap, each date
+        of a recorder is in the range of the most recently started
+        deployment only. The ranges are tuples of (recorder_id, first date,
+        last date, Deployment), using datetime.date.min and max for open
+        ended ranges.
+        """
+
+        for recorder_id, (_, _, intervals) in self._index.iteritems():
+
+            # The winning deployment can only change at a start date or the
+            # day after an end date
+            bounds = set()
+            for start, end, dep in intervals:
+                bounds.add(start)
+                if end != datetime.date.max:
+                    bounds.add(end + datetime.timedelta(days=1))
+
+            bounds = sorted(bounds)
+            ranges = []
+
+            for idx, first in enumerate(bounds):
+
+                last = bounds[idx + 1] - datetime.timedelta(days=1) if idx + 1 < len(bounds) else datetime.date.max
+
+                # The intervals are sorted as in resolve(), so the last one
+                # covering the range wins
+                winner = None
+                for start, end, dep in intervals:
+                    if start <= first and end >= first:
+                        winner = dep
+
+                if winner is None:
+                    continue
+
+                if ranges and ranges[-1][3] == winner and ranges[-1][2] + datetime.timedelta(days=1) == first:
+                    ranges[-1][2] = last
+                else:
+                    ranges.append([recorder_id, first, last, winner])
+
+            for rng in ranges:
+                yield tuple(rng)
+
+    def resolve(self, recorder_id, date):
+
+        """
+        Finds the deployment of a recorder on a given date.
+
+        :param recorder_id: The recorder id string
+        :param date: A datetime.date or datetime.datetime
+        :return: A Deployment tuple or None if no deployment matches
+        """
+
+        if recorder_id not in self._index:
+            return None
+
+        if isinstance(date, datetime.datetime):
+            date = date.date()
+
+        starts, max_ends, intervals = self._index[recorder_id]
+
+        # Step back from the last deployment starting on or before the date
+        # until no earlier deployment can still be running.
+        idx = bisect.bisect_right(starts, date) - 1
+        matches = []
+
+        while idx >= 0 and max_ends[idx] >= date:
+            start, end, dep = intervals[idx]
+            if end >= date:
+                matches.append(dep)
+            idx -= 1
+
+        if not matches:
+            return None
+
+        if len(matches) > 1:
+            self.ambiguous[(recorder_id, date)] = [dep.deployment_id for dep in matches]
+
+        return matches[0]
+
+    def report(self):
+
+        """
+        Describes any overlapping deployments found in the index.
+
+        :return: A string, which is empty if there are no overlaps
+        """
+
+        report = ""
+
+        for recorder_id, first, second in self.overlaps:
+            report += "Recorder {}: deployments {} and {} overlap\n".format(recorder_id, first, second)
+
+        if self.ambiguous:
+            report += "{} recorder days matched overlapping deployments\n".format(len(self.ambiguous))
+
+        return report
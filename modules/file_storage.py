@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+File storage module.
+
+Defines the StorageBackend interface used by the application to find new
+audio files, get file details, provide download links and read parts of
+files, so that the rest of the application does not depend on a particular
+file store. The Box implementation is the BoxStorage class in the box
+module and the LocalStorage class here uses a local directory, such as a
+mounted NFS share or a synthetic archive used for offline testing.
+
+The backend used is set by the storage.backend configuration option in the
+rr model, which makes the backend instance available as current.file_storage.
+'''
+
+import os
+import datetime
+from collections import namedtuple
+
+from gluon import URL
+
+
+# A file in the store. The path is a list of the names of the folders
+# containing the file, starting from the root of the store, and the id is
+# the backend identifier stored in the box_id field of the audio table.
+StoredFile = namedtuple('StoredFile', ['id', 'name', 'path', 'size', 'created_at'])
+
+# An access token given to users to download files and its expiry time, as
+# seconds since the epoch.
+DownloadToken = namedtuple('DownloadToken', ['access_token', 'expires_at'])
+
+
+class StorageBackend(object):
+
+    """
+    The interface for file storage backends.
+    """
+
+    def list_new_files(self, folder_id, since=None, until=None, extensions=('mp3',), page_size=200):
+        """
+        Lists the files within a folder, including subfolders, added to the
+        store within a time range.
+
+        :param folder_id: The backend identifier of the folder
+        :param since: An optional datetime, listing files added at or after this time
+        :param until: An optional datetime, listing files added before this time
+        :param extensions: A tuple of the file extensions to list
+        :param page_size: The number of files to request from the backend at once
+        :return: A generator of StoredFile tuples
+        """
+
+        raise NotImplementedError()
+
+    def metadata(self, file_id):
+        """
+        Gets the details of a file.
+
+        :param file_id: The backend identifier of the file
+        :return: A StoredFile tuple
+        """
+
+        raise NotImplementedError()
+
+    def download_url(self, file_id):
+        """
+        Gets a URL that users can use to download a file.
+
+        :param file_id: The backend identifier of the file
+        :return: A URL string
+        """
+
+        raise NotImplementedError()
+
+    def read_range(self, file_id, start, end):
+        """
+        Reads part of a file.
+
+        :param file_id: The backend identifier of the file
+        :param start: The first byte to read
+        :param end: The byte after the last byte to read
+        :return: A bytes string
+        """
+
+        raise NotImplementedError()
+
+    def download_token(self):
+        """
+        Gets the access token given to users to download files, if the
+        backend needs one.
+
+        :return: A DownloadToken tuple or None
+        """
+
+        return None
+
+
+class LocalStorage(StorageBackend):
+
+    """
+    A file storage backend using a local directory. File and folder ids are
+    paths relative to the root directory, using forward slashes. The path of
+    a file starts with the name of the root directory, as Box paths start
+    with the root folder, so that the data_folders configuration of the path
+    indices applies to a copy of the Box folder structure. Files are listed
+    by modification time and downloaded using the stored_file action.
+
+    :param root: The path to the root directory
+    """
+
+    def __init__(self, root):
+
+        self.root = os.path.abspath(root)
+        self.root_name = os.path.basename(self.root)
+
+    def local_path(self, file_id):
+        """
+        Converts an id to a path within the root directory, rejecting ids that
+        point outside it.
+        """
+
+        path = os.path.normpath(os.path.join(self.root, *str(file_id).split('/')))
+
+        if path != self.root and not path.startswith(self.root + os.sep):
+            raise ValueError('Path outside storage root: {}'.format(file_id))
+
+        return path
+
+    def _stored_file(self, path):
+
+        stat = os.stat(path)
+        rel_path = os.path.relpath(path, self.root).split(os.sep)
+
+        return StoredFile(id='/'.join(rel_path),
+                          name=rel_path[-1],
+                          path=[self.root_name] + rel_path[:-1],
+                          size=stat.st_size,
+                          created_at=datetime.datetime.fromtimestamp(int(stat.st_mtime)))
+
+    def list_new_files(self, folder_id, since=None, until=None, extensions=('mp3',), page_size=200):
+
+        extensions = tuple('.' + ext.lower() for ext in extensions)
+
+        for dirpath, dirnames, filenames in os.walk(self.local_path(folder_id)):
+
+            dirnames.sort()
+
+            for filename in sorted(filenames):
+
+                if not filename.lower().endswith(extensions):
+                    continue
+
+                stored = self._stored_file(os.path.join(dirpath, filename))
+
+                if since is not None and stored.created_at < since:
+                    continue
+                if until is not None and stored.created_at >= until:
+                    continue
+
+                yield stored
+
+    def metadata(self, file_id):
+
+        return self._stored_file(self.local_path(file_id))
+
+    def download_url(self, file_id):
+
+        return URL('default', 'stored_file', args=str(file_id).split('/'), scheme=True, host=True)
+
+    def read_range(self, file_id, start, end):
+
+        with open(self.local_path(file_id), 'rb') as infile:
+            infile.seek(start)
+            return infile.read(max(0, end - start))
+
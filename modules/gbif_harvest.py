@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+GBIF harvest module.
+
+Harvests GBIF occurrences with image or sound media for each taxon into the
+gbif_image_occurrences and gbif_sound_occurrences tables. The GBIF API is
+called concurrently for several taxa using a bounded pool of threads, each
+reusing connections through its own requests session. Database access stays
+in the calling thread: the results for each taxon are inserted with a single
+bulk_insert and committed as each taxon completes, so a failure does not
+lose the taxa already harvested.
+
+The ids of the completed taxa are kept as a checkpoint in the app_state
+table, so that an interrupted or partly failed run resumes with the
+remaining taxa. The checkpoint is cleared when a run completes all taxa.
+The date of the last complete harvest of each taxon is also stored, so that
+later harvests only request the occurrences that have changed since then and
+update the stored rows for those occurrences. Occurrences deleted from GBIF
+are removed by a separate, slower, full scan.
+'''
+
+import datetime
+import threading
+from multiprocessing.pool import ThreadPool
+
+from gluon import current
+
+from app_state import get_state, set_state
+
+GBIF_API = "http://api.gbif.org/v1/occurrence/search"
+
+# Occurrences are limited to human observations with media that fall within
+# Borneo (otherwise we get swamped by widespread species)
+BORNEO = ("Polygon((108.2 2.9, 108.2 -2.0, 110.2 -4.6, 117.0 -5.9, "
+          "121 4.1, 119.5 7.7, 115.1 7.6, 108.2 2.9))")
+
+# GBIF fields included with each occurrence when they are present
+OPT_FIELDS = {'gbif_occurrence_behavior': 'behavior',
+              'gbif_occurrence_references': 'references',
+              'gbif_occurrence_rights_holder': 'rightsHolder',
+              'gbif_occurrence_rights': 'rights'}
+
+MEDIA_FIELDS = {'gbif_media_identifier': 'identifier',
+                'gbif_media_format': 'format',
+                'gbif_media_creator': 'creator',
+                'gbif_media_description': 'description'}
+
+# The fields updated when a stored occurrence has changed in GBIF. The taxon
+# fields are left alone, as genus level taxa can return the same occurrences
+# as their species, and use_for_taxon is set by the admin users.
+SYNCED_FIELDS = (['gbif_occurrence_accepted_name', 'gbif_occurrence_license'] +
+                 sorted(OPT_FIELDS) + sorted(MEDIA_FIELDS))
+
+# The GBIF media type harvested into each table
+MEDIA_TYPES = {'gbif_image_occurrences': 'StillImage',
+               'gbif_sound_occurrences': 'Sound'}
+
+# A requests session for each pool thread
+_local = threading.local()
+
+
+def _session():
+    """
+    Gets the requests session for the current thread, so that each thread
+    reuses its connections to the GBIF API.
+    """
+
+    import requests
+
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+
+    return _local.session
+
+
+def fetch_occurrences(gbif_key, media_type, api_url=GBIF_API, since=None, limit=300, timeout=60):
+    """
+    Gets all of the GBIF occurrences of a taxon with a media type, following
+    the paged output of the API. This does not use the database, so it can
+    run in a pool thread.
+
+    :param gbif_key: The GBIF taxon key
+    :param media_type: The GBIF media type, such as StillImage or Sound
+    :param api_url: The URL of the GBIF occurrence search API
+    :param since: An optional ISO date, to only get occurrences that GBIF
+        has interpreted on or after that date
+    :param limit: The number of records to request in each page
+    :param timeout: The request timeout in seconds
+    :return: A tuple of the list of occurrences and a boolean showing if
+        all of the pages were retrieved
+    """
+
+    import requests
+
+    session = _session()
+    params = {'taxonKey': gbif_key,
+              'mediaType': media_type,
+              'limit': limit,
+              'offset': 0,
+              'geometry': BORNEO,
+              'basisOfRecord': 'HUMAN_OBSERVATION'}
+
+    if since is not None:
+        params['lastInterpreted'] = '{},*'.format(since)
+
+    results = []
+
+    while True:
+        try:
+            response = session.get(api_url, params=params, timeout=timeout)
+        except requests.RequestException:
+            return results, False
+
+        if response.status_code != 200:
+            return results, False
+
+        try:
+            data = response.json()
+        except ValueError:
+            return results, False
+
+        results += data['results']
+
+        if data['endOfRecords']:
+            return results, True
+
+        params['offset'] += limit
+
+
+def occurrence_rows(taxon, occurrence, table):
+    """
+    Converts a GBIF occurrence into rows for an occurrence table, with one
+    row for each media file of the harvested type. Image occurrences that
+    also include a Sound file are skipped, as the images are (probably)
+    sonograms, and sonogram images are screened out of sound occurrences.
+
+    :param taxon: A row from the taxa table
+    :param occurrence: A GBIF occurrence dictionary
+    :param table: The name of the occurrence table
+    :return: A list of dictionaries of row data
+    """
+
+    media_types = {media['type'] for media in occurrence['media']}
+
+    if table == 'gbif_image_occurrences' and 'Sound' in media_types:
+        return []
+
+    # First, get the occurrence level data, including the species of the occurrence
+    # as our taxa can be genus level, and we want to provide precise ids.
+    insert_data = {'taxon_id': taxon.id,
+                   'gbif_occurrence_taxon_key': taxon.gbif_key,
+                   'gbif_occurrence_accepted_name': occurrence['acceptedScientificName'],
+                   'gbif_occurrence_key': occurrence['key'],
+                   'gbif_occurrence_license': occurrence['license']}
+
+    for key, val in OPT_FIELDS.iteritems():
+        if val in occurrence:
+            insert_data[key] = occurrence[val]
+
+    rows = []
+
+    for media in occurrence['media']:
+
+        if table == 'gbif_sound_occurrences' and media['type'] != 'Sound':
+            continue
+
+        media_data = insert_data.copy()
+
+        for key, val in MEDIA_FIELDS.iteritems():
+            if val in media:
+                media_data[key] = media[val]
+
+        rows.append(media_data)
+
+    return rows
+
+
+def _pooled_fetch(taxa, media_type, n_workers, api_url, since=None):
+    """
+    Generator that fetches the occurrences for a list of taxa using a pool
+    of threads, yielding the results for each taxon as it completes.
+
+    :param taxa: A list of rows from the taxa table
+    :param media_type: The GBIF media type
+    :param n_workers: The number of concurrent API requests
+    :param api_url: The URL of the GBIF occurrence search API
+    :param since: An optional dictionary of ISO dates keyed by taxon id
+        string, giving the date from which to fetch changed occurrences
+    :return: A generator of tuples of the taxon row, the list of
+        occurrences and a boolean showing if all pages were retrieved
+    """
+
+    since = since or {}
+
+    def _fetch(taxon):
+        results, complete = fetch_occurrences(taxon.gbif_key, media_type, api_url=api_url,
+                                              since=since.get(str(taxon.id)))
+        return taxon, results, complete
+
+    pool = ThreadPool(n_workers)
+
+    try:
+        for result in pool.imap_unordered(_fetch, taxa):
+            yield result
+
+        pool.close()
+    finally:
+        pool.terminate()
+
+
+def _sync_occurrence(table, stored, rows):
+    """
+    Updates the stored rows of an occurrence to match the rows from GBIF,
+    matching the rows by media identifier. Changed rows are updated in place,
+    keeping their ids and use_for_taxon settings, and rows for media that
+    have been removed from the occurrence are deleted.
+
+    :param table: The name of the occurrence table
+    :param stored: A list of the stored rows of the occurrence
+    :param rows: A list of dictionaries of row data from occurrence_rows
+    :return: A tuple of a list of the rows for new media and the number of
+        rows updated
+    """
+
+    db = current.db
+
+    by_media = {row.gbif_media_identifier: row for row in stored}
+    new_rows = []
+    n_updated = 0
+
+    for row in rows:
+
+        old = by_media.pop(row.get('gbif_media_identifier'), None)
+
+        if old is None:
+            new_rows.append(row)
+            continue
+
+        changes = {fld: row.get(fld) for fld in SYNCED_FIELDS if row.get(fld) != old[fld]}
+
+        if changes:
+            db(db[table].id == old.id).update(**changes)
+            n_updated += 1
+
+    if by_media:
+        db(db[table].id.belongs([row.id for row in by_media.values()])).delete()
+
+    return new_rows, n_updated
+
+
+def harvest(table, n_workers=4, resume=True, incremental=True, api_url=GBIF_API):
+    """
+    Harvests the GBIF occurrences for all taxa into an occurrence table.
+    The API is queried for several taxa at once and the occurrences for
+    each taxon are inserted or updated and committed as soon as that taxon
+    is complete. The existing occurrence rows are loaded once, rather than
+    checking each occurrence with a query.
+
+    The date of the last complete harvest of each taxon is stored in the
+    app_state table and incremental harvests only request occurrences that
+    GBIF has interpreted since that date, so a taxon with no changes costs
+    a single request. Occurrences that are already stored are updated with
+    any changes. Deleted occurrences are not found by an incremental
+    harvest: use reconcile_deletions to remove them.
+
+    :param table: One of gbif_image_occurrences or gbif_sound_occurrences
+    :param n_workers: The number of concurrent API requests
+    :param resume: Skip the taxa completed by an earlier interrupted run
+    :param incremental: Only request occurrences changed since the last
+        harvest of each taxon
+    :param api_url: The URL of the GBIF occurrence search API
+    :return: A string containing a report of the harvest
+    """
+
+    db = current.db
+    media_type = MEDIA_TYPES[table]
+    checkpoint = 'gbif_harvest.{}'.format(table)
+    last_harvest_key = 'gbif_harvest.{}.last_harvest'.format(table)
+
+    done = set((get_state(checkpoint) or []) if resume else [])
+    taxa = [taxon for taxon in db(db.taxa).select() if taxon.id not in done]
+
+    # The date is taken before any requests and the search includes the whole
+    # of that day, so occurrences changed during the harvest are not missed.
+    harvest_date = datetime.datetime.utcnow().date().isoformat()
+    last_harvest = get_state(last_harvest_key) or {}
+
+    existing = {}
+    for row in db(db[table]).select(db[table].id, db[table].gbif_occurrence_key,
+                                    *[db[table][fld] for fld in SYNCED_FIELDS]):
+        existing.setdefault(row.gbif_occurrence_key, []).append(row)
+
+    # Occurrences already handled in this run, which can be returned for
+    # both a genus and its species
+    seen = set()
+
+    report = ""
+    row_hdr = "{0.scientific_name} ({0.gbif_key}): "
+    n_failed = 0
+
+    if done:
+        report += "Resuming harvest: {} taxa already complete\n".format(len(done))
+
+    for taxon, results, complete in _pooled_fetch(taxa, media_type, n_workers, api_url,
+                                                  since=last_harvest if incremental else None):
+
+        new_rows = []
+        n_updated = 0
+
+        for occurrence in results:
+
+            if occurrence['key'] in seen:
+                continue
+
+            seen.add(occurrence['key'])
+            rows = occurrence_rows(taxon, occurrence, table)
+
+            if occurrence['key'] in existing:
+                rows, n_rows_updated = _sync_occurrence(table, existing[occurrence['key']], rows)
+                n_updated += n_rows_updated
+
+            new_rows += rows
+
+        if new_rows:
+            db[table].bulk_insert(new_rows)
+
+        # Only mark the taxon as done if all of the pages were retrieved,
+        # so that a resumed run tries again.
+        if complete:
+            done.add(taxon.id)
+            last_harvest[str(taxon.id)] = harvest_date
+            set_state(checkpoint, sorted(done))
+            set_state(last_harvest_key, last_harvest)
+            report += (row_hdr + "{1} records returned, {2} new rows, {3} rows updated\n").format(
+                taxon, len(results), len(new_rows), n_updated)
+        else:
+            n_failed += 1
+            report += (row_hdr + "GBIF scan failed after {1} records, {2} new rows, {3} rows updated\n").format(
+                taxon, len(results), len(new_rows), n_updated)
+
+        db.commit()
+
+    if not n_failed:
+        set_state(checkpoint, None)
+        db.commit()
+        report += "Harvest complete\n"
+    else:
+        report += "Harvest incomplete: run again to resume\n"
+
+    return report
+
+
+def reconcile_deletions(table, n_workers=4, api_url=GBIF_API):
+    """
+    Removes occurrences that are no longer returned by GBIF, for example
+    because they have been deleted or their media removed. This requests
+    all of the occurrences for each taxon, so it is much slower than an
+    incremental harvest and is intended to be run occasionally. Rows for a
+    taxon are only removed if all of the pages for that taxon were retrieved.
+
+    :param table: One of gbif_image_occurrences or gbif_sound_occurrences
+    :param n_workers: The number of concurrent API requests
+    :param api_url: The URL of the GBIF occurrence search API
+    :return: A string containing a report of the reconciliation
+    """
+
+    db = current.db
+    report = ""
+    row_hdr = "{0.scientific_name} ({0.gbif_key}): "
+    n_deleted = 0
+
+    for taxon, results, complete in _pooled_fetch(db(db.taxa).select(), MEDIA_TYPES[table],
+                                                  n_workers, api_url):
+
+        if not complete:
+            report += (row_hdr + "GBIF scan failed, not reconciled\n").format(taxon)
+            continue
+
+        keys = [occurrence['key'] for occurrence in results]
+        n_taxon = db((db[table].taxon_id == taxon.id) &
+                     ~db[table].gbif_occurrence_key.belongs(keys)).delete()
+        db.commit()
+
+        if n_taxon:
+            n_deleted += n_taxon
+            report += (row_hdr + "{1} rows removed\n").format(taxon, n_taxon)
+
+    report += "Reconciliation complete: {} rows removed\n".format(n_deleted)
+
+    return report
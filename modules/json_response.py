@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+JSON response module.
+
+Sends JSON service responses with an ETag, returning 304 Not Modified when
+the client already holds the current content, and compressing the body
+with brotli or gzip when the client accepts it. Compressed bodies are held
+in memory by ETag, so repeated requests for unchanged content are only
+compressed once per process. Brotli is used only if the brotli package is
+installed.
+'''
+
+import gzip
+import hashlib
+import io
+
+from gluon import current, HTTP
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 1024
+
+# Compressed bodies keyed by (etag, encoding)
+_compressed = {}
+_COMPRESSED_MAX = 64
+
+
+def content_etag(content):
+    """
+    Creates a strong ETag from a hash of the content
+
+    :param content: The response body
+    :return: A quoted ETag string
+    """
+
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+
+    return '"{}"'.format(hashlib.sha1(content).hexdigest()[:16])
+
+
+def compress(content, encoding):
+    """
+    Compresses content using a content encoding
+
+    :param content: The bytes to compress
+    :param encoding: One of 'br' or 'gzip'
+    :return: The compressed bytes
+    """
+
+    if encoding == 'br':
+        return brotli.compress(content)
+
+    outfile = io.BytesIO()
+    # a fixed mtime keeps the gzip bytes stable for the same content
+    with gzip.GzipFile(fileobj=outfile, mode='wb', compresslevel=6, mtime=0) as gz_file:
+        gz_file.write(content)
+
+    return outfile.getvalue()
+
+
+def accepted_encoding():
+    """
+    Gets the preferred supported content encoding accepted by the client
+
+    :return: 'br', 'gzip' or None
+    """
+
+    accept = current.request.env.http_accept_encoding or ''
+    accept = {enc.split(';')[0].strip() for enc in accept.split(',')}
+
+    if brotli is not None and 'br' in accept:
+        return 'br'
+    elif 'gzip' in accept:
+        return 'gzip'
+
+    return None
+
+
+def _not_modified(etag):
+    """
+    Checks the If-None-Match request header against an ETag, ignoring
+    weak validator prefixes added by proxies.
+    """
+
+    if_none_match = current.request.env.http_if_none_match
+
+    if not if_none_match:
+        return False
+
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+
+    return '*' in tags or etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+
+def send_json(content, etag=None, compressed=None, **headers):
+    """
+    Sends a serialised JSON body by raising an HTTP response, which stops
+    any further serialisation of the content by the service. The current
+    response headers, such as the CORS headers set in default.call, are
+    included along with any extra headers.
+
+    :param content: The serialised JSON
+    :param etag: A quoted ETag for the content, calculated if not provided
+    :param compressed: An optional dictionary of precompressed bodies
+        keyed by content encoding
+    :param headers: Additional response headers
+    """
+
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+
+    if etag is None:
+        etag = content_etag(content)
+
+    response_headers = dict(current.response.headers)
+    response_headers.update(headers)
+    response_headers['ETag'] = etag
+    response_headers['Vary'] = 'Accept-Encoding'
+    response_headers['Content-Type'] = 'application/json; charset=utf-8'
+
+    if _not_modified(etag):
+        raise HTTP(304, '', **response_headers)
+
+    encoding = accepted_encoding()
+
+    if encoding is not None and len(content) >= MIN_COMPRESS_SIZE:
+
+        if compressed and encoding in compressed:
+            content = compressed[encoding]
+        else:
+            key = (etag, encoding)
+            if key not in _compressed:
+                if len(_compressed) >= _COMPRESSED_MAX:
+                    _compressed.clear()
+                _compressed[key] = compress(content, encoding)
+            content = _compressed[key]
+
+        response_headers['Content-Encoding'] = encoding
+
+    raise HTTP(200, content, **response_headers)
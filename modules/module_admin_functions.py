@@ -1,17 +1,18 @@
 import os
-import requests
-from itertools import tee, izip, groupby
-import box
+from itertools import groupby
+import audio_scan
+from deployment_index import DeploymentIndex
+from app_state import get_state, set_state
+import api_payload
+import gbif_harvest
+import daily_counts
 import datetime
 from gluon import current, URL
-from PIL import Image
-import io
-import pandas
-import numpy as np
 import random
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+
+# This module is imported on every request by the scheduler model and the
+# default controller, so the heavy libraries - pandas, numpy and matplotlib
+# - are imported inside the functions that use them.
 
 def populate_gbif_image_occurrences():
 
@@ -22,281 +23,271 @@ def populate_gbif_image_occurrences():
     :return: A string containing a report of the scanning process
     """
 
-    taxa = current.db(current.db.taxa).select()
+    return gbif_harvest.harvest('gbif_image_occurrences')
 
-    # An API call to GBIF occurrences limited to human observations with sound or image
-    # media that falls within Borneo (otherwise we get swamped by widespread species)
-    gbif_api = ("http://api.gbif.org/v1/occurrence/search"
-                "?taxonKey={}&mediaType=StillImage&limit={}&offset={}"
-                "&geometry=Polygon((108.2 2.9, 108.2 -2.0, 110.2 -4.6, 117.0 -5.9, "
-                "121 4.1, 119.5 7.7, 115.1 7.6, 108.2 2.9))"
-                "&basisOfRecord=HUMAN_OBSERVATION")
 
-    report = ""
-    row_hdr = "{0.scientific_name} ({0.gbif_key}): "
+def populate_gbif_sound_occurrences():
 
-    for this_taxon in taxa:
+    """
+    A function to populate the gbif sound occurrences table  with sounds
+    to provide to the frontend via the API.
 
-        # Call the GBIF occurrences API, which has paged output, so iterate
-        # over limit sized blocks if needed to get all information.
+    :return: A string containing a report of the scanning process
+    """
 
-        end_of_records = False
-        limit = 300
-        offset = 0
-        results = []
+    return gbif_harvest.harvest('gbif_sound_occurrences')
 
-        while not end_of_records:
-            api_call = gbif_api.format(this_taxon.gbif_key, limit, offset)
-            response = requests.get(api_call)
 
-            if response.status_code != 200:
-                report += (row_hdr + "GBIF scan failed\n").format(this_taxon)
-                end_of_records = True
-            else:
-                data = response.json()
-                report += (row_hdr + "{1} records returned\n").format(this_taxon, len(data['results']))
-                results += data['results']
-                end_of_records = data['endOfRecords']
-                offset += limit
+def reconcile_gbif_occurrences():
 
-        # Each result is an occurrence, which may reference one more more image or sound files.
+    """
+    A function to remove GBIF image and sound occurrences that are no
+    longer available from GBIF. This requests every occurrence, so is
+    slower than the routine incremental updates.
 
-        for this_result in results:
+    :return: A string containing a report of the reconciliation
+    """
 
-            # Do we already have this occurrence?
-            if current.db(current.db.gbif_image_occurrences.gbif_occurrence_key == this_result['key']).select():
-                continue
+    return (gbif_harvest.reconcile_deletions('gbif_image_occurrences') +
+            gbif_harvest.reconcile_deletions('gbif_sound_occurrences'))
 
-            # Does the media include a Sound file? If so, any images are (probably) Sonograms
-            media_types = {media['type'] for media in this_result['media']}
-            if 'Sound' in media_types:
-                continue
 
-            # First, get the occurrence level data, including the species of the occurrence
-            # as our taxa can be genus level, and we want to provide precise ids on images.
-            insert_data = {'taxon_id': this_taxon.id,
-                           'gbif_occurrence_taxon_key': this_taxon.gbif_key,
-                           'gbif_occurrence_accepted_name': this_result['acceptedScientificName'],
-                           'gbif_occurrence_key': this_result['key'],
-                           'gbif_occurrence_license': this_result['license']}
+def scan_box():
+    """
+    This action runs the scanning process. This should probably be run a
+    cron job but for the moment this action provides the functionality
+    """
 
-            # Some fields are not always present
-            opt_fields = {'gbif_occurrence_behavior': 'behavior',
-                          'gbif_occurrence_references': 'references',
-                          'gbif_occurrence_rights_holder': 'rightsHolder',
-                          'gbif_occurrence_rights': 'rights'}
+    scan_stats = audio_scan.scan_storage(current.file_storage)
 
-            for key, val in opt_fields.iteritems():
-                if val in this_result:
-                    insert_data[key] = this_result[val]
+    # index_audio()
 
-            # loop over the media files
-            for this_media in this_result['media']:
+    assign_time_windows()
 
-                media_data = insert_data.copy()
+    daily_counts.update_daily_counts()
 
-                media_fields = {'gbif_media_identifier': 'identifier',
-                                'gbif_media_format': 'format',
-                                'gbif_media_creator': 'creator',
-                                'gbif_media_description': 'description'}
+    index_day_streams()
 
-                for key, val in media_fields.iteritems():
-                    if val in this_media:
-                        media_data[key] = this_media[val]
+    # If this runs from within a controller, then db.commit happens
+    # automatically, but if it is run by a scheduler it doesn't
+    current.db.commit()
 
-                current.db.gbif_image_occurrences.insert(**media_data)
+    # Swap in the new api_response payload for all workers
+    api_payload.render_api_payload()
 
-    # save those inserts
-    current.db.commit()
+    make_availability_png()
 
-    return report
+    if scan_stats['files_scanned'] == 0:
+        return "Scan complete: no files found"
 
+    return ("Scan complete: {files_scanned} files checked, {known_new} new matched and "
+            "{unknown_new} new unmatched, at {files_per_second:.1f} files/second\n"
+            "{folder_report}\n"
+            "{deployment_report}").format(**scan_stats)
 
-def populate_gbif_sound_occurrences():
 
+def rescan_deployments(rescan_all=False, set_based=True):
     """
-    A function to populate the gbif sound occurrences table  with sounds
-    to provide to the frontend via the API.
+    This action assigns audio to deployments. They are automatically
+    matched when imported but this allows them to be updated when
+    deployments are changed. Setting rescan_all rescans all audio, not
+    just the audio which didn't match at import.
 
-    :return: A string containing a report of the scanning process
+    By default, the matching is done in the database using one UPDATE
+    per deployment, and only the sites whose audio assignments have changed
+    are then reindexed. Setting set_based to False matches each audio record
+    in turn against the deployment index.
+
+    :param rescan_all: Rescan all deployed audio, not just unmatched audio.
+    :param set_based: Use one database update per deployment.
+    :return: A string containing a report of the rescan
     """
 
-    taxa = current.db(current.db.taxa).select()
+    db = current.db
 
-    # An API call to GBIF occurrences limited to human observations with sound
-    # media that falls within Borneo (otherwise we get swamped by widespread species)
-    gbif_api = ("http://api.gbif.org/v1/occurrence/search"
-                "?taxonKey={}&mediaType=Sound&limit={}&offset={}"
-                "&geometry=Polygon((108.2 2.9, 108.2 -2.0, 110.2 -4.6, 117.0 -5.9, "
-                "121 4.1, 119.5 7.7, 115.1 7.6, 108.2 2.9))"
-                "&basisOfRecord=HUMAN_OBSERVATION")
+    deployments = DeploymentIndex()
 
-    report = ""
-    row_hdr = "{0.scientific_name} ({0.gbif_key}): "
+    # Only audio from deployed recorders is matched against deployments
+    qry = db.audio.recorder_type == deployments.recorder_type
 
-    for this_taxon in taxa:
+    if not rescan_all:
+        qry &= (db.audio.site_id == None)
 
-        # Call the GBIF occurrences API, which has paged output, so iterate
-        # over limit sized blocks if needed to get all information.
+    _backfill_recorder_ids(qry)
 
-        end_of_records = False
-        limit = 300
-        offset = 0
-        results = []
+    if set_based:
+        n_updated, changed_sites = _rescan_deployments_set_based(qry, deployments)
+    else:
+        n_updated, changed_sites = _rescan_deployments_by_row(qry, deployments)
 
-        while not end_of_records:
-            api_call = gbif_api.format(this_taxon.gbif_key, limit, offset)
-            response = requests.get(api_call)
+    changed_sites.discard(None)
 
-            if response.status_code != 200:
-                report += (row_hdr + "GBIF scan failed\n").format(this_taxon)
-                end_of_records = True
-            else:
-                data = response.json()
-                report += (row_hdr + "{1} records returned\n").format(this_taxon, len(data['results']))
-                results += data['results']
-                end_of_records = data['endOfRecords']
-                offset += limit
+    for site_id in changed_sites:
+        _index_site(site_id)
 
-        # Each result is an occurrence, which may reference one more more image or sound files.
+    assign_time_windows()
 
-        for this_result in results:
+    daily_counts.update_daily_counts(site_ids=changed_sites)
 
-            # Do we already have this occurrence?
-            if current.db(current.db.gbif_sound_occurrences.gbif_occurrence_key == this_result['key']).select():
-                continue
+    index_day_streams(site_ids=changed_sites)
 
-            # First, get the occurrence level data, including the species of the occurrence
-            # as our taxa can be genus level, and we want to provide precise ids on images.
-            insert_data = {'taxon_id': this_taxon.id,
-                           'gbif_occurrence_taxon_key': this_taxon.gbif_key,
-                           'gbif_occurrence_accepted_name': this_result['acceptedScientificName'],
-                           'gbif_occurrence_key': this_result['key'],
-                           'gbif_occurrence_license': this_result['license']}
+    current.db.commit()
 
-            # Some fields are not always present
-            opt_fields = {'gbif_occurrence_behavior': 'behavior',
-                          'gbif_occurrence_references': 'references',
-                          'gbif_occurrence_rights_holder': 'rightsHolder',
-                          'gbif_occurrence_rights': 'rights'}
+    api_payload.render_api_payload()
 
-            for key, val in opt_fields.iteritems():
-                if val in this_result:
-                    insert_data[key] = this_result[val]
+    return ("Rescan complete: {} audio records updated at {} sites\n".format(n_updated, len(changed_sites)) +
+            deployments.report())
 
-            # loop over the media files
-            for this_media in this_result['media']:
 
-                # media entries for sounds include sonogram pngs, so screen them out
-                if this_media['type'] == 'Sound':
+def _rescan_deployments_set_based(qry, deployments):
+    """
+    Matches audio to deployments using a single UPDATE statement for each
+    deployment. Where deployments overlap, each deployment only updates the
+    dates on which it is the most recently started deployment, as in
+    DeploymentIndex.resolve(), so each record is matched by one update only
+    and the updates do not depend on each other.
+
+    :param qry: A DAL query selecting the audio to be rescanned
+    :param deployments: A DeploymentIndex instance
+    :return: A tuple of the number of audio records updated and the set of
+        site ids whose audio has changed
+    """
 
-                    media_data = insert_data.copy()
+    db = current.db
 
-                    media_fields = {'gbif_media_identifier': 'identifier',
-                                    'gbif_media_format': 'format',
-                                    'gbif_media_creator': 'creator',
-                                    'gbif_media_description': 'description'}
+    n_updated = 0
+    changed_sites = set()
 
-                    for key, val in media_fields.iteritems():
-                        if val in this_media:
-                            media_data[key] = this_media[val]
+    for recorder_id, start, end, dep in deployments.effective_ranges():
 
-                    current.db.gbif_sound_occurrences.insert(**media_data)
+        dep_qry = qry & (db.audio.recorder_id == recorder_id)
 
-    # save those inserts
-    current.db.commit()
+        if start != datetime.date.min:
+            dep_qry &= (db.audio.record_datetime >= datetime.datetime.combine(start, datetime.time()))
 
-    return report
+        if end != datetime.date.max:
+            dep_qry &= (db.audio.record_datetime < datetime.datetime.combine(end + datetime.timedelta(days=1),
+                                                                             datetime.time()))
 
+        # Skip records that already have this assignment
+        dep_qry &= ((db.audio.deployment_id == None) |
+                    (db.audio.deployment_id != dep.deployment_id) |
+                    (db.audio.site_id == None) |
+                    (db.audio.site_id != dep.site_id))
 
-def scan_box():
+        # Note the sites that are losing audio before updating
+        old_sites = db(dep_qry).select(db.audio.site_id, distinct=True)
+
+        n_rows = db(dep_qry).update(deployment_id=dep.deployment_id,
+                                    site_id=dep.site_id,
+                                    habitat=dep.habitat,
+                                    recorder_type=dep.recorder_type)
+
+        if n_rows:
+            n_updated += n_rows
+            changed_sites.add(dep.site_id)
+            changed_sites.update(rw.site_id for rw in old_sites)
+
+    return n_updated, changed_sites
+
+
+def _rescan_deployments_by_row(qry, deployments):
     """
-    This action runs the scanning process. This should probably be run a
-    cron job but for the moment this action provides the functionality
+    Matches audio to deployments one record at a time using the
+    deployment index.
+
+    :param qry: A DAL query selecting the audio to be rescanned
+    :param deployments: A DeploymentIndex instance
+    :return: A tuple of the number of audio records updated and the set of
+        site ids whose audio has changed
     """
 
-    box.scan_box(current.box_client)
+    db = current.db
 
-    # index_audio()
+    audio = db(qry).select(db.audio.id,
+                           db.audio.recorder_id,
+                           db.audio.record_datetime,
+                           db.audio.deployment_id,
+                           db.audio.site_id)
 
-    assign_time_windows()
+    n_updated = 0
+    changed_sites = set()
 
-    index_day_streams()
+    # now iterate over the selected rows
+    for row in audio:
 
-    # If this runs from within a controller, then db.commit happens
-    # automatically, but if it is run by a scheduler it doesn't
-    current.db.commit()
-    
-    make_availability_png()
-    
-    return "Scan complete"
+        deployment = deployments.resolve(row.recorder_id, row.record_datetime)
+
+        if deployment is None or (deployment.deployment_id == row.deployment_id and
+                                  deployment.site_id == row.site_id):
+            continue
+
+        db(db.audio.id == row.id).update(deployment_id=deployment.deployment_id,
+                                         site_id=deployment.site_id,
+                                         habitat=deployment.habitat,
+                                         recorder_type=deployment.recorder_type)
+        n_updated += 1
+        changed_sites.update([deployment.site_id, row.site_id])
 
+    return n_updated, changed_sites
 
-def rescan_deployments(rescan_all=False):
+
+def _backfill_recorder_ids(qry):
     """
-    This action assigns audio to deployments. They are automatically
-    matched when imported but this allows them to be updated when
-    deployments are changed. Setting rescan_all rescans all audio, not
-    just the audio which didn't match at import.
+    Older audio records were imported without the recorder id. This fills
+    in missing recorder ids from the stored Box path, using one update per
+    recorder.
+
+    :param qry: A DAL query selecting the audio to be rescanned
     """
 
-    # TODO - I suspect this might be faster using the DAL but the code
-    #        here can be ripped straight from the box.scan_box() code.
+    db = current.db
 
-    deployments = current.db((current.db.recorders.id == current.db.deployments.recorder_id) &
-                             (current.db.sites.id == current.db.deployments.site_id)).select()
+    rows = db(qry & (db.audio.recorder_id == None)).select(db.audio.id, db.audio.box_dir)
 
-    if rescan_all:
-        audio = current.db(current.db.audio).select()
-    else:
-        audio = current.db(current.db.audio.site_id == None).select()
+    ids_by_recorder = {}
 
-    # now iterate over the selected rows
-    for row in audio:
+    for row in rows:
+        recorder_id = _recorder_id_from_box_dir(row.box_dir)
+        if recorder_id is not None:
+            ids_by_recorder.setdefault(recorder_id, []).append(row.id)
 
-        # get the path
-        which_deployment = [(row.recorder_id == dp.recorders.recorder_id) &
-                            (row.record_datetime.date() >= dp.deployments.deployed_from) &
-                            (row.record_datetime.date() <= dp.deployments.deployed_to)
-                            for dp in deployments]
+    for recorder_id, ids in ids_by_recorder.iteritems():
+        db(db.audio.id.belongs(ids)).update(recorder_id=recorder_id)
 
-        if True in which_deployment:
-            deployment_record = deployments[which_deployment.index(True)]
-            row.update_record(deployment_id=deployment_record.deployments.id,
-                              site_id=deployment_record.deployments.site_id,
-                              habitat=deployment_record.sites.habitat,
-                              recorder_type=deployment_record.recorders.recorder_type)
 
-    index_audio()
+def _recorder_id_from_box_dir(box_dir):
+    """
+    Recovers the recorder id from the stored Box path of a recording, using
+    the pi_index of the deployed data folders.
 
-    assign_time_windows()
+    :param box_dir: The box_dir value of an audio record
+    :return: The recorder id or None
+    """
 
-    current.db.commit()
+    if box_dir is None:
+        return None
+
+    path = box_dir.split('/')
+
+    for this_folder in current.myconf.take('box.data_folders'):
+        if this_folder['deployed'] and len(path) > this_folder['pi_index']:
+            return path[this_folder['pi_index']]
+
+    return None
 
 
 def make_availability_png():
-    
+
     """
-    Saves a PNG of the current site availability
+    Saves a PNG heatmap of the current site availability, drawn from the
+    audio daily counts summary rather than from every audio record.
     """
-    
-    db = current.db
-    
-    rec = db.executesql('select site_id, record_datetime from audio where recorder_type="rpi-eco-monitor"')
-    site, dt = zip(*rec)
-    
-    site_labels = db.executesql('select id, site_name from sites')
-    site_id, site_label = zip(*site_labels)
-    
-    fig, ax = plt.subplots(figsize=(9.2, 5))
-    ax.plot(dt, site, 'bo', alpha=0.5, markersize=2)
-    plt.yticks(site_id, site_label)
-    plt.tight_layout()
-    
-    png_file = os.path.join(current.request.folder, 'static', 'images', 'availability.png')
-    plt.savefig(png_file)
 
-    return None
+    daily_counts.render_availability_png()
+
+    return "Availability plot saved"
+
 
 # ---
 # Indexing: functions to identify the next audio 'in stream' for each recording
@@ -313,57 +304,84 @@ def index_audio():
         _index_site(site.id)
 
 
-def pairwise(iterable):
-    """
-    Recipe from itertools to turn an iterable into a generator
-    yielding successive pairs of entries:
-        s -> (s0,s1), (s1,s2), (s2, s3), ...
-
-    Parameters:
-        iterable: An iterable object
-
-    Returns:
-        A generator giving pairs of entries in iterable
-    """
-
-    a, b = tee(iterable)
-    next(b, None)
-    return izip(a, b)
+# SQL expressions by database engine for the seconds since midnight and the
+# hour of a time field. SQLite stores times as text and strftime reads them
+# as times on 2000-01-01, so the seconds are taken relative to midnight.
+TIME_SQL = {'sqlite': ("(CAST(strftime('%s', {0}) AS INTEGER) - CAST(strftime('%s', '00:00:00') AS INTEGER))",
+                       "CAST(strftime('%H', {0}) AS INTEGER)"),
+            'postgres': ("CAST(EXTRACT(EPOCH FROM {0}) AS INTEGER)",
+                         "CAST(EXTRACT(HOUR FROM {0}) AS INTEGER)")}
 
 
-def assign_time_windows():
+def assign_time_windows(recompute=False):
     """
     Calculates the time window for each recording in db.audio and updates
     the database to store the window codes. These windows are used to
     group recordings to provide counts within time windows to the front
     end via the get_site API call.
 
+    The windows are calculated in the database from the start_second field,
+    as SQLite has an issue with the time extractors on pure time fields.
+    Only recordings without a time window are updated, unless recompute
+    is set or the configured window width has changed since the last run.
+    The observation hour of taxon observations is filled in similarly.
+
+    Parameters:
+        recompute (bool): Recalculate the time window for all recordings and
+            the hour of all taxon observations.
+
     Returns:
-        None
+        A string reporting the number of updated recordings
     """
 
     db = current.db
 
     window_width = int(current.myconf.take('audio.window_width'))
 
-    # # These should work and are much faster but SQLite has an issue with the time extractors
-    # # and pure time fields - would work for datetime.
+    # Fill in start_second for any recordings that predate it, using a single
+    # update with the SQL for the time fields in the database engine.
+    engine = db._adapter.dbengine
+
+    if engine in TIME_SQL:
+        seconds_sql, hour_sql = TIME_SQL[engine]
+        db.executesql('UPDATE audio SET start_second = {}, time_window = NULL '
+                      'WHERE start_second IS NULL AND start_time IS NOT NULL;'.format(
+                          seconds_sql.format('start_time')))
+    else:
+        # Otherwise, use one update for each distinct start time.
+        missing = db((db.audio.start_second == None) &
+                     (db.audio.start_time != None)).select(db.audio.start_time, distinct=True)
+
+        for row in missing:
+            t_sec = row.start_time.hour * 60 * 60 + row.start_time.minute * 60 + row.start_time.second
+            db((db.audio.start_second == None) &
+               (db.audio.start_time == row.start_time)).update(start_second=t_sec,
+                                                               time_window=None)
+
+    # A change in the window width invalidates all existing windows
+    if recompute or get_state('audio.window_width') != window_width:
+        qry = db.audio.id > 0
+    else:
+        qry = db.audio.time_window == None
+
+    n_updated = db(qry).update(time_window=db.audio.start_second / window_width)
+    set_state('audio.window_width', window_width)
 
-    # db(db.audio).update(time_window=(db.audio.start_time.hour() * 60 * 60 +
-    #                                  db.audio.start_time.minutes() * 60 +
-    #                                  db.audio.start_time.seconds()) / window_width)
-    #
-    # db(db.taxon_observations).update(time_window=(db.taxon_observations.start_time.hour() * 60 * 60 +
-    #                                               db.taxon_observations.start_time.minutes() * 60 +
-    #                                               db.taxon_observations.start_time.seconds()) / window_width)
+    # The observation hours do not depend on the window width, so are only
+    # all recalculated when recompute is set
+    if engine in TIME_SQL:
+        db.executesql('UPDATE taxon_observations SET obs_hour = {}{};'.format(
+            hour_sql.format('obs_time'), '' if recompute else ' WHERE obs_hour IS NULL'))
+    else:
+        if recompute:
+            obs_qry = db.taxon_observations.id > 0
+        else:
+            obs_qry = db.taxon_observations.obs_hour == None
 
-    # Grabbing the value into python turns it into a time object
-    for row in db(db.audio).iterselect():
-        t_sec = row.start_time.hour * 60 * 60 + row.start_time.minute * 60 + row.start_time.second
-        row.update_record(time_window=t_sec / window_width)
+        for row in db(obs_qry).iterselect():
+            row.update_record(obs_hour=row.obs_time.hour)
 
-    for row in db(db.taxon_observations).iterselect():
-        row.update_record(obs_hour=row.obs_time.hour)
+    return "Time windows assigned for {} recordings".format(n_updated)
 
 
 def _index_site(site_id, rec_length=1200):
@@ -375,87 +393,153 @@ def _index_site(site_id, rec_length=1200):
     a simple set of indices in the db that provide a reasonably
     consistent sounding route through the audio available at a site.
 
+    The audio for the site is loaded with a single query and the search
+    for recordings at similar times uses an index of the recordings sorted
+    by time of day, so no further queries are needed. Only changed values
+    of next_in_stream are written back, using batched updates.
+
     Parameters:
         site_id (int): the site id to index
         rec_length (int): the actual lengths of the recordings are not
             easily accessible, so this sets the offset in seconds from
             start_time to be used as the time of the end of the recording.
+
+    Returns:
+        The number of records updated
     """
 
-    # get sufficiently long audio records for the site sorted in ascending order
+    import numpy as np
+
+    db = current.db
+
+    # get all audio records for the site - the similarity search uses all of
+    # them, but only sufficiently long recordings get a next in stream.
     min_size = int(current.myconf.take('audio.min_size'))
-    records = current.db((current.db.audio.site_id == site_id) &
-                         (current.db.audio.file_size > min_size)).select(orderby=current.db.audio.record_datetime)
+    rows = db(db.audio.site_id == site_id).select(db.audio.id,
+                                                  db.audio.record_datetime,
+                                                  db.audio.start_second,
+                                                  db.audio.start_time,
+                                                  db.audio.file_size,
+                                                  db.audio.next_in_stream,
+                                                  orderby=db.audio.record_datetime)
+
+    records = [rw for rw in rows if rw.file_size > min_size]
 
     # need at least two records
     if len(records) < 2:
-        return None
+        return 0
 
     similarity_window = int(current.myconf.take('audio.window_width'))
 
     # get the maximum delay between records that counts as continuous
-    # similar recordings and the timedelta for either side of start_time
+    # similar recordings and the half width of the window in seconds
     max_delay = rec_length + similarity_window / 2
-    window = datetime.timedelta(seconds=similarity_window / 2)
+    window = similarity_window / 2
+
+    # Arrays of ids, record times in seconds and seconds of the day for all
+    # the site recordings, along with the order of the time of day index.
+    epoch = datetime.datetime(1970, 1, 1)
+    all_ids = np.array([rw.id for rw in rows], dtype=np.int64)
+    all_dt = np.array([(rw.record_datetime - epoch).total_seconds() for rw in rows], dtype=np.int64)
+    all_tod = np.array([rw.start_second if rw.start_second is not None else
+                        rw.start_time.hour * 3600 + rw.start_time.minute * 60 + rw.start_time.second
+                        for rw in rows], dtype=np.int64)
 
-    def _search_for_next(rec):
+    tod_order = np.argsort(all_tod, kind='mergesort')
+    tod_sorted = all_tod[tod_order]
+
+    def _search_for_next(rec_dt):
         """
-        Internal function to find the next_in_stream from the db. Only needed
-        when the sort order from the records set doesn't provide a matching
-        next_in_stream.
+        Internal function to find the next_in_stream from the time of day
+        index. Only needed when the sort order from the records set doesn't
+        provide a matching next_in_stream.
 
         Returns:
             The db.audio.id of the next_in_stream
         """
 
-        # get the similarity time window as a where condition allowing
+        # get the recordings in the similarity time window allowing
         # for wrapping at midnight
-        sim_min = (rec.record_datetime - window).time()
-        sim_max = (rec.record_datetime + window).time()
+        sim_min = (rec_dt - window) % 86400
+        sim_max = (rec_dt + window) % 86400
+
+        lower = np.searchsorted(tod_sorted, sim_min, side='right')
+        upper = np.searchsorted(tod_sorted, sim_max, side='left')
 
         if sim_min < sim_max:
-            sim_where = ((current.db.audio.start_time > sim_min) &
-                         (current.db.audio.start_time < sim_max))
+            candidates = tod_order[lower:upper]
         else:
-            sim_where = ((current.db.audio.start_time > sim_min) |
-                         (current.db.audio.start_time < sim_max))
+            candidates = np.concatenate((tod_order[lower:], tod_order[:upper]))
 
-        # search the current.db for the next later recording within the similarity window
-        later = current.db((current.db.audio.site_id == site_id) &
-                           (current.db.audio.record_datetime > rec.record_datetime) &
-                           sim_where).select(orderby=current.db.audio.record_datetime)
+        cand_dt = all_dt[candidates]
 
-        if later:
-            return later[0].id
-        else:
-            # if no later recordings in the slot, look for an earlier one
-            earlier = current.db((current.db.audio.site_id == site_id) &
-                                 (current.db.audio.record_datetime < rec.record_datetime) &
-                                 sim_where).select(orderby=~current.db.audio.record_datetime)
-            if earlier:
-                return earlier[0].id
-            else:
-                return None
+        # look for the next later recording within the similarity window
+        later = cand_dt > rec_dt
+        if later.any():
+            return int(all_ids[candidates[later][np.argmin(cand_dt[later])]])
+
+        # if no later recordings in the slot, look for an earlier one
+        earlier = cand_dt < rec_dt
+        if earlier.any():
+            return int(all_ids[candidates[earlier][np.argmax(cand_dt[earlier])]])
+
+        return None
+
+    rec_dt = [(rw.record_datetime - epoch).total_seconds() for rw in records]
+    next_in_stream = {}
 
     # Now identify next_in_stream for each record
-    for this_rec, next_rec in pairwise(records):
+    for idx in range(len(records) - 1):
 
         # get the time to the next recording
-        delta = next_rec.record_datetime - this_rec.record_datetime
+        delta = rec_dt[idx + 1] - rec_dt[idx]
 
-        if delta.total_seconds() < max_delay:
+        if delta < max_delay:
             # the next record in ascending record datetime is within the max delay
             # of the current record, so call that next in stream
-            this_rec.update_record(next_in_stream=next_rec.id)
+            next_in_stream[records[idx].id] = records[idx + 1].id
         else:
-            this_rec.update_record(next_in_stream=_search_for_next(this_rec))
+            next_in_stream[records[idx].id] = _search_for_next(rec_dt[idx])
 
     # handle the last record, which will be the most recent at the site
-    next_rec.update_record(next_in_stream=_search_for_next(next_rec))
+    next_in_stream[records[-1].id] = _search_for_next(rec_dt[-1])
 
-    return None
+    # write back the changed values
+    changed = {rw.id: next_in_stream[rw.id] for rw in records
+               if rw.next_in_stream != next_in_stream[rw.id]}
+
+    _update_next_in_stream(changed)
 
-def index_day_streams():
+    return len(changed)
+
+
+def _update_next_in_stream(next_in_stream, batch_size=500):
+    """
+    Writes next_in_stream values to the audio table using a single UPDATE
+    with a CASE expression for each batch of records.
+
+    Parameters:
+        next_in_stream (dict): next_in_stream values keyed by audio id
+        batch_size (int): the number of records to update in each statement
+    """
+
+    db = current.db
+
+    items = sorted(next_in_stream.items())
+
+    for start in range(0, len(items), batch_size):
+
+        batch = items[start:start + batch_size]
+
+        cases = ' '.join('WHEN {} THEN {}'.format(int(audio_id), 'NULL' if nxt is None else int(nxt))
+                         for audio_id, nxt in batch)
+        ids = ', '.join(str(int(audio_id)) for audio_id, _ in batch)
+
+        db.executesql('UPDATE {0} SET next_in_stream = CASE id {1} END WHERE id IN ({2});'.format(
+            db.audio._tablename, cases, ids))
+
+
+def index_day_streams(full_rebuild=False, site_ids=None):
 
     """
     Populates the day streams index - this is part of the large api_response
@@ -463,108 +547,267 @@ def index_day_streams():
     payload will change slowly - basically when new audio is loaded - so
     saving this information in the database avoids a lot of overhead.
 
-    This index generates a 72-list (assuming 20 minute recordings) of the
-    sequence of audio files to play for each day and site combination.
+    This index generates a list of the sequence of audio files to play for
+    each day and site combination, with one slot per time window: 72 slots
+    with the default 20 minute window width.
 
-    :return:
-    """
+    The index is updated incrementally: only sites that have received new
+    audio since the last run are indexed and only the streams for days that
+    have changed - new days and days whose gaps are now filled from new
+    audio - are updated in place. The window width and the last audio id
+    indexed are stored in the app_state table.
 
-    # TODO  - This feels really clumsy and over the top, but not thinking
-    #         too well at the moment
+    :param full_rebuild: Delete and rebuild the streams for all sites.
+    :param site_ids: An iterable of site ids whose streams should be rebuilt
+        in full, for example following changes to deployments.
+    :return: A string reporting the number of streams updated.
+    """
 
     db = current.db
 
-    for site in db(db.sites).select():
+    window_width = int(current.myconf.take('audio.window_width'))
+    last_audio_id = get_state('audio_streams.last_audio_id', 0)
+
+    max_id = db.audio.id.max()
+    max_id = db(db.audio).select(max_id).first()[max_id] or 0
 
-        audio = db(db.audio.site_id == site.id).select(db.audio.id,
-                                                       db.audio.time_window,
-                                                       db.audio.site_id,
-                                                       db.audio.record_datetime)
+    # A change in the window width changes every stream
+    if get_state('audio_streams.window_width') != window_width:
+        full_rebuild = True
 
-        # Convert that data into a matrix of ndays x 72 using pandas
-        # to turn the db tuples into a dataframe of indices
-        audio = pandas.DataFrame.from_records(audio.as_list())
-        audio['date'] = audio.record_datetime.apply(datetime.date.toordinal)
+    # Get a dictionary of sites to index, giving the audio id from which each
+    # site has received new audio.
+    if full_rebuild:
+        db(db.audio_streams).delete()
+        sites = {rw.id: 0 for rw in db(db.sites).select(db.sites.id)}
+    else:
+        new_audio = db((db.audio.id > last_audio_id) &
+                       (db.audio.site_id != None)).select(db.audio.site_id, distinct=True)
+        sites = {rw.site_id: last_audio_id for rw in new_audio}
+        if site_ids is not None:
+            sites.update({sid: 0 for sid in site_ids})
+
+    n_streams = 0
+
+    for site_id, since_id in sites.iteritems():
+        n_streams += _index_site_day_streams(site_id, since_id)
 
-        # get the matrix size
-        day_one = audio.date.min()
-        nrow = audio.date.max() - day_one + 1
-        audio['day_index'] = audio['date'] - day_one
+    set_state('audio_streams.last_audio_id', max_id)
+    set_state('audio_streams.window_width', window_width)
 
-        # create the matrix, insert the data and remove completely empty
-        # days, noting the date of retained rows
-        audio_matrix = np.zeros((nrow, 72), dtype=np.uint16)
-        audio_matrix[audio.day_index, audio.time_window] = audio.id
-        ordinal_days = np.arange(0, nrow) + day_one
-        non_empty_days = (audio_matrix > 0).sum(axis=1) > 0
+    return "Day streams updated: {} streams at {} sites".format(n_streams, len(sites))
 
-        audio_matrix = audio_matrix[non_empty_days, ]
-        ordinal_days = ordinal_days[non_empty_days]
-        nrow = non_empty_days.sum()
 
-        # now we slide one copy of the matrix up and down another padded
-        # copy filling in gaps.
-        audio_pad = np.pad(audio_matrix, ((nrow, nrow), (0, 0)), 'constant')
+def _day_matrix(audio, n_slots, id_dtype):
 
-        offsets = np.repeat(np.arange(1, nrow), 2) * np.tile((1, -1), nrow - 1)
+    """
+    Converts a dataframe of the audio at a site into a matrix of ndays x
+    n_slots, removes empty days and fills empty slots in each day from
+    nearby days.
+
+    :param audio: A pandas dataframe of audio ids, time windows and dates
+    :param n_slots: The number of time windows in a day
+    :param id_dtype: A numpy integer dtype able to hold the audio ids
+    :return: A tuple of an array of ordinal days and a matrix of audio ids
+    """
 
-        for offset in offsets:
+    import numpy as np
 
-            audio_matrix = np.where(audio_matrix == 0,
-                                    audio_pad[(nrow + offset):(nrow * 2 + offset), :],
-                                    audio_matrix)
+    if not len(audio):
+        return np.array([], dtype=int), np.zeros((0, n_slots), dtype=id_dtype)
 
-        # audio_matrix will now contain a full set of recordings, except
-        # where there is no recording at all in a slot, in which case we just
-        # repeat the same recording (hack).
+    # get the matrix size
+    day_one = audio.date.min()
+    nrow = audio.date.max() - day_one + 1
+    day_index = audio['date'] - day_one
 
-        for idx in np.arange(nrow):
+    # create the matrix, insert the data and remove completely empty
+    # days, noting the date of retained rows
+    audio_matrix = np.zeros((nrow, n_slots), dtype=id_dtype)
+    audio_matrix[day_index, audio.time_window] = audio.id
+    ordinal_days = np.arange(0, nrow) + day_one
+    non_empty_days = (audio_matrix > 0).sum(axis=1) > 0
 
-            this_stream = db(db.audio.id.belongs(audio_matrix[idx, :])
-                             ).select(orderby=db.audio.time_window)
+    audio_matrix = audio_matrix[non_empty_days, ]
+    ordinal_days = ordinal_days[non_empty_days]
 
-            this_stream = [{'audio': row.id,
-                            'box_id': row.box_id,
-                            'date': row.record_datetime.date().isoformat(),
-                            'time': row.record_datetime.time().isoformat(),
-                            'site': row.site_id} for row in this_stream]
+    # fill in gaps from the nearest day with a recording in each slot
+    audio_matrix = _fill_day_matrix(audio_matrix)
 
-            db.audio_streams.insert(site=site.id,
-                                    stream_date=datetime.date.fromordinal(ordinal_days[idx]),
-                                    stream_data=this_stream)
+    # audio_matrix will now contain a full set of recordings, except
+    # where there is no recording at all in a slot, in which case we just
+    # repeat the same recording (hack).
 
+    return ordinal_days, audio_matrix
 
-def make_thumb(image_id, table='site_images', size=(150, 150)):
 
+def _fill_day_matrix(audio_matrix):
+
+    """
+    Fills the empty (zero) slots in a matrix of days by slots using the
+    recording in the same slot from the nearest day that has one. Where
+    the nearest days before and after are equally distant, the later day
+    is used. This matches searching alternately one day later, one day
+    earlier, two days later and so on, but runs in linear time: the index
+    of the last filled day at or before each day and the first filled day
+    at or after each day are propagated down each column using cumulative
+    maxima and the nearer of the two is used.
+
+    :param audio_matrix: A 2D numpy array of audio ids, with zero for gaps
+    :return: A filled copy of audio_matrix
     """
-    Takes a record number and a table name and inserts a thumbnail of
-    the 'image' field in the table into the 'thumb' field.
 
-    :param image_id: A record id
-    :param table: The name of a table containing image and thumb fields
-    :param size: The resolution of the thumbnail
-    :return: None
+    import numpy as np
+
+    nrow = audio_matrix.shape[0]
+
+    if nrow < 2:
+        return audio_matrix.copy()
+
+    filled = audio_matrix != 0
+    rows = np.arange(nrow)[:, None]
+
+    # index of the nearest filled day at or before each day, -1 if none
+    before = np.maximum.accumulate(np.where(filled, rows, -1), axis=0)
+
+    # index of the nearest filled day at or after each day, found by running
+    # the same accumulation up the reversed rows: nrow if none
+    after = np.maximum.accumulate(np.where(filled[::-1], rows, -1), axis=0)[::-1]
+    after = (nrow - 1) - after
+
+    # choose the nearer day, with ties going to the later day
+    use_after = (after < nrow) & ((before < 0) | ((after - rows) <= (rows - before)))
+    source = np.where(use_after, after, before)
+
+    cols = np.broadcast_to(np.arange(audio_matrix.shape[1]), audio_matrix.shape)
+    fill = audio_matrix[np.clip(source, 0, nrow - 1), cols]
+    fill[source < 0] = 0
+
+    return np.where(filled, audio_matrix, fill)
+
+
+def _index_site_day_streams(site_id, since_id=0):
+
+    """
+    Updates the day streams for a single site. The matrix of day streams
+    is calculated with and without the audio added since since_id, and only
+    days where the streams differ are written to the database, updating
+    existing rows. If since_id is zero, all of the streams for the site
+    are rewritten.
+
+    :param site_id: The id of the site to index
+    :param since_id: The last audio id included in the existing streams
+    :return: The number of streams written
     """
 
-    # Get the record for the image id
-    record = current.db(current.db[table].id == image_id).select().first()
+    import numpy as np
+    import pandas
+
+    db = current.db
+
+    # Get all the audio for the site in a single query, keeping the
+    # rows by id to build the stream data.
+    rows = db((db.audio.site_id == site_id) &
+              (db.audio.time_window != None)).select(db.audio.id,
+                                                     db.audio.time_window,
+                                                     db.audio.record_datetime,
+                                                     db.audio.box_id,
+                                                     orderby=db.audio.id)
 
-    # Get the image from the table and resize it
-    nm, file_obj = current.db[table].image.retrieve(record.image)
-    im = Image.open(file_obj)
-    im.thumbnail(size, Image.ANTIALIAS)
+    audio_by_id = {row.id: row for row in rows}
 
-    # Save that Image object to a file-like object
-    outfile = io.BytesIO()
-    im.save(outfile, im.format)
-    outfile.seek(0)
+    # Convert that data into a dataframe of indices
+    audio = pandas.DataFrame.from_records([(row.id, row.time_window, row.record_datetime) for row in rows],
+                                          columns=['id', 'time_window', 'record_datetime'])
+    audio['date'] = audio.record_datetime.apply(datetime.date.toordinal)
 
-    # Store the image file using the Field methods and then update the record
-    outname = current.db[table].thumb.store(outfile, nm)
-    record.update_record(thumb=outname)
+    # Size the matrix from the window width and use an integer type that can
+    # hold the largest audio id - ids wrap silently if the type is too small
+    window_width = int(current.myconf.take('audio.window_width'))
+    n_slots = -(-24 * 60 * 60 // window_width)
+    id_dtype = np.min_scalar_type(int(audio.id.max())) if len(audio) else np.uint8
+
+    ordinal_days, audio_matrix = _day_matrix(audio, n_slots, id_dtype)
+
+    # Find the days that have changed since the last indexing
+    if since_id:
+        old_days, old_matrix = _day_matrix(audio[audio.id <= since_id], n_slots, id_dtype)
+        old_streams = dict(zip(old_days, old_matrix))
+        changed = [idx for idx, day in enumerate(ordinal_days)
+                   if day not in old_streams or not np.array_equal(old_streams[day], audio_matrix[idx, :])]
+    else:
+        changed = range(len(ordinal_days))
+
+    # Get the existing stream rows for the site by date
+    existing = {}
+    for row in db(db.audio_streams.site == site_id).select(db.audio_streams.id,
+                                                          db.audio_streams.stream_date,
+                                                          orderby=db.audio_streams.id):
+        existing.setdefault(row.stream_date, []).append(row.id)
+
+    # A full reindex of the site removes any streams for days no longer present
+    if not since_id:
+        current_days = {datetime.date.fromordinal(day) for day in ordinal_days}
+        stale = [row_id for day, row_ids in existing.iteritems()
+                 if day not in current_days for row_id in row_ids]
+        db(db.audio_streams.id.belongs(stale)).delete()
+
+    for idx in changed:
+
+        # Build the stream in slot order, keeping the repeated recordings
+        # used to fill gaps and skipping slots with no recordings at all.
+        this_stream = [audio_by_id[int(audio_id)] for audio_id in audio_matrix[idx, :] if audio_id]
+
+        this_stream = [{'audio': row.id,
+                        'box_id': row.box_id,
+                        'date': row.record_datetime.date().isoformat(),
+                        'time': row.record_datetime.time().isoformat(),
+                        'site': site_id} for row in this_stream]
+
+        stream_date = datetime.date.fromordinal(ordinal_days[idx])
+
+        # Upsert the stream, removing any duplicates left by earlier versions of
+        # the indexing, which appended streams on every run.
+        if stream_date in existing:
+            keep = existing[stream_date][0]
+            db(db.audio_streams.id == keep).update(stream_data=this_stream)
+            db(db.audio_streams.id.belongs(existing[stream_date][1:])).delete()
+        else:
+            db.audio_streams.insert(site=site_id,
+                                    stream_date=stream_date,
+                                    stream_data=this_stream)
 
+    return len(changed)
 
-def api_response():
+
+def random_taxon_sounds(taxon_ids, rng=random):
+    """
+    Chooses a random GBIF sound occurrence for each of a set of taxa. All
+    of the sound occurrences for the taxa are fetched in a single query
+    and grouped by taxon, rather than using a random ordered query for
+    each taxon.
+
+    :param taxon_ids: A list of taxon ids
+    :param rng: A random number generator, such as random.Random(seed)
+    :return: A dictionary of gbif_sound_occurrences rows keyed by taxon id
+    """
+
+    db = current.db
+
+    # Order the rows so that a seeded generator gives reproducible choices
+    rows = db(db.gbif_sound_occurrences.taxon_id.belongs(taxon_ids)
+              ).select(db.gbif_sound_occurrences.taxon_id,
+                       db.gbif_sound_occurrences.gbif_occurrence_rights_holder,
+                       db.gbif_sound_occurrences.gbif_occurrence_key,
+                       db.gbif_sound_occurrences.gbif_media_identifier,
+                       db.gbif_sound_occurrences.gbif_occurrence_behavior,
+                       orderby=[db.gbif_sound_occurrences.taxon_id,
+                                db.gbif_sound_occurrences.id])
+
+    return {key: rng.choice(list(group)) for key, group in groupby(rows, lambda x: x.taxon_id)}
+
+
+def api_response(seed=None):
     
     """
     Implementation of Aaron's 'mega' API to populate the front end with a single
@@ -575,12 +818,20 @@ def api_response():
 
     See static/api_response.ts for description
 
+    :param seed: An optional seed for the random choice of site images and
+        taxon sounds, so that a response can be reproduced.
     :return:
         A JSON object containing all the data needed to populate the front end.
     """
     
     db = current.db
     myconf = current.myconf
+    rng = random.Random(seed)
+
+    # The payload is also rendered by scheduler tasks, where the request host
+    # is not the public one, so links use the configured host.
+    scheme = myconf.take('app.scheme')
+    host = myconf.take('app.host')
     
     # TimeSegment: Array of hour indexing strings used client side
     time_segments = [datetime.time(hour=hr).strftime('%H:%M') for hr in range(0, 24)]
@@ -620,30 +871,30 @@ def api_response():
         habitats[key] = [g['image'] for g in group]
 
     for site in sites_by_id.values():
-        site['photo'] = {ky:  URL('download', random.choice(habitats[site['habitat']]), scheme=True, host=True)
+        site['photo'] = {ky:  URL('download', rng.choice(habitats[site['habitat']]), scheme=scheme, host=host)
                          for ky in time_segments}
 
     # -----------------
     # taxaById
     # - This uses the curated image stored in the taxon table but a random
     #   selection from one of the gbif sound occurrences.
-    #   TODO - At the moment this is done with a clumsy loop - can't figure out
-    #          how to get a left join to return a random row.
     # -----------------
 
     # get taxon dictionaries
     taxa_rows = db((db.taxa.image != None) |
                    (db.taxa.gbif_media_identifier != None)).select()
 
-    # package curated image in dictionary and get a random sound
-    # (currently using many queries)
+    # get a random sound for each taxon
+    sounds = random_taxon_sounds([taxon.id for taxon in taxa_rows], rng)
+
+    # package curated image in dictionary
     taxa_by_id = {}
 
     for taxon in taxa_rows:
 
         # images
         if taxon.image_is_local:
-            img_media_url = URL('download', taxon.image, scheme=True, host=True)
+            img_media_url = URL('download', taxon.image, scheme=scheme, host=host)
             img_gbif_rights_holder = None
             img_gbif_occurrence_key = None
         else:
@@ -651,8 +902,7 @@ def api_response():
             img_gbif_rights_holder = taxon.gbif_media_creator
             img_gbif_occurrence_key = taxon.gbif_occurrence_key
 
-        # get a random sound
-        audio = taxon.gbif_sound_occurrences.select(limitby=(0,1), orderby='<random>').first()
+        audio = sounds.get(taxon.id)
 
         if audio is not None:
             audio_gbif_rights_holder = audio.gbif_occurrence_rights_holder
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Shared cache module.
+
+The web2py cache.ram store is held in each worker process, so with several
+workers every process repeats expensive work, such as authenticating the
+Box client and downscoping the download token. This module provides a small
+cache interface with two backends:
+
+- DiskCache, which stores JSON values in the application cache folder and
+  uses file locks, so that all workers on a host share the values and only
+  one worker recreates an expired value.
+- LocalCache, an in-process stand-in with the same interface, used when
+  workers do not need to share values or when testing.
+
+Values must be JSON serialisable and each value is stored with an absolute
+expiry time, so that the expiry can come from the value itself (such as the
+expires_in of a token) rather than a fixed lifetime. The backend is chosen
+using the cache.backend setting in appconfig.json.
+'''
+
+import os
+import json
+import time
+import threading
+
+from gluon import current
+from gluon import portalocker
+
+
+class LocalCache(object):
+
+    """
+    An in-process cache of values with absolute expiry times.
+    """
+
+    def __init__(self):
+
+        self._values = {}
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        """
+        Gets a value from the cache.
+
+        :param key: The cache key
+        :return: The value or None if it is missing or has expired
+        """
+
+        with self._lock:
+            entry = self._values.get(key)
+
+        if entry is None or entry[0] <= time.time():
+            return None
+
+        return entry[1]
+
+    def set(self, key, value, expires_at):
+        """
+        Stores a value in the cache.
+
+        :param key: The cache key
+        :param value: A JSON serialisable value
+        :param expires_at: The expiry time as seconds since the epoch
+        """
+
+        with self._lock:
+            self._values[key] = (expires_at, value)
+
+    def get_or_create(self, key, creator):
+        """
+        Gets a value from the cache, creating it if it is missing or has
+        expired. The lock is held while the value is created, so concurrent
+        callers wait for a single creation rather than repeating it.
+
+        :param key: The cache key
+        :param creator: A function returning a tuple of the value and its
+            expiry time as seconds since the epoch
+        :return: The value
+        """
+
+        with self._lock:
+            value = self.get(key)
+
+            if value is None:
+                value, expires_at = creator()
+                self.set(key, value, expires_at)
+
+        return value
+
+
+class DiskCache(LocalCache):
+
+    """
+    A cache of values shared between processes using files in a folder.
+    Each key has a JSON file holding the expiry time and value and a lock
+    file used to serialise creation of the value. Files are replaced
+    atomically, so readers never need to take the lock. The values include
+    access tokens, so the folder and files are only readable by the owner
+    and expired files are removed when they are read.
+
+    :param folder: The folder used to store the cache files
+    """
+
+    def __init__(self, folder):
+
+        super(DiskCache, self).__init__()
+
+        if not os.path.exists(folder):
+            os.makedirs(folder, 0o700)
+
+        self.folder = folder
+
+    def _path(self, key):
+
+        return os.path.join(self.folder, key + '.json')
+
+    def get(self, key):
+
+        path = self._path(key)
+
+        try:
+            with open(path, 'r') as infile:
+                expires_at, value = json.load(infile)
+                read_stat = os.fstat(infile.fileno())
+        except (IOError, ValueError):
+            return None
+
+        if expires_at <= time.time():
+            # Remove the expired file, unless another worker has already
+            # replaced it with a new value
+            try:
+                path_stat = os.stat(path)
+                if (path_stat.st_ino, path_stat.st_mtime) == (read_stat.st_ino, read_stat.st_mtime):
+                    os.remove(path)
+            except OSError:
+                pass
+
+            return None
+
+        return value
+
+    def set(self, key, value, expires_at):
+
+        path = self._path(key)
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+
+        # Create the file readable by the owner only, whatever the umask
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as outfile:
+            json.dump([expires_at, value], outfile)
+
+        os.rename(tmp_path, path)
+
+    def get_or_create(self, key, creator):
+
+        value = self.get(key)
+
+        if value is not None:
+            return value
+
+        # Take the thread lock and then the file lock, and check again in
+        # case another worker created the value while this one waited.
+        with self._lock:
+            with open(os.path.join(self.folder, key + '.lock'), 'ab') as lock_file:
+                portalocker.lock(lock_file, portalocker.LOCK_EX)
+                try:
+                    value = self.get(key)
+
+                    if value is None:
+                        value, expires_at = creator()
+                        self.set(key, value, expires_at)
+                finally:
+                    portalocker.unlock(lock_file)
+
+        return value
+
+
+# The cache instance for this process
+_cache = []
+
+
+def get_shared_cache():
+    """
+    Gets the shared cache for this process, creating it using the
+    cache.backend setting, which can be 'disk' or 'local'.
+
+    :return: A DiskCache or LocalCache instance
+    """
+
+    if not _cache:
+
+        backend = current.myconf.take('cache.backend')
+
+        if backend == 'disk':
+            _cache.append(DiskCache(os.path.join(current.request.folder, 'cache', 'shared')))
+        elif backend == 'local':
+            _cache.append(LocalCache())
+        else:
+            raise ValueError('Unknown cache backend: {}'.format(backend))
+
+    return _cache[0]
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Start data module.
+
+Loads the example admin user, sites, deployments, taxa, taxon observations
+and site images into an empty database. Web2py runs every model file on
+every request, so rather than checking the tables each time, the loader is
+run once by the zzz_load_start_data model when the seeded marker file is
+missing from the databases folder and the marker is written once the data
+has been committed. Deleting the marker reruns the loader, which only fills
+tables that are empty.
+
+A file lock stops several workers from seeding the database at the same
+time when they start together. Thumbnails of the loaded images are created
+by a queued scheduler task.
+'''
+
+import os
+import csv
+import glob
+import datetime
+
+from gluon import current
+from gluon import portalocker
+
+from thumbnails import queue_thumbnails
+
+SEEDED_MARKER = 'start_data.seeded'
+
+SITES = [{'site_name': "E100_edge", 'latitude': 4.68392, 'longitude': 117.58604, 'habitat': "Logged Fragment"},
+         {'site_name': "D100_641", 'latitude': 4.71129, 'longitude': 117.58753, 'habitat': "Logged Fragment"},
+         {'site_name': "C10_621", 'latitude': 4.71118, 'longitude': 117.61899, 'habitat': "Logged Fragment"},
+         {'site_name': "B10", 'latitude': 4.72747, 'longitude': 117.61433, 'habitat': "Logged Fragment"},
+         {'site_name': "E1_648", 'latitude': 4.693722, 'longitude': 117.581175, 'habitat': "Logged Fragment"},
+         {'site_name': "D_Matrix", 'latitude': 4.70272, 'longitude': 117.59141, 'habitat': "Cleared Forest"},
+         {'site_name': "C_Matrix", 'latitude': 4.71011, 'longitude': 117.61071, 'habitat': "Cleared Forest"},
+         {'site_name': "Riparian_1", 'latitude': 4.65041, 'longitude': 117.54203, 'habitat': "Riparian Reserve"},
+         {'site_name': "Riparian_2", 'latitude': 4.65278, 'longitude': 117.54653, 'habitat': "Riparian Reserve"},
+         {'site_name': "VJR_1", 'latitude': 4.664433, 'longitude': 117.535133, 'habitat': "Old Growth"},
+         {'site_name': "VJR_2", 'latitude': 4.66803, 'longitude': 117.53897, 'habitat': "Old Growth"},
+         {'site_name': "B1_602", 'latitude': 4.72834, 'longitude': 117.62350, 'habitat': "Logged Fragment"},
+         {'site_name': "OP3_843", 'latitude': 4.64005, 'longitude': 117.45265, 'habitat': "Oil Palm"},
+         # {'site_name':"OP Young", 'latitude': 4.63707, 'longitude': 117.52016,'habitat': "Oil Palm"}
+         {'site_name': "OP_Belian", 'latitude': 4.63707, 'longitude': 117.52016, 'habitat': "Oil Palm"}]
+
+DEPLOYMENTS = [["B10",        10, "16/10/2018",  "RPiID-00000000c0e3c6fc"],
+               ["E1_648",      5, "17/10/2018",  "RPiID-00000000ef3410fd"],
+               ["E100_edge",  13, "17/10/2018",  "RPiID-000000005ec3ba66"],
+               ["C10_621",    10, "18/10/2018",  "RPiID-000000005ee4697b"],
+               ["VJR_1",      30, "26/10/2018",  "RPiID-0000000075818774"],
+               ["VJR_2",       5, "19/10/2018",  "RPiID-000000006cb9d2cb"],
+               ["Riparian_1", 17, "26/10/2018",  "RPiID-0000000094cecfb7"],
+               ["Riparian_2", 16, "23/10/2018",  "RPiID-000000009b618d6d"],
+               ["D100_641",    7, "22/10/2018",  "RPiID-000000008acc6628"],
+               ["D_Matrix",   10, "22/10/2018",  "RPiID-00000000823f6bbd"]]
+
+
+def is_seeded():
+    """
+    Checks for the seeded marker file, without querying the database.
+
+    :return: A boolean
+    """
+
+    return os.path.exists(os.path.join(current.request.folder, 'databases', SEEDED_MARKER))
+
+
+def seed_start_data(habitats):
+    """
+    Loads the start data into any empty tables, holding a file lock so
+    that only one process seeds the database, and then writes the seeded
+    marker file.
+
+    :param habitats: The list of habitats with site image folders
+    :return: A string reporting the rows loaded
+    """
+
+    marker = os.path.join(current.request.folder, 'databases', SEEDED_MARKER)
+
+    with open(marker + '.lock', 'ab') as lock_file:
+        portalocker.lock(lock_file, portalocker.LOCK_EX)
+        try:
+            # Another process may have seeded while this one waited
+            if os.path.exists(marker):
+                return ""
+
+            report = load_start_data(habitats)
+            current.db.commit()
+
+            with open(marker, 'w') as marker_file:
+                marker_file.write(datetime.datetime.now().isoformat())
+        finally:
+            portalocker.unlock(lock_file)
+
+    return report
+
+
+def load_start_data(habitats):
+    """
+    Loads the start data into any empty tables. Each table is loaded with a
+    single bulk_insert, using in memory lookups of site and taxon ids by name.
+
+    :param habitats: The list of habitats with site image folders
+    :return: A string reporting the rows loaded
+    """
+
+    db = current.db
+    folder = current.request.folder
+    report = ""
+
+    # Example admin user - password generated using:
+    # str(db.auth_user.password.validate(string)[0])
+    if db(db.auth_user).count() == 0:
+        db.auth_user.insert(first_name='Admin',
+                            last_name='Admin',
+                            username='admin',
+                            email='d.orme@imperial.ac.uk',
+                            password='pbkdf2(1000,20,sha512)$b0a46bad495e614a$5f1fde78956bc7f5fd4bc00e0443c019a70f9ee7')
+        report += "Admin user created\n"
+
+    if db(db.sites).count() == 0:
+        db.sites.bulk_insert(SITES)
+        report += "{} sites loaded\n".format(len(SITES))
+
+    sites = {rw.site_name: rw.id for rw in db(db.sites).select(db.sites.id, db.sites.site_name)}
+
+    if db(db.deployments).count() == 0:
+
+        deployed_to = datetime.datetime.strptime("31/12/2020", '%d/%m/%Y')
+        data = [dict(recorder_id=recid,
+                     site_id=sites[nm],
+                     deployed_from=datetime.datetime.strptime(start, '%d/%m/%Y'),
+                     deployed_to=deployed_to,
+                     deployed_by='Sarab Sethi',
+                     height=hght)
+                for nm, hght, start, recid in DEPLOYMENTS]
+
+        db.deployments.bulk_insert(data)
+        report += "{} deployments loaded\n".format(len(data))
+
+    # Load taxon details and Shutterstock imagery provided by Aaron Signorelli
+    if db(db.taxa).count() == 0:
+
+        taxon_csv = os.path.join(folder, 'private', 'taxa', 'taxa_with_images.csv')
+
+        with open(taxon_csv, 'r') as csv_file:
+            taxon_data = list(csv.DictReader(csv_file))
+
+        data = []
+
+        for taxon in taxon_data:
+
+            row = {ky: vl for ky, vl in taxon.iteritems() if ky in db.taxa.fields}
+
+            if taxon['file']:
+                img_in = os.path.join(folder, 'private', 'taxa', 'shutterstock_imagery', taxon['file'])
+                with open(img_in, 'rb') as img_file:
+                    row['image'] = db.taxa.image.store(img_file, taxon['file'])
+                row['image_is_local'] = True
+            else:
+                row['image_is_local'] = False
+
+            data.append(row)
+
+        ids = db.taxa.bulk_insert(data)
+        queue_thumbnails('taxa', [rec for rec, row in zip(ids, data) if row['image_is_local']])
+
+        report += "{} taxa loaded\n".format(len(ids))
+
+    if db(db.taxon_observations).count() == 0:
+
+        taxa = {rw.scientific_name: rw.id for rw in db(db.taxa).select(db.taxa.id, db.taxa.scientific_name)}
+        obs_csv = os.path.join(folder, 'private', 'taxa', 'taxon_observations.csv')
+
+        with open(obs_csv, 'r') as csv_file:
+            data = [dict(taxon_id=taxa[obs['scientific_name']],
+                         site_id=sites[obs['site']],
+                         obs_time=obs['time'],
+                         obs_hour=datetime.datetime.strptime(obs['time'], '%H:%M').hour)
+                    for obs in csv.DictReader(csv_file) if obs['site'] in sites]
+
+        db.taxon_observations.bulk_insert(data)
+        report += "{} taxon observations loaded\n".format(len(data))
+
+    if db(db.site_images).count() == 0:
+
+        data = []
+
+        for habitat in habitats:
+
+            hab_dir = os.path.join(folder, 'private', 'site_images_small', habitat)
+
+            for image in glob.glob(hab_dir + '/*'):
+                with open(image, 'rb') as img_file:
+                    img_st = db.site_images.image.store(img_file, image)
+                data.append(dict(name=image, image=img_st, habitat=habitat))
+
+        ids = db.site_images.bulk_insert(data)
+        queue_thumbnails('site_images', ids)
+
+        report += "{} site images loaded\n".format(len(ids))
+
+    return report
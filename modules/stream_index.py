@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Stream index module.
+
+Holds an in memory index of the recordings at each site, sorted by time of
+day, used to pick a random recording for the shuffle option of stream_get
+without selecting every candidate row. The index is rebuilt when the
+api_response payload version changes, which happens after each scan and
+admin edit, so all workers pick up new audio at the same point. Checking
+the version only needs a stat of the payload pointer file and does not
+render a payload if there is none.
+'''
+
+import bisect
+import random
+
+from gluon import current
+
+import api_payload
+
+# Whether the index has been built, the payload version it was built for
+# and a dictionary by site of a tuple of sorted start seconds and matching
+# audio ids
+_index = {'built': False, 'version': None, 'sites': {}}
+
+
+def _build_index():
+    """
+    Loads the start time and id of all the sufficiently long recordings
+    at each site using a single query.
+
+    :return: A dictionary keyed by site id of lists of start seconds and ids
+    """
+
+    db = current.db
+
+    min_size = int(current.myconf.take('audio.min_size'))
+    rows = db((db.audio.site_id != None) &
+              (db.audio.file_size > min_size) &
+              (db.audio.start_second != None)).select(db.audio.site_id,
+                                                      db.audio.start_second,
+                                                      db.audio.id,
+                                                      orderby=[db.audio.site_id,
+                                                               db.audio.start_second,
+                                                               db.audio.id])
+
+    sites = {}
+
+    for row in rows:
+        seconds, ids = sites.setdefault(row.site_id, ([], []))
+        seconds.append(row.start_second)
+        ids.append(row.id)
+
+    return sites
+
+
+def random_in_window(site_id, time_second, half_width, rng=random):
+    """
+    Picks a random recording at a site with a start time strictly within
+    half_width seconds of a time of day, allowing for wrapping at midnight.
+    This uses two binary searches on the site index and then a single
+    random choice from the matching range.
+
+    :param site_id: The site id
+    :param time_second: The requested time of day in seconds
+    :param half_width: The half width of the similarity window in seconds
+    :param rng: A random number generator
+    :return: An audio id or None if there are no matching recordings
+    """
+
+    version = api_payload.stored_version()
+
+    if not _index['built'] or _index['version'] != version:
+        _index['sites'] = _build_index()
+        _index['version'] = version
+        _index['built'] = True
+
+    if site_id not in _index['sites']:
+        return None
+
+    seconds, ids = _index['sites'][site_id]
+
+    sim_min = (time_second - half_width) % 86400
+    sim_max = (time_second + half_width) % 86400
+
+    lower = bisect.bisect_right(seconds, sim_min)
+    upper = bisect.bisect_left(seconds, sim_max)
+
+    if sim_min < sim_max:
+        n_match = max(upper - lower, 0)
+        if not n_match:
+            return None
+        return ids[lower + rng.randrange(n_match)]
+
+    # The window wraps around midnight, so matches are at both ends
+    n_late = len(seconds) - lower
+    n_match = n_late + upper
+
+    if not n_match:
+        return None
+
+    choice = rng.randrange(n_match)
+
+    return ids[lower + choice] if choice < n_late else ids[choice - n_late]
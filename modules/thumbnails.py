@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Thumbnail module.
+
+Creates resized copies of the images in the site_images and taxa tables in
+several sizes - the small square thumbnail used in the admin grids and a
+larger card size for the front end - and in JPEG and, if PIL supports it,
+WebP formats. The image files are resized in a pool of processes, as the
+resizing is CPU bound, or a pool of threads when running as a scheduler task.
+
+Thumbnails are saved in the uploads/thumbnails folder using a hash of the
+source image content, so an image that has already been processed is
+skipped and identical images share thumbnails. The hash is stored in the
+thumb_hash field of the record and the admin size JPEG is also stored in the
+thumb upload field, so that the admin grids can use the download action.
+
+Thumbnails are made asynchronously by queueing a make_thumbnails task with
+the scheduler, so uploads and seeding do not wait for the resizing.
+'''
+
+import os
+import io
+import hashlib
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from gluon import current
+
+# The thumbnail sizes by name and the formats and file extensions created
+THUMB_SIZES = [('thumb', (150, 150)),
+               ('card', (480, 360))]
+
+FORMATS = [('JPEG', 'jpg'),
+           ('WEBP', 'webp')]
+
+# The tables with image, thumb and thumb_hash fields
+TABLES = ('site_images', 'taxa')
+
+
+def thumbnail_dir(folder=None):
+    """
+    Gets the folder used to store thumbnails, creating it if needed.
+
+    :param folder: The application folder, defaulting to the current request
+    :return: The path to the thumbnail folder
+    """
+
+    thumb_dir = os.path.join(folder or current.request.folder, 'uploads', 'thumbnails')
+
+    if not os.path.exists(thumb_dir):
+        os.makedirs(thumb_dir)
+
+    return thumb_dir
+
+
+def thumbnail_path(digest, size_name, ext, folder=None):
+    """
+    Gets the path to a thumbnail
+
+    :param digest: The content hash of the source image
+    :param size_name: A size name from THUMB_SIZES
+    :param ext: A file extension from FORMATS
+    :param folder: The application folder, defaulting to the current request
+    :return: The path to the thumbnail file
+    """
+
+    return os.path.join(thumbnail_dir(folder), '{}.{}.{}'.format(digest, size_name, ext))
+
+
+def _render(job):
+    """
+    Creates any missing thumbnails for a source image. This does not use the
+    database, so that it can run in a pool process.
+
+    :param job: A tuple of a record id, the path to the source image and the
+        application folder
+    :return: A tuple of the record id, the content hash of the image and the
+        number of thumbnails created
+    """
+
+    from PIL import Image
+
+    record_id, source, folder = job
+
+    with open(source, 'rb') as infile:
+        content = infile.read()
+
+    digest = hashlib.sha1(content).hexdigest()[:16]
+    resample = Image.LANCZOS if hasattr(Image, 'LANCZOS') else Image.ANTIALIAS
+    image = None
+    n_made = 0
+
+    for size_name, size in THUMB_SIZES:
+        for fmt, ext in FORMATS:
+
+            path = thumbnail_path(digest, size_name, ext, folder)
+
+            if os.path.exists(path):
+                continue
+
+            if image is None:
+                image = Image.open(io.BytesIO(content))
+                if image.mode not in ('RGB', 'L'):
+                    image = image.convert('RGB')
+
+            thumb = image.copy()
+            thumb.thumbnail(size, resample)
+
+            outfile = io.BytesIO()
+
+            try:
+                thumb.save(outfile, fmt, quality=85)
+            except (IOError, KeyError):
+                # This PIL installation cannot write this format
+                continue
+
+            tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+
+            with open(tmp_path, 'wb') as out:
+                out.write(outfile.getvalue())
+
+            os.rename(tmp_path, path)
+            n_made += 1
+
+    return record_id, digest, n_made
+
+
+def make_thumbnails(table, ids=None, processes=None):
+    """
+    Creates the thumbnails for images in a table, using a pool of processes
+    to resize the images, and updates the thumb and thumb_hash fields of
+    the records.
+
+    :param table: One of site_images or taxa
+    :param ids: An optional list of record ids, defaulting to all records
+    :param processes: The number of processes, defaulting to the CPU count
+    :return: A string reporting the thumbnails created
+    """
+
+    db = current.db
+    folder = current.request.folder
+
+    qry = db[table].image != None
+
+    if ids is not None:
+        qry &= db[table].id.belongs(ids)
+
+    rows = db(qry).select(db[table].id, db[table].image, db[table].thumb, db[table].thumb_hash)
+    jobs = [(row.id, db[table].image.retrieve(row.image, nameonly=True)[1], folder) for row in rows]
+
+    # A pool is not worth starting for a single image. Scheduler tasks run
+    # in daemonic processes, which cannot start child processes, so these use
+    # threads instead: PIL releases the GIL while resizing and encoding.
+    if len(jobs) > 1 and processes != 1:
+        if multiprocessing.current_process().daemon:
+            pool = ThreadPool(processes or multiprocessing.cpu_count())
+        else:
+            pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_render, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_render(job) for job in jobs]
+
+    by_id = {row.id: row for row in rows}
+    n_made = 0
+    n_updated = 0
+
+    for record_id, digest, n_record in results:
+
+        n_made += n_record
+        row = by_id[record_id]
+
+        if row.thumb and row.thumb_hash == digest:
+            continue
+
+        name = db[table].image.retrieve(row.image, nameonly=True)[0]
+        name = os.path.splitext(name)[0] + '.jpg'
+
+        with open(thumbnail_path(digest, 'thumb', 'jpg'), 'rb') as thumb_file:
+            thumb = db[table].thumb.store(thumb_file, name)
+
+        db(db[table].id == record_id).update(thumb=thumb, thumb_hash=digest)
+        n_updated += 1
+
+    db.commit()
+
+    return "{}: {} images, {} thumbnails created, {} records updated".format(table, len(jobs), n_made, n_updated)
+
+
+def queue_thumbnails(table, ids):
+    """
+    Queues a scheduler task to create the thumbnails for records.
+
+    :param table: One of site_images or taxa
+    :param ids: A list of record ids
+    """
+
+    current.scheduler.queue_task('make_thumbnails',
+                                 pvars=dict(table=table, ids=list(ids)),
+                                 immediate=True,
+                                 timeout=3600)
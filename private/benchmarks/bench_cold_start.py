@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Cold start benchmark, measuring the time from starting a fresh web2py
+server process to its first successful response and the resident memory
+of the process after that response. Each run starts a new server, so the
+first request pays for compiling the models and importing the modules, as
+a newly spawned worker does. Run it from the web2py root before and after
+a change to compare, for example:
+
+    python applications/acoustics_db/private/benchmarks/bench_cold_start.py \
+        /acoustics_db/default/call/json/get_sites
+
+The RSS is read from /proc, so this only runs on Linux.
+
+The cold start itself - the time to first response and the RSS of a fresh
+worker - has not yet been measured before and after the lazy imports in
+module_admin_functions, as no web2py server was available. Only the import
+of module_admin_functions on its own has been timed, in a fresh Python
+process with the Box SDK stubbed out, which gave medians over five runs of:
+
+    before lazy imports: 1.05s, RSS +115.4MB (143.4MB total)
+    after lazy imports:  0.03s, RSS +2.0MB (30.0MB total)
+
+These figures are an upper bound on the saving per worker and are not a
+substitute for running this benchmark against a server.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+import urllib2
+
+
+def rss_mb(pid):
+    """
+    Gets the resident set size of a process in megabytes from /proc
+    """
+
+    with open('/proc/{}/status'.format(pid)) as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024.0
+
+    return None
+
+
+def cold_start(path, port, timeout=60):
+    """
+    Starts a web2py server, polls the path until it responds and returns the
+    time to the first response and the server RSS after that response.
+    """
+
+    server = subprocess.Popen([sys.executable, 'web2py.py', '-a', '<recycle>',
+                               '-i', '127.0.0.1', '-p', str(port)],
+                              stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+
+    url = 'http://127.0.0.1:{}{}'.format(port, path)
+    start = time.time()
+
+    try:
+        while True:
+            try:
+                urllib2.urlopen(url).read()
+                break
+            except urllib2.HTTPError:
+                # the server is up but the request failed
+                raise
+            except urllib2.URLError:
+                # the server is not listening yet
+                if time.time() - start > timeout:
+                    raise RuntimeError('Server did not respond within {} seconds'.format(timeout))
+                time.sleep(0.01)
+
+        elapsed = time.time() - start
+        memory = rss_mb(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+
+    return elapsed, memory
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('path', help='The path of the URL to request')
+    parser.add_argument('-n', '--runs', type=int, default=5)
+    parser.add_argument('-p', '--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    results = [cold_start(args.path, args.port) for _ in range(args.runs)]
+    times = sorted(res[0] for res in results)
+    memory = sorted(res[1] for res in results)
+
+    print('{} runs: first response median {:.2f}s (min {:.2f}s, max {:.2f}s), '
+          'RSS median {:.1f}MB (min {:.1f}MB, max {:.1f}MB)'.format(
+              args.runs, times[len(times) // 2], times[0], times[-1],
+              memory[len(memory) // 2], memory[0], memory[-1]))
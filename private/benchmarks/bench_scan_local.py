@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the audio scan using the local file storage backend, so that
+the scan can be run offline without Box. A synthetic archive of empty MP3
+files is created in a temporary folder, laid out so that the configured
+box.data_folders path indices apply, with folder names taken from the
+configured folder ids. The scan uses an in-memory SQLite database with the
+table definitions from the model and synthetic sites and deployments.
+
+The benchmark compares the first full scan using a single listing thread
+with the concurrent scan, adding a fixed delay to each page of files listed
+to stand in for the Box search latency, and checks that both add the same
+files. It then checks that a second scan finds no new files and that files
+added after that are found by the next scan, and reports the scan time for
+each folder.
+
+Run from the web2py root using:
+
+    python web2py.py -S acoustics_db -M -R applications/acoustics_db/private/benchmarks/bench_scan_local.py
+"""
+
+import os
+import time
+import shutil
+import datetime
+import tempfile
+
+from gluon import current
+from gluon.dal import DAL, Field
+import audio_scan
+import file_storage
+
+app_db = current.db
+
+N_SITES = 8
+N_DAYS = 60
+FILES_PER_DAY = 24
+START_DATE = datetime.date(2019, 1, 1)
+PAGE_LATENCY = 0.25
+
+
+class SlowStorage(file_storage.LocalStorage):
+
+    """
+    Local storage with a delay for each page of files listed
+    """
+
+    def list_new_files(self, folder_id, since=None, until=None, extensions=('mp3',), page_size=200):
+
+        for idx, stored in enumerate(super(SlowStorage, self).list_new_files(folder_id, since, until,
+                                                                              extensions, page_size)):
+            if idx % page_size == 0:
+                time.sleep(PAGE_LATENCY)
+            yield stored
+
+
+def synthetic_db():
+    """
+    Creates an in-memory database of sites and deployments with empty audio
+    and box_scans tables
+    """
+
+    mem_db = DAL('sqlite:memory')
+
+    for table in ('sites', 'deployments', 'audio', 'box_scans'):
+        mem_db.define_table(table, *[fld.clone() for fld in app_db[table] if fld.name != 'id'])
+
+    mem_db.sites.bulk_insert([{'site_name': 'Site {}'.format(idx), 'habitat': 'Old Growth'}
+                              for idx in range(N_SITES)])
+
+    mem_db.deployments.bulk_insert([{'recorder_id': 'rpi_{}'.format(idx), 'site_id': idx + 1,
+                                     'deployed_from': START_DATE, 'deployed_to': None}
+                                    for idx in range(N_SITES)])
+
+    return mem_db
+
+
+def add_files(root, folder, days, mtime):
+    """
+    Adds empty MP3 files to a data folder of the synthetic archive, placing
+    the recorder or site name and the date at the configured path indices,
+    which count the root folder as index 0.
+
+    :return: The number of files added
+    """
+
+    if folder['deployed']:
+        name_index = folder['pi_index']
+        names = ['rpi_{}'.format(idx) for idx in range(N_SITES)]
+    else:
+        name_index = folder['location_index']
+        names = ['Site {}'.format(idx) for idx in range(N_SITES)]
+
+    n_files = 0
+
+    for name in names:
+        for day in days:
+
+            path = [str(folder['id'])]
+            while len(path) < max(name_index, folder['date_index']):
+                path.append('data')
+
+            path[name_index - 1] = name
+            path[folder['date_index'] - 1] = (START_DATE + datetime.timedelta(days=day)).isoformat()
+
+            local_dir = os.path.join(root, *path)
+            if not os.path.exists(local_dir):
+                os.makedirs(local_dir)
+
+            for hour in range(FILES_PER_DAY):
+                filename = os.path.join(local_dir, '{:02d}-00-00_dur=1200secs.mp3'.format(hour))
+                with open(filename, 'wb') as outfile:
+                    outfile.write(b'\x00' * 128)
+                os.utime(filename, (mtime, mtime))
+                n_files += 1
+
+    return n_files
+
+
+root = tempfile.mkdtemp()
+folders = current.myconf.take('box.data_folders')
+
+try:
+    storage = SlowStorage(root)
+
+    # Files dated over the last two years, so they are all found by the first
+    # scan and are spread across its time slices
+    now = time.time()
+    n_files = sum(add_files(root, folder, range(day, N_DAYS, 10), now - 86400 * (day * 80 + 1))
+                  for folder in folders for day in range(10))
+
+    contents = {}
+
+    for n_workers in (1, 4):
+        current.db = synthetic_db()
+        slices = 1 if n_workers == 1 else 4
+        stats = audio_scan.scan_storage(storage, n_workers=n_workers, slices_per_folder=slices)
+        assert stats['files_scanned'] == n_files
+        contents[n_workers] = {(rw.box_id, rw.site_id, rw.record_datetime)
+                               for rw in current.db(current.db.audio).select()}
+        assert len(contents[n_workers]) == n_files
+        print('First scan, {} workers and {} slices per folder: {} files in {:.2f}s, {:.0f} files per second, '
+              '{} matched, {} unmatched'.format(n_workers, slices, stats['files_scanned'], stats['scan_seconds'],
+                                                stats['files_per_second'] or 0, stats['known_new'],
+                                                stats['unknown_new']))
+        print(stats['folder_report'])
+
+    assert contents[1] == contents[4]
+
+    stats = audio_scan.scan_storage(storage)
+    assert stats['files_scanned'] == 0
+    print('Second scan: no new files')
+
+    # Wait for the clock to move past the last scan time before adding files
+    time.sleep(1)
+    n_new = sum(add_files(root, folder, [N_DAYS], time.time()) for folder in folders)
+
+    stats = audio_scan.scan_storage(storage)
+    assert stats['files_scanned'] == n_new
+    print('Third scan: {} new files in {:.2f}s'.format(stats['files_scanned'], stats['scan_seconds']))
+
+    record = current.db(current.db.audio).select(limitby=(0, 1)).first()
+    assert storage.metadata(record.box_id).size == 128
+    assert storage.read_range(record.box_id, 100, 200) == b'\x00' * 28
+finally:
+    shutil.rmtree(root)
+    current.db = app_db
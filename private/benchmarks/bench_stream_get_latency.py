@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Load test of the stream_get service, reporting latency percentiles for the
+most recent and shuffle modes. Run it against a local server before and
+after a change to compare, for example:
+
+    python bench_stream_get_latency.py http://127.0.0.1:8000/acoustics_db/default/call/json/stream_get
+
+Options set the number of requests, concurrent clients and sites to use.
+
+Without a URL, the database work of _stream_get is timed in process instead,
+using an in-memory SQLite database with the table definitions and indexes
+from the model and synthetic audio at each site. This compares the original
+queries, which selected every recording in the time window at the site,
+with the limit 1 query used for the most recent mode and the stream_index
+lookup used for shuffle. Run that from the web2py root using:
+
+    python web2py.py -S acoustics_db -M -R applications/acoustics_db/private/benchmarks/bench_stream_get_latency.py
+
+With 14 sites of 8640 recordings, one for each 20 minute window over 120
+days, 1000 requests gave:
+
+    Stream index built in 2.67s
+    recent  before: 1000 requests, p50 5.1ms, p90 7.5ms, p99 12.1ms, max 30.9ms
+    recent  after : 1000 requests, p50 0.7ms, p90 0.8ms, p99 1.4ms, max 3.4ms
+    shuffle before: 1000 requests, p50 5.6ms, p90 7.0ms, p99 12.0ms, max 534.5ms
+    shuffle after : 1000 requests, p50 0.2ms, p90 0.3ms, p99 0.4ms, max 1.6ms
+
+The index build is paid by the first shuffle request after each new
+payload version.
+"""
+
+import argparse
+import datetime
+import random
+import threading
+import time
+import urllib
+import urllib2
+
+N_DAYS = 120
+START_DATE = datetime.datetime(2019, 1, 1)
+
+
+def percentile(values, pct):
+    """
+    Nearest rank percentile of a sorted list
+    """
+
+    idx = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[idx]
+
+
+def report(label, latencies, n_errors=None):
+
+    errors = '' if n_errors is None else '{} errors, '.format(n_errors)
+    print('{}: {} requests, {}p50 {:.1f}ms, p90 {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms'.format(
+        label, len(latencies), errors, *[1000 * percentile(latencies, pct) for pct in (50, 90, 99, 100)]))
+
+
+def run_load(url, n_requests, n_clients, sites, shuffle):
+    """
+    Issues n_requests to stream_get from n_clients threads with random
+    sites and times, returning the sorted latencies and the error count.
+    """
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    per_client = n_requests // n_clients
+
+    def client():
+        for _ in range(per_client):
+            params = urllib.urlencode({'site': random.choice(sites),
+                                       'time': round(random.uniform(0, 23.99), 2),
+                                       'shuffle': 1 if shuffle else ''})
+            start = time.time()
+            try:
+                urllib2.urlopen('{}?{}'.format(url, params)).read()
+                failed = False
+            except urllib2.HTTPError:
+                failed = True
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+                errors.append(failed)
+
+    threads = [threading.Thread(target=client) for _ in range(n_clients)]
+    [thr.start() for thr in threads]
+    [thr.join() for thr in threads]
+
+    return sorted(latencies), sum(errors)
+
+
+def synthetic_db(app_db, sites, min_size, window):
+    """
+    Creates an in-memory database with one recording at each site in each
+    time window of each day, at a random offset within the window. One
+    recording in ten is too small to be streamed.
+    """
+
+    from gluon.dal import DAL
+    import db_indexes
+
+    rng = random.Random(1)
+    mem_db = DAL('sqlite:memory')
+
+    for table in ('sites', 'deployments', 'audio'):
+        mem_db.define_table(table, *[fld.clone() for fld in app_db[table] if fld.name != 'id'])
+
+    for name, table, fields in db_indexes.INDEXES:
+        if table == 'audio':
+            mem_db.executesql('CREATE INDEX {} ON audio ({});'.format(name, ', '.join(fields)))
+
+    mem_db.sites.bulk_insert([{'site_name': 'Site {}'.format(idx), 'habitat': 'Old Growth'}
+                              for idx in range(max(sites))])
+
+    for site in sites:
+        audio = []
+        for day in range(N_DAYS):
+            for slot in range(86400 // window):
+                start_second = slot * window + rng.randrange(window)
+                rec_dt = START_DATE + datetime.timedelta(days=day, seconds=start_second)
+                audio.append({'site_id': site, 'habitat': 'Old Growth',
+                              'recorder_type': 'rpi-eco-monitor',
+                              'record_datetime': rec_dt,
+                              'start_time': rec_dt.time(),
+                              'start_second': start_second,
+                              'file_size': min_size // 2 if rng.random() < 0.1 else min_size * 2,
+                              'box_id': str(rng.getrandbits(48))})
+        mem_db.audio.bulk_insert(audio)
+
+    return mem_db
+
+
+def local_latency(n_requests, sites):
+    """
+    Times the database work of the original and current _stream_get for
+    both modes on an in-memory database of synthetic audio.
+    """
+
+    from gluon import current
+    import stream_index
+
+    app_db = current.db
+    window = int(current.myconf.take('audio.window_width'))
+    min_size = int(current.myconf.take('audio.min_size'))
+
+    db = current.db = synthetic_db(app_db, sites, min_size, window)
+
+    def sim_where(time_second):
+        start_time = START_DATE + datetime.timedelta(seconds=time_second)
+        sim_min = (start_time - datetime.timedelta(seconds=window / 2)).time()
+        sim_max = (start_time + datetime.timedelta(seconds=window / 2)).time()
+        if sim_min < sim_max:
+            return (db.audio.start_time > sim_min) & (db.audio.start_time < sim_max)
+        return (db.audio.start_time > sim_min) | (db.audio.start_time < sim_max)
+
+    def candidates(site, time_second):
+        return db((db.audio.site_id == site) & (db.audio.file_size > min_size) &
+                  sim_where(time_second)).select(orderby=~db.audio.record_datetime)
+
+    def recent_before(site, time_second):
+        return candidates(site, time_second)[0]
+
+    def recent_after(site, time_second):
+        return db((db.audio.site_id == site) & (db.audio.file_size > min_size) &
+                  sim_where(time_second)).select(orderby=~db.audio.record_datetime,
+                                                 limitby=(0, 1)).first()
+
+    def shuffle_before(site, time_second):
+        return random.choice(candidates(site, time_second))
+
+    def shuffle_after(site, time_second):
+        return db.audio[stream_index.random_in_window(site, time_second, window / 2)]
+
+    try:
+        start = time.time()
+        stream_index.random_in_window(sites[0], 0, window / 2)
+        print('Stream index built in {:.2f}s'.format(time.time() - start))
+
+        requests = [(random.choice(sites), random.randrange(0, 86400, 60)) for _ in range(n_requests)]
+
+        for label, func in (('recent  before', recent_before), ('recent  after ', recent_after),
+                            ('shuffle before', shuffle_before), ('shuffle after ', shuffle_after)):
+            latencies = []
+            for site, time_second in requests:
+                start = time.time()
+                func(site, time_second)
+                latencies.append(time.time() - start)
+            report(label, sorted(latencies))
+    finally:
+        current.db = app_db
+
+
+parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+parser.add_argument('url', nargs='?', help='The URL of the stream_get service, omitted to run in process')
+parser.add_argument('-n', '--requests', type=int, default=1000)
+parser.add_argument('-c', '--clients', type=int, default=8)
+parser.add_argument('-s', '--sites', type=int, nargs='+', default=range(1, 15))
+args = parser.parse_args()
+
+if args.url is None:
+    local_latency(args.requests, list(args.sites))
+else:
+    for shuffle in (False, True):
+        latencies, n_errors = run_load(args.url, args.requests, args.clients, args.sites, shuffle)
+        report('shuffle' if shuffle else 'recent ', latencies, n_errors)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of choosing a random GBIF sound for each taxon in api_response,
+comparing one ORDER BY RANDOM() query per taxon with the single query and
+grouping in random_taxon_sounds. Uses synthetic taxa in an in-memory SQLite
+database with the gbif_sound_occurrences table definition from the model.
+
+Run from the web2py root using:
+
+    python web2py.py -S acoustics_db -M -R applications/acoustics_db/private/benchmarks/bench_taxon_sounds.py
+"""
+
+import random
+import timeit
+from gluon import current
+from gluon.dal import DAL, Field
+from module_admin_functions import random_taxon_sounds
+
+app_db = current.db
+
+
+def synthetic_db(n_taxa, max_sounds=20, seed=1):
+    """
+    Creates an in-memory database of taxa with between 0 and max_sounds
+    sound occurrences each.
+    """
+
+    rng = random.Random(seed)
+    mem_db = DAL('sqlite:memory')
+    mem_db.define_table('taxa', Field('scientific_name', 'string'))
+    mem_db.define_table('gbif_sound_occurrences',
+                        *[fld.clone() for fld in app_db.gbif_sound_occurrences
+                          if fld.name not in ('id', 'taxon_id')] +
+                        [Field('taxon_id', 'reference taxa')])
+
+    for idx in range(n_taxa):
+        taxon_id = mem_db.taxa.insert(scientific_name='Taxon {}'.format(idx))
+        mem_db.gbif_sound_occurrences.bulk_insert(
+            [{'taxon_id': taxon_id, 'gbif_occurrence_key': rng.randint(1, 10 ** 9),
+              'gbif_media_identifier': 'https://example.org/{}.mp3'.format(rng.random())}
+             for _ in range(rng.randint(0, max_sounds))])
+
+    return mem_db
+
+
+def per_taxon_sounds(taxon_ids):
+    """
+    The original approach, with one random ordered query per taxon
+    """
+
+    db = current.db
+
+    return {tx: db(db.gbif_sound_occurrences.taxon_id == tx).select(limitby=(0, 1), orderby='<random>').first()
+            for tx in taxon_ids}
+
+
+for n_taxa in (150, 5000):
+
+    current.db = synthetic_db(n_taxa)
+    taxon_ids = [rw.id for rw in current.db(current.db.taxa).select(current.db.taxa.id)]
+
+    # both approaches should find a sound for the same set of taxa
+    old = per_taxon_sounds(taxon_ids)
+    new = random_taxon_sounds(taxon_ids, random.Random(1))
+    assert {tx for tx, snd in old.items() if snd is not None} == set(new)
+
+    # and a seeded choice should be reproducible
+    again = random_taxon_sounds(taxon_ids, random.Random(1))
+    assert {tx: snd.gbif_occurrence_key for tx, snd in new.items()} == \
+        {tx: snd.gbif_occurrence_key for tx, snd in again.items()}
+
+    t_old = min(timeit.repeat(lambda: per_taxon_sounds(taxon_ids), number=1, repeat=3))
+    t_new = min(timeit.repeat(lambda: random_taxon_sounds(taxon_ids, random.Random(1)), number=1, repeat=3))
+
+    print('{:>5} taxa: {} queries in {:.3f}s before, 1 query in {:.3f}s after'.format(
+        n_taxa, len(taxon_ids), t_old, t_new))
+
+current.db = app_db
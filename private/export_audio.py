@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Exports the audio catalogue, joined with the site and deployment details, to
+a CSV, newline delimited JSON or Parquet file. The export is written in
+chunks, so memory use does not grow with the size of the catalogue.
+
+Run this from the web2py folder within the application environment, with
+the export options following -A, for example:
+
+    python web2py.py -S acoustics_db -M -R applications/acoustics_db/private/export_audio.py \
+        -A audio.parquet --sites 1,2,3 --start 2018-01-01 --end 2018-12-31
+
+The format is taken from the output file extension unless --format is given.
+"""
+
+import os
+import sys
+import time
+import argparse
+import datetime
+
+import audio_export
+
+
+def _date(value):
+
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def _sites(value):
+
+    return [int(st) for st in value.split(',')]
+
+
+parser = argparse.ArgumentParser(description='Export the audio catalogue')
+parser.add_argument('outfile', help='The output file')
+parser.add_argument('--format', choices=audio_export.FORMATS, default=None,
+                    help='The output format, defaulting to the file extension')
+parser.add_argument('--sites', type=_sites, default=None, help='A comma separated list of site ids')
+parser.add_argument('--habitat', default=None, help='A habitat name')
+parser.add_argument('--start', type=_date, default=None, help='The first date, as YYYY-MM-DD')
+parser.add_argument('--end', type=_date, default=None, help='The last date, as YYYY-MM-DD')
+parser.add_argument('--chunk-size', type=int, default=5000, help='The number of records read at once')
+
+args = parser.parse_args(sys.argv[1:])
+
+fmt = args.format or os.path.splitext(args.outfile)[1].lstrip('.').lower()
+
+if fmt not in audio_export.FORMATS:
+    parser.error('Cannot work out the format from the file name, use --format')
+
+start_time = time.time()
+
+with open(args.outfile, 'wb') as outfile:
+    n_rows = audio_export.write_export(outfile, fmt, site_ids=args.sites, habitat=args.habitat,
+                                       start=args.start, end=args.end, chunk_size=args.chunk_size)
+
+print('Exported {} records to {} in {:.1f} seconds'.format(n_rows, args.outfile, time.time() - start_time))